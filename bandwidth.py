@@ -0,0 +1,131 @@
+"""
+下载带宽限制
+TokenBucket为令牌桶限速器；BandwidthManager把全局上限和客户端上限在正在下载的任务之间平均分配，/admin/bandwidth显示和调整这些上限。
+本模块只依赖标准库，导入时没有副作用；main创建全局的bandwidth_manager实例并提供上限配置。
+"""
+import time
+import asyncio
+
+# 令牌桶容量对应的秒数，允许的短时突发量为 速率 × 该秒数
+BANDWIDTH_BURST_SECONDS = 1.0
+
+
+class TokenBucket:
+    """
+    令牌桶限速器，rate为每秒字节数，0表示不限速；只在事件循环线程中使用
+    clock为返回秒数的单调时钟，sleep为等待指定秒数的协程函数，测试时可以替换
+    """
+    def __init__(self, rate=0, burst_seconds=BANDWIDTH_BURST_SECONDS, clock=time.monotonic, sleep=asyncio.sleep):
+        self.rate = rate
+        self.burst_seconds = burst_seconds
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = rate * burst_seconds
+        self.updated = clock()
+        self._lock = asyncio.Lock()  # 等待中的请求按先后顺序获得令牌
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.rate * self.burst_seconds, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate):
+        self._refill()
+        self.rate = rate
+        self.tokens = min(self.tokens, rate * self.burst_seconds)
+
+    async def consume(self, amount):
+        """消耗amount个令牌，不足时等待（允许先透支，等待补足欠额）"""
+        if not self.rate:
+            return
+        async with self._lock:
+            self._refill()
+            self.tokens -= amount
+            if self.tokens < 0 and self.rate:
+                await self.sleep(-self.tokens / self.rate)
+
+
+class BandwidthManager:
+    """
+    带宽分配：全局上限和客户端上限在正在下载的任务之间平均分配，每个任务的速率取各项上限中最小的一个
+    子进程和进程池下载通过yt-dlp的限速参数生效（任务速率变化时调用on_rate_change(task_id, rate)），
+    内置分段下载器通过令牌桶生效
+    """
+    def __init__(self, global_limit=0, task_limit=0, client_limit=0, on_rate_change=None,
+                 clock=time.monotonic, sleep=asyncio.sleep):
+        self.global_limit = global_limit
+        self.task_limit = task_limit
+        self.client_limit = client_limit
+        self.on_rate_change = on_rate_change
+        self.clock = clock
+        self.sleep = sleep
+        self.global_bucket = self._new_bucket(global_limit)
+        self._tasks = {}  # task_id -> (客户端, 令牌桶)
+
+    def _new_bucket(self, rate=0):
+        return TokenBucket(rate, clock=self.clock, sleep=self.sleep)
+
+    def _rate_changed(self, task_id, rate):
+        if self.on_rate_change is not None:
+            self.on_rate_change(task_id, rate)
+
+    def register(self, task_id, client=None):
+        self._tasks[task_id] = (client or "local", self._new_bucket())
+        self._rebalance()
+
+    def unregister(self, task_id):
+        if self._tasks.pop(task_id, None) is not None:
+            self._rate_changed(task_id, 0)
+            self._rebalance()
+
+    def set_limits(self, global_limit=None, task_limit=None, client_limit=None):
+        if global_limit is not None:
+            self.global_limit = global_limit
+            self.global_bucket.set_rate(global_limit)
+        if task_limit is not None:
+            self.task_limit = task_limit
+        if client_limit is not None:
+            self.client_limit = client_limit
+        self._rebalance()
+
+    def task_rate(self, task_id):
+        """任务当前的速率上限（字节/秒），0表示不限制"""
+        entry = self._tasks.get(task_id)
+        return entry[1].rate if entry else 0
+
+    def _fair_rate(self, client, client_tasks):
+        limits = [self.task_limit]
+        if self.global_limit:
+            limits.append(self.global_limit / len(self._tasks))
+        if self.client_limit:
+            limits.append(self.client_limit / client_tasks)
+        limits = [limit for limit in limits if limit]
+        return min(limits) if limits else 0
+
+    def _rebalance(self):
+        client_counts = {}
+        for client, _ in self._tasks.values():
+            client_counts[client] = client_counts.get(client, 0) + 1
+        for task_id, (client, bucket) in self._tasks.items():
+            rate = self._fair_rate(client, client_counts[client])
+            if rate != bucket.rate:
+                bucket.set_rate(rate)
+                self._rate_changed(task_id, rate)
+
+    async def consume(self, task_id, amount):
+        """内置下载器每读取一块数据后调用，按任务速率和全局上限等待"""
+        entry = self._tasks.get(task_id)
+        if entry is not None:
+            await entry[1].consume(amount)
+        await self.global_bucket.consume(amount)
+
+    def snapshot(self):
+        return {
+            "global_limit": self.global_limit,
+            "task_limit": self.task_limit,
+            "client_limit": self.client_limit,
+            "tasks": {
+                task_id: {"client": client, "rate": bucket.rate}
+                for task_id, (client, bucket) in self._tasks.items()
+            }
+        }
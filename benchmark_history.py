@@ -0,0 +1,154 @@
+"""
+下载历史查询性能测试
+在临时数据库中按当前迁移创建表结构，分别写入不同数量的记录，
+测量首页历史查询（与get_downloaded_videos相同的键集分页查询）、按路径查找、按文件名删除的耗时，
+并输出查询计划以确认使用了索引。
+用法: python benchmark_history.py [记录数 ...]
+"""
+import os
+import time
+import argparse
+import sqlite3
+import tempfile
+import statistics
+
+# 只导入迁移模块，不导入main（导入main会启动整个应用并初始化./downloads.db）
+from migrations import apply_migrations
+
+# 默认测试的记录数量
+DEFAULT_ROW_COUNTS = [10_000, 100_000, 1_000_000]
+# 最近2天内的记录数（首页只显示最近2天的记录，与总记录数无关）
+RECENT_ROWS = 1_000
+# 每个查询重复执行的次数
+REPEAT = 50
+BATCH_SIZE = 50_000
+# 每页条数（get_downloaded_videos多取一条用于判断是否还有下一页）
+PAGE_SIZE = 10
+
+TWO_DAYS = 2 * 24 * 60 * 60
+
+HISTORY_COLUMNS = "download_time_str, title, filepath, file_type, download_time, id, file_mtime"
+
+QUERIES = {
+    "历史记录计数": (
+        "SELECT COUNT(*) FROM downloads WHERE file_exists = 1 AND download_time >= ?",
+        lambda now, n: (now - TWO_DAYS,)
+    ),
+    "历史记录第一页": (
+        f"SELECT {HISTORY_COLUMNS} FROM downloads WHERE file_exists = 1 AND download_time >= ? "
+        "ORDER BY download_time DESC, id DESC LIMIT ? OFFSET ?",
+        lambda now, n: (now - TWO_DAYS, PAGE_SIZE + 1, 0)
+    ),
+    "历史记录游标翻页": (
+        f"SELECT {HISTORY_COLUMNS} FROM downloads WHERE file_exists = 1 AND download_time >= ? "
+        "AND (download_time, id) < (?, ?) "
+        "ORDER BY download_time DESC, id DESC LIMIT ? OFFSET ?",
+        lambda now, n: (
+            now - TWO_DAYS, recent_download_time(now, RECENT_ROWS // 2), f"id-{RECENT_ROWS // 2}", PAGE_SIZE + 1, 0
+        )
+    ),
+    "最近下载": (
+        f"SELECT {HISTORY_COLUMNS} FROM downloads WHERE file_exists = 1 AND download_time >= ? "
+        "ORDER BY download_time DESC, id DESC LIMIT ?",
+        lambda now, n: (now - TWO_DAYS, 3)
+    ),
+    "按路径查找": (
+        "SELECT id FROM downloads WHERE filepath = ?",
+        lambda now, n: (make_filepath(n // 2),)
+    ),
+    "按文件名删除": (
+        "DELETE FROM downloads WHERE file_name = ?",
+        lambda now, n: (make_filename(n // 3),)
+    ),
+}
+
+
+def recent_download_time(now, i):
+    """第i条最近记录的下载时间（前RECENT_ROWS条均匀分布在最近2天内）"""
+    return now - (i * TWO_DAYS / RECENT_ROWS)
+
+
+def make_filename(i):
+    return f"video {i}-{i:011d}.mp4"
+
+
+def make_filepath(i):
+    return os.path.join("C:\\videos", make_filename(i))
+
+
+def populate(conn, row_count, now):
+    """写入row_count条记录，其中RECENT_ROWS条在最近2天内，其余为更早的记录"""
+    def rows():
+        for i in range(row_count):
+            if i < RECENT_ROWS:
+                download_time = recent_download_time(now, i)
+            else:
+                download_time = now - TWO_DAYS - 60 - i
+            filename = make_filename(i)
+            yield (
+                f"id-{i}", f"video {i}", make_filepath(i), "MP4", f"uploader {i % 1000}",
+                "0:03:21", "12.00 MB", "VIDEO - best", download_time,
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(download_time)),
+                None, "C:\\videos", 12 * 1024 * 1024, 201, f"{i:011d}", filename
+            )
+
+    insert = (
+        "INSERT INTO downloads (id, title, filepath, file_type, uploader, duration, filesize, "
+        "format_info, download_time, download_time_str, custom_path, actual_download_dir, "
+        "filesize_bytes, duration_seconds, video_id, file_name) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    )
+    batch = []
+    for row in rows():
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            conn.executemany(insert, batch)
+            batch.clear()
+    if batch:
+        conn.executemany(insert, batch)
+    conn.commit()
+    conn.execute("ANALYZE")
+
+
+def measure(conn, sql, params):
+    timings = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        conn.execute(sql, params).fetchall()
+        timings.append((time.perf_counter() - start) * 1000)
+        conn.rollback()  # 删除操作不提交，保证每次测量的数据相同
+    return statistics.median(timings)
+
+
+def run(row_count):
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    try:
+        conn = sqlite3.connect(path)
+        apply_migrations(conn)
+        now = time.time()
+        print(f"\n===== {row_count:,} 条记录 =====")
+        start = time.perf_counter()
+        populate(conn, row_count, now)
+        print(f"写入耗时: {time.perf_counter() - start:.1f} 秒")
+
+        for name, (sql, make_params) in QUERIES.items():
+            params = make_params(now, row_count)
+            plan = "; ".join(row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params))
+            print(f"{name}: {measure(conn, sql, params):.3f} ms  [{plan}]")
+        conn.close()
+    finally:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="下载历史查询性能测试")
+    parser.add_argument(
+        "row_counts", metavar="记录数", type=int, nargs="*",
+        help=f"要测试的记录数量，默认 {' '.join(str(count) for count in DEFAULT_ROW_COUNTS)}"
+    )
+    args = parser.parse_args()
+    for count in args.row_counts or DEFAULT_ROW_COUNTS:
+        run(count)
@@ -0,0 +1,240 @@
+"""
+下载历史查询
+HistoryQuery按过滤条件生成历史记录的计数和分页查询（按 download_time, id 的键集分页），
+在同一个读事务中执行并生成下一页的游标；总数按history_meta中的版本号缓存。
+本模块只依赖标准库，导入时没有副作用；main在数据库读连接上执行查询。
+"""
+import re
+import json
+import time
+import base64
+import logging
+import threading
+from datetime import datetime, timedelta
+from collections import OrderedDict
+
+db_log = logging.getLogger("ytdl.db")
+
+# 首页显示最近多少天的下载记录
+HISTORY_DISPLAY_DAYS = 2
+
+# 文件类型分组，file_type参数也可以直接传文件扩展名（如mp4）
+FILE_TYPE_GROUPS = {
+    "video": ("MP4", "WEBM", "MKV", "FLV", "MOV", "AVI", "ZIP"),
+    "audio": ("MP3", "M4A", "AAC", "OPUS", "OGG", "WAV", "FLAC"),
+}
+# 全文搜索的相关度权重（标题、上传者）
+SEARCH_WEIGHTS = (10.0, 1.0)
+SEARCH_TERM_PATTERN = re.compile(r'"([^"]+)"|(\S+)')
+
+
+def build_search_query(search_text, tokenizer):
+    """
+    把搜索文本转换为FTS5 MATCH表达式
+    支持用双引号包裹的短语；unicode61分词时普通词按前缀匹配（词尾*可省略），
+    trigram分词本身就是子串匹配，少于3个字符的词无法用trigram索引，返回到like_terms中用LIKE匹配。
+    返回 (match表达式或None, like_terms)
+    """
+    phrases = []
+    like_terms = []
+    for quoted, word in SEARCH_TERM_PATTERN.findall(search_text):
+        term = (quoted or word).strip()
+        is_prefix = not quoted
+        if word and term.endswith("*"):
+            term = term.rstrip("*")
+        if not term:
+            continue
+        if tokenizer is None or (tokenizer == "trigram" and len(term) < 3):
+            like_terms.append(term)
+            continue
+        phrase = '"' + term.replace('"', '""') + '"'
+        if tokenizer != "trigram" and is_prefix:
+            phrase += "*"
+        phrases.append(phrase)
+    return (" ".join(phrases) or None), like_terms
+
+
+def parse_date_filter(date_str, end_of_day=False):
+    """把YYYY-MM-DD日期转换为时间戳，end_of_day为True时返回次日零点，无法解析时返回None"""
+    if not date_str:
+        return None
+    try:
+        day = datetime.strptime(date_str, "%Y-%m-%d")
+    except ValueError:
+        db_log.warning(f"忽略无法解析的日期: {date_str}")
+        return None
+    if end_of_day:
+        day += timedelta(days=1)
+    return day.timestamp()
+
+
+# 首页"最近下载"显示的数量
+HISTORY_RECENT_COUNT = 3
+# 历史记录总数缓存：downloads表有变化时立即失效，否则最多缓存HISTORY_COUNT_TTL秒（2天时间窗口随时间移动）
+HISTORY_COUNT_TTL = 60
+HISTORY_COUNT_CACHE_SIZE = 64
+
+
+class HistoryCountCache:
+    """按过滤条件缓存历史记录总数，以history_meta中的版本号判断是否失效"""
+    def __init__(self, max_entries=HISTORY_COUNT_CACHE_SIZE, ttl=HISTORY_COUNT_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (version, 缓存时间, 总数)
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version or time.time() - entry[1] > self.ttl:
+                return None
+            self._entries.move_to_end(key)
+            return entry[2]
+
+    def put(self, key, version, count):
+        with self._lock:
+            self._entries[key] = (version, time.time(), count)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+
+def encode_history_cursor(values):
+    """把最后一条记录的排序键编码为不透明的游标字符串"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode("utf-8")).decode("ascii")
+
+
+def decode_history_cursor(cursor):
+    """解析游标，无效时返回None"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return values if isinstance(values, list) and len(values) in (2, 3) else None
+    except (ValueError, UnicodeError):
+        return None
+
+
+class HistoryQuery:
+    """
+    下载历史查询
+    使用游标（按 download_time, id 的键集分页）时不需要跳过前面的记录，翻到很深的页也保持一样快；
+    没有游标时按page兼容旧的页码分页。include_recent为True时同时查询"最近下载"，
+    默认首页直接复用同一个结果集。tokenizer为全文索引的分词器，没有全文索引时为None
+    """
+    def __init__(self, page=1, page_size=10, start_date=None, end_date=None, search_text=None, file_type=None,
+                 cursor=None, include_recent=False, tokenizer=None, now=None):
+        self.page_size = page_size
+        # 构建基础查询，只选择需要的字段
+        columns = [
+            'downloads.download_time_str',
+            'downloads.title',
+            'downloads.filepath',
+            'downloads.file_type',
+            'downloads.download_time',
+            'downloads.id',
+            'downloads.file_mtime'
+        ]
+        from_clause = 'FROM downloads'
+        # 只显示文件仍然存在的记录（由后台同步维护）
+        conditions = ['downloads.file_exists = 1']
+        params = []
+        rank_expr = None
+        match_query, like_terms = None, []
+        
+        # 添加搜索文本过滤：使用全文索引，并按相关度排序
+        if search_text:
+            match_query, like_terms = build_search_query(search_text, tokenizer)
+            if match_query:
+                rank_expr = f'bm25(downloads_fts, {SEARCH_WEIGHTS[0]}, {SEARCH_WEIGHTS[1]})'
+                columns.append(rank_expr)
+                from_clause += ' JOIN downloads_fts ON downloads_fts.rowid = downloads.rowid'
+                conditions.append('downloads_fts MATCH ?')
+                params.append(match_query)
+            for term in like_terms:
+                conditions.append('(downloads.title LIKE ? OR downloads.uploader LIKE ?)')
+                search_pattern = f'%{term}%'
+                params.extend([search_pattern, search_pattern])
+        self.rank_expr = rank_expr
+        
+        # 默认显示最近2天的记录，指定了日期范围时在此基础上过滤
+        self.two_days_ago = (time.time() if now is None else now) - HISTORY_DISPLAY_DAYS * 86400
+        start_time = parse_date_filter(start_date)
+        conditions.append('downloads.download_time >= ?')
+        params.append(max(self.two_days_ago, start_time or 0))
+        end_time = parse_date_filter(end_date, end_of_day=True)
+        if end_time is not None:
+            conditions.append('downloads.download_time < ?')
+            params.append(end_time)
+        
+        # 文件类型过滤
+        file_types = ()
+        if file_type:
+            file_types = FILE_TYPE_GROUPS.get(file_type.lower(), (file_type.upper().lstrip("."),))
+            conditions.append(f'downloads.file_type IN ({", ".join("?" * len(file_types))})')
+            params.extend(file_types)
+        
+        # 获取总记录数（不含分页条件）
+        self.count_query = f'SELECT COUNT(*) {from_clause} WHERE {" AND ".join(conditions)}'
+        self.count_params = list(params)
+        self.count_key = (match_query, tuple(like_terms), start_time, end_time, file_types)
+        
+        # 键集分页：从上一页最后一条记录之后继续
+        cursor_values = decode_history_cursor(cursor) if cursor else None
+        offset = 0
+        if cursor_values is not None:
+            if rank_expr and len(cursor_values) == 3:
+                conditions.append(
+                    f'({rank_expr} > ? OR ({rank_expr} = ? AND (downloads.download_time, downloads.id) < (?, ?)))'
+                )
+                params.extend([cursor_values[0], cursor_values[0], cursor_values[1], cursor_values[2]])
+            else:
+                conditions.append('(downloads.download_time, downloads.id) < (?, ?)')
+                params.extend(cursor_values[-2:])
+        else:
+            offset = (max(1, page) - 1) * page_size
+        
+        # 添加排序（相关度优先，其次按时间倒序）
+        order_by = 'downloads.download_time DESC, downloads.id DESC'
+        if rank_expr:
+            order_by = f'{rank_expr}, ' + order_by
+        self.query = (
+            f'SELECT {", ".join(columns)} {from_clause} WHERE {" AND ".join(conditions)} '
+            f'ORDER BY {order_by} LIMIT ? OFFSET ?'
+        )
+        # 多取一条，用于判断是否还有下一页
+        params.extend([page_size + 1, offset])
+        self.params = params
+        
+        # 默认首页（无过滤、第一页）的前几条就是"最近下载"，其他情况单独查询
+        is_default_first_page = not (search_text or start_date or end_date or file_type or cursor_values or offset)
+        self.recent_query = None
+        if include_recent and not is_default_first_page:
+            self.recent_query = '''
+                SELECT download_time_str, title, filepath, file_type, download_time, id, file_mtime
+                FROM downloads WHERE file_exists = 1 AND download_time >= ?
+                ORDER BY download_time DESC, id DESC LIMIT ?
+            '''
+
+    def fetch(self, conn, count_cache=None):
+        """
+        在同一个读事务中执行计数和分页查询
+        返回 (总数, 本页记录, 最近下载的记录（复用本页时为None）, 下一页的游标（没有下一页时为None）)
+        """
+        cur = conn.cursor()
+        version = cur.execute("SELECT value FROM history_meta WHERE key = 'version'").fetchone()[0]
+        total_count = count_cache.get(self.count_key, version) if count_cache is not None else None
+        if total_count is None:
+            total_count = cur.execute(self.count_query, self.count_params).fetchone()[0]
+            if count_cache is not None:
+                count_cache.put(self.count_key, version, total_count)
+        rows = cur.execute(self.query, self.params).fetchall()
+        recent_rows = None
+        if self.recent_query:
+            recent_rows = cur.execute(self.recent_query, (self.two_days_ago, HISTORY_RECENT_COUNT)).fetchall()
+        
+        next_cursor = None
+        if len(rows) > self.page_size:
+            rows = rows[:self.page_size]
+            last = rows[-1]
+            next_cursor = encode_history_cursor(([last[7]] if self.rank_expr else []) + [last[4], last[5]])
+        return total_count, rows, recent_rows, next_cursor
@@ -6,6 +6,7 @@ import time
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Any, Union
 from pathlib import Path
+from collections import deque, OrderedDict
 import sys
 import shutil
 from pydantic import BaseModel
@@ -14,29 +15,59 @@ from tkinter import filedialog
 import ctypes
 from ctypes.wintypes import HWND, LPWSTR, UINT
 import subprocess
+import multiprocessing
+import queue
+import concurrent.futures
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import sqlite3
-from functools import lru_cache
+from functools import lru_cache, partial
+from glob import escape as glob_escape
 from difflib import SequenceMatcher
 import hashlib
 import hmac
 import threading
 import zipfile
+import io
 import platform
 import winshell
 import logging
+import logging.handlers
+import atexit
 import html
 import re
-import random
+import bisect
+import math
+from urllib.parse import urlsplit, urljoin, quote
+import ssl
 
 import yt_dlp
 from fastapi import FastAPI, Request, Form, HTTPException
-from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, StreamingResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 import uvicorn
 import aiofiles
 import win32com.client
 
+import ytdlp_worker
+from migrations import apply_migrations, detect_fts_tokenizer, extract_video_id_from_path
+from bandwidth import BandwidthManager
+from history import HISTORY_DISPLAY_DAYS, HISTORY_RECENT_COUNT, HistoryCountCache, HistoryQuery
+from scheduler import DownloadScheduler, QueueFullError
+from tasks import TASK_TRANSITIONS, TERMINAL_TASK_STATES, TaskStore
+from ytdlp_process import (
+    YtdlpProcess, YTDLP_STRUCTURED_OUTPUT_ARGS, parse_ytdlp_output_line, is_ytdlp_structured_line, describe_postprocess
+)
+
+# watchdog为可选依赖：未安装时只通过定期扫描同步下载文件的状态
+try:
+    from watchdog.observers import Observer
+    WATCHDOG_AVAILABLE = True
+except ImportError:
+    Observer = None
+    WATCHDOG_AVAILABLE = False
+
 # 创建应用
 app = FastAPI(title="YouTube视频下载器")
 
@@ -45,6 +76,352 @@ templates = Jinja2Templates(directory="templates")
 app.mount("/static", StaticFiles(directory="static"), name="static")
 app.mount("/videos", StaticFiles(directory="videos"), name="videos")
 
+# ==================== 日志 ====================
+# 日志通过QueueHandler交给后台线程输出，调用方不会因为控制台写入（Windows控制台尤其慢）而阻塞
+# 日志级别
+LOG_LEVEL = "INFO"
+# 输出格式: "text" 普通文本; "json" 每行一个JSON对象
+LOG_FORMAT = "text"
+# 高频日志（如逐行的yt-dlp输出）按限流键限制：每个周期内每个键最多输出的条数
+LOG_RATE_LIMIT = 20
+LOG_RATE_LIMIT_INTERVAL = 10
+# JSON日志中从extra取出的字段
+LOG_EXTRA_FIELDS = ("task_id", "suppressed")
+
+
+class JsonLogFormatter(logging.Formatter):
+    """每条日志输出为一行JSON"""
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        for field in LOG_EXTRA_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class TextLogFormatter(logging.Formatter):
+    """普通文本格式，附带任务ID和被限流丢弃的条数"""
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s [%(name)s] %(message)s")
+
+    def format(self, record):
+        text = super().format(record)
+        suppressed = getattr(record, "suppressed", None)
+        if suppressed:
+            text += f" (限流省略了 {suppressed} 条)"
+        return text
+
+
+class LogRateLimitFilter(logging.Filter):
+    """
+    对带有rate_key的日志限流（extra={"rate_key": ...}），没有rate_key的日志不受影响。
+    每个键每个周期最多通过LOG_RATE_LIMIT条，被丢弃的条数附加在下一条通过的日志上
+    """
+    def __init__(self, limit=LOG_RATE_LIMIT, interval=LOG_RATE_LIMIT_INTERVAL):
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        self._windows = {}  # 限流键 -> [周期开始时间, 已通过条数, 已丢弃条数]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = getattr(record, "rate_key", None)
+        if key is None:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window is not None else 0
+                window = self._windows[key] = [now, 0, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+            if window[1] >= self.limit:
+                window[2] += 1
+                return False
+            window[1] += 1
+            return True
+
+
+def setup_logging():
+    """配置ytdl日志器：限流后放入队列，由QueueListener在后台线程写到标准输出"""
+    root = logging.getLogger("ytdl")
+    if root.handlers:
+        return None
+    root.setLevel(LOG_LEVEL)
+    root.propagate = False
+
+    stream = sys.stdout or sys.stderr
+    if stream is None:
+        # 无控制台的打包程序中没有标准输出
+        output = logging.NullHandler()
+    else:
+        output = logging.StreamHandler(stream)
+    output.setFormatter(JsonLogFormatter() if LOG_FORMAT == "json" else TextLogFormatter())
+
+    log_queue = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(log_queue)
+    handler.addFilter(LogRateLimitFilter())
+    root.addHandler(handler)
+    listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+log_listener = setup_logging()
+
+# 各子系统的日志器
+db_log = logging.getLogger("ytdl.db")
+task_log = logging.getLogger("ytdl.tasks")
+scheduler_log = logging.getLogger("ytdl.scheduler")
+download_log = logging.getLogger("ytdl.download")
+pool_log = logging.getLogger("ytdl.pool")
+info_log = logging.getLogger("ytdl.info")
+playlist_log = logging.getLogger("ytdl.playlist")
+zip_log = logging.getLogger("ytdl.zip")
+ffmpeg_log = logging.getLogger("ytdl.ffmpeg")
+api_log = logging.getLogger("ytdl.api")
+metrics_log = logging.getLogger("ytdl.metrics")
+
+
+# 退出时输出队列中剩余的日志
+if log_listener is not None:
+    atexit.register(log_listener.stop)
+
+
+# ==================== 运行指标（Prometheus） ====================
+# /metrics以Prometheus文本格式（0.0.4）输出计数器、仪表和直方图，不依赖prometheus_client
+# 数据库写线程在init_db()时就会记录指标，因此本节必须位于数据库初始化之前
+# 指标名前缀
+METRICS_PREFIX = "ytdl_"
+# 耗时较短的操作（数据库写入、启动子进程、事件循环延迟）使用的直方图分桶（秒）
+FAST_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# 任务阶段耗时的直方图分桶（秒）
+PHASE_LATENCY_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+# 事件循环延迟的采样间隔（秒）
+EVENT_LOOP_LAG_INTERVAL = 0.5
+
+
+def _format_metric_value(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        if value.is_integer():
+            return str(int(value))
+        return repr(value)
+    return str(value)
+
+
+def _escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_metric_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label_value(value)}"' for name, value in pairs) + "}"
+
+
+class MetricsRegistry:
+    """按注册顺序输出所有指标"""
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                metrics_log.warning(f"生成指标 {metric.name} 时出错: {e}")
+        return "\n".join(lines) + "\n"
+
+
+metrics_registry = MetricsRegistry()
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labels=(), registry=metrics_registry):
+        self.name = METRICS_PREFIX + name
+        self.help = help_text.replace("\\", "\\\\").replace("\n", "\\n")
+        self.labelnames = tuple(labels)
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"指标 {self.name} 需要标签 {self.labelnames}，实际为 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """只增不减的计数器，可在任意线程调用"""
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=(), registry=metrics_registry):
+        super().__init__(name, help_text, labels, registry)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+        if not values and not self.labelnames:
+            values[()] = 0
+        return self._header() + [
+            f"{self.name}{_format_metric_labels(self.labelnames, key)} {_format_metric_value(value)}"
+            for key, value in sorted(values.items())
+        ]
+
+
+class Gauge(_Metric):
+    """
+    当前值；可以直接set，也可以提供回调在输出时计算
+    回调返回数值（无标签），或 {标签值元组: 数值} 字典
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labels=(), collect=None, registry=metrics_registry):
+        super().__init__(name, help_text, labels, registry)
+        self._values = {}
+        self._collect = collect
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def render(self):
+        if self._collect is not None:
+            collected = self._collect()
+            values = collected if isinstance(collected, dict) else {(): collected}
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return self._header() + [
+            f"{self.name}{_format_metric_labels(self.labelnames, key)} {_format_metric_value(value)}"
+            for key, value in sorted(values.items())
+        ]
+
+
+class Histogram(_Metric):
+    """累积分桶的直方图，可在任意线程调用"""
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=FAST_LATENCY_BUCKETS, registry=metrics_registry):
+        super().__init__(name, help_text, labels, registry)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # 标签值 -> [各分桶计数, 总和, 数量]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, **labels):
+        """计时上下文管理器"""
+        return _HistogramTimer(self, labels)
+
+    def render(self):
+        with self._lock:
+            series = {key: (list(counts), total, count) for key, (counts, total, count) in self._series.items()}
+        lines = self._header()
+        for key, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_metric_labels(self.labelnames, key, [("le", _format_metric_value(float(bound)))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_metric_labels(self.labelnames, key, [("le", "+Inf")])
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_metric_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_metric_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class _HistogramTimer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+def _collect_task_states():
+    return {(state,): len(task_store.ids_in_state(state)) for state in TASK_TRANSITIONS}
+
+
+TASKS_BY_STATE = Gauge("tasks", "内存中各状态的任务数", labels=("state",), collect=_collect_task_states)
+TASKS_FINISHED = Counter("tasks_finished_total", "按最终状态统计的结束任务数", labels=("state",))
+QUEUE_DEPTH = Gauge("queue_depth", "调度器等待队列中的任务数", collect=lambda: download_scheduler.stats()["queued"])
+RUNNING_DOWNLOADS = Gauge("running_downloads", "正在运行的下载任务数", collect=lambda: download_scheduler.stats()["running"])
+DOWNLOAD_BYTES = Counter("download_bytes_total", "所有任务实际下载的字节数")
+PHASE_DURATION = Histogram(
+    "phase_duration_seconds", "任务各阶段耗时（extract为提取视频信息，merge为ffmpeg合并）",
+    labels=("phase",), buckets=PHASE_LATENCY_BUCKETS
+)
+DB_WRITE_DURATION = Histogram("db_write_duration_seconds", "数据库写线程执行一次写操作（含提交）的耗时")
+SUBPROCESS_SPAWN_DURATION = Histogram("subprocess_spawn_seconds", "启动yt-dlp/ffmpeg子进程的耗时")
+YtdlpProcess.spawn_observer = SUBPROCESS_SPAWN_DURATION.observe
+DOWNLOAD_RETRIES = Counter("download_retries_total", "按错误类型统计的下载重试次数", labels=("error_class",))
+EVENT_LOOP_LAG = Histogram("event_loop_lag_seconds", "事件循环调度延迟（定时器实际唤醒时间与预期之差）")
+
+
+async def monitor_event_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        EVENT_LOOP_LAG.observe(max(0.0, loop.time() - start - EVENT_LOOP_LAG_INTERVAL))
+
+
+@app.on_event("startup")
+async def start_event_loop_lag_monitor():
+    asyncio.create_task(monitor_event_loop_lag())
+
+
+# Prometheus抓取接口
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 # 全局变量
 BASE_DIR = Path(__file__).resolve().parent
 STATIC_DIR = BASE_DIR / "static"
@@ -56,83 +433,324 @@ VIDEOS_DIR.mkdir(exist_ok=True)
 
 # 数据库初始化
 DB_PATH = Path("downloads.db")
+# 读连接数量（读操作在对应数量的线程中执行）
+DB_READER_COUNT = 4
+# 每个连接缓存的预编译语句数量
+DB_STATEMENT_CACHE_SIZE = 256
+# 数据库被锁定时的等待时间（毫秒）
+DB_BUSY_TIMEOUT_MS = 5000
 
-def init_db():
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS downloads (
-            id TEXT PRIMARY KEY,
-            title TEXT,
-            filepath TEXT,
-            file_type TEXT,
-            uploader TEXT,
-            duration TEXT,
-            filesize TEXT,
-            format_info TEXT,
-            download_time REAL,
-            download_time_str TEXT,
-            custom_path TEXT,
-            actual_download_dir TEXT
+
+class Database:
+    """
+    SQLite访问层
+    所有写操作在一个专用写线程中顺序执行（单写者，避免锁竞争），读操作使用连接池中的读连接，
+    连接长期复用以便重用预编译语句；数据库使用WAL模式和synchronous=NORMAL。
+    同步方法可在任意线程调用，a开头的异步方法在后台线程执行，不阻塞事件循环。
+    """
+    def __init__(self, path, reader_count=DB_READER_COUNT):
+        self.path = path
+        self.reader_count = reader_count
+        self._lock = threading.Lock()
+        self._write_queue = queue.Queue()
+        self._writer_thread = None
+        self._writer_conn = None
+        self._readers = queue.LifoQueue()
+        self._executor = None
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE_SIZE
         )
-        ''')
-        
-        # 检查actual_download_dir列是否存在，如果不存在则添加
-        cursor.execute("PRAGMA table_info(downloads)")
-        columns = [column[1] for column in cursor.fetchall()]
-        
-        if "actual_download_dir" not in columns:
-            print("添加actual_download_dir列到downloads表")
-            cursor.execute("ALTER TABLE downloads ADD COLUMN actual_download_dir TEXT")
-        
-        conn.commit()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        return conn
+
+    def _ensure_writer(self):
+        with self._lock:
+            if self._writer_thread is None or not self._writer_thread.is_alive():
+                self._writer_thread = threading.Thread(target=self._writer_loop, name="db-writer", daemon=True)
+                self._writer_thread.start()
+
+    def _writer_loop(self):
+        conn = self._writer_conn = self._connect()
+        while True:
+            func, args, future = self._write_queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            start = time.perf_counter()
+            try:
+                result = func(conn, *args)
+                conn.commit()
+                future.set_result(result)
+            except BaseException as e:
+                conn.rollback()
+                future.set_exception(e)
+            finally:
+                DB_WRITE_DURATION.observe(time.perf_counter() - start)
+
+    def submit_write(self, func, *args):
+        """把写操作func(conn, *args)排入写线程，返回concurrent.futures.Future；执行后自动提交"""
+        future = concurrent.futures.Future()
+        if threading.current_thread() is self._writer_thread:
+            # 写线程中嵌套的写操作直接执行，由外层统一提交
+            try:
+                future.set_result(func(self._writer_conn, *args))
+            except BaseException as e:
+                future.set_exception(e)
+            return future
+        self._ensure_writer()
+        self._write_queue.put((func, args, future))
+        return future
+
+    def write(self, func, *args):
+        """执行写操作并等待结果"""
+        return self.submit_write(func, *args).result()
+
+    def read(self, func, *args):
+        """借用一个读连接执行func(conn, *args)并返回结果"""
+        try:
+            conn = self._readers.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            return func(conn, *args)
+        finally:
+            conn.rollback()  # 结束读事务，避免长期持有WAL快照
+            self._readers.put(conn)
+
+    def execute(self, sql, params=()):
+        """执行一条写SQL，返回受影响的行数"""
+        return self.write(lambda conn: conn.execute(sql, params).rowcount)
+
+    def executemany(self, sql, seq_of_params):
+        return self.write(lambda conn: conn.executemany(sql, seq_of_params).rowcount)
+
+    def fetchone(self, sql, params=()):
+        return self.read(lambda conn: conn.execute(sql, params).fetchone())
+
+    def fetchall(self, sql, params=()):
+        return self.read(lambda conn: conn.execute(sql, params).fetchall())
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.reader_count, thread_name_prefix="db-reader"
+                )
+            return self._executor
+
+    async def run(self, func, *args, **kwargs):
+        """在数据库线程池中执行阻塞函数（其中可以调用同步的read/write方法）"""
+        return await asyncio.get_running_loop().run_in_executor(self._get_executor(), partial(func, *args, **kwargs))
+
+    async def aread(self, func, *args):
+        return await self.run(self.read, func, *args)
+
+    async def awrite(self, func, *args):
+        return await asyncio.wrap_future(self.submit_write(func, *args))
+
+    async def aexecute(self, sql, params=()):
+        return await self.awrite(lambda conn: conn.execute(sql, params).rowcount)
+
+    async def afetchone(self, sql, params=()):
+        return await self.run(self.fetchone, sql, params)
+
+    async def afetchall(self, sql, params=()):
+        return await self.run(self.fetchall, sql, params)
+
+
+db = Database(DB_PATH)
+
+
+# ==================== 数据库结构迁移 ====================
+# 迁移定义在migrations.py中（无副作用，可单独导入）
+
+# 全文索引使用的分词器（trigram/unicode61），未建立全文索引时为None，在init_db中检测
+downloads_fts_tokenizer = None
+
+
+def init_db():
+    global downloads_fts_tokenizer
+    db.write(apply_migrations)
+    downloads_fts_tokenizer = db.read(detect_fts_tokenizer)
 
 # 初始化数据库
 init_db()
 
-# 清理旧数据的函数
-def cleanup_old_records():
+# ==================== 下载记录保留策略 ====================
+# 保留策略按顺序执行，可用的类型：
+#   age   - 删除下载时间超过max_age_days天的记录
+#   idle  - 删除最后访问时间超过max_idle_days天的记录
+#   count - 只保留最新的max_records条记录
+#   quota - 每个下载目录中记录的文件总大小不超过max_bytes，超出时按最近访问时间（LRU）删除
+# delete_files为True时同时删除媒体文件，否则只删除数据库记录
+RETENTION_POLICIES = [
+    {"type": "age", "max_age_days": HISTORY_DISPLAY_DAYS, "delete_files": False},
+    # {"type": "count", "max_records": 1000, "delete_files": True},
+    # {"type": "quota", "max_bytes": 50 * 1024 ** 3, "delete_files": True},
+]
+# 执行间隔（秒）
+RETENTION_INTERVAL = 3600
+# 每批处理的记录数，以及每次执行每个策略最多处理的批数（剩余的在下次执行时继续）
+RETENTION_BATCH_SIZE = 200
+RETENTION_MAX_BATCHES = 10
+
+
+class RetentionEngine:
+    """按保留策略分批清理下载记录（及文件），记录每次回收的空间"""
+    def __init__(self, policies, batch_size=RETENTION_BATCH_SIZE, max_batches=RETENTION_MAX_BATCHES):
+        self.policies = policies
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self.last_report = None
+
+    def run_once(self):
+        """执行一轮清理并返回报告（在数据库线程池中调用）"""
+        started = time.time()
+        report = {"started_at": started, "policies": [], "records": 0, "reclaimed_bytes": 0}
+        for policy in self.policies:
+            try:
+                records, reclaimed = self._apply_policy(policy, started)
+            except Exception as e:
+                db_log.warning(f"执行保留策略出错 {policy}: {e}")
+                records, reclaimed = 0, 0
+            report["policies"].append({**policy, "records": records, "reclaimed_bytes": reclaimed})
+            report["records"] += records
+            report["reclaimed_bytes"] += reclaimed
+        report["duration"] = time.time() - started
+        self.last_report = report
+        if report["records"]:
+            db_log.info(f"保留策略清理了 {report['records']} 条记录，回收 {format_size(report['reclaimed_bytes'])}")
+        return report
+
+    def _apply_policy(self, policy, now):
+        kind = policy["type"]
+        if kind == "quota":
+            return self._apply_quota(policy)
+        if kind == "age":
+            sql = '''SELECT rowid, filepath FROM downloads WHERE download_time < ?
+                     ORDER BY download_time LIMIT ?'''
+            params = (now - policy["max_age_days"] * 86400,)
+        elif kind == "idle":
+            sql = '''SELECT rowid, filepath FROM downloads WHERE last_accessed < ?
+                     ORDER BY last_accessed LIMIT ?'''
+            params = (now - policy["max_idle_days"] * 86400,)
+        elif kind == "count":
+            sql = '''SELECT rowid, filepath FROM downloads
+                     ORDER BY download_time DESC, id DESC LIMIT ? OFFSET ?'''
+            params = None
+        else:
+            raise ValueError(f"未知的保留策略类型: {kind}")
+
+        records = reclaimed = 0
+        for _ in range(self.max_batches):
+            if params is None:
+                rows = db.fetchall(sql, (self.batch_size, policy["max_records"]))
+            else:
+                rows = db.fetchall(sql, params + (self.batch_size,))
+            if not rows:
+                break
+            reclaimed += self._remove(rows, policy.get("delete_files", False))
+            records += len(rows)
+        return records, reclaimed
+
+    def _apply_quota(self, policy):
+        """每个目录超出配额时，按最近访问时间从旧到新删除，直到回到配额以内"""
+        records = reclaimed = 0
+        over_quota = db.fetchall(
+            '''SELECT actual_download_dir, SUM(filesize_bytes) FROM downloads
+               WHERE file_exists = 1 GROUP BY actual_download_dir HAVING SUM(filesize_bytes) > ?''',
+            (policy["max_bytes"],)
+        )
+        for directory, total_bytes in over_quota:
+            excess = total_bytes - policy["max_bytes"]
+            for _ in range(self.max_batches):
+                if excess <= 0:
+                    break
+                candidates = db.fetchall(
+                    '''SELECT rowid, filepath, filesize_bytes FROM downloads
+                       WHERE actual_download_dir IS ? AND file_exists = 1
+                       ORDER BY last_accessed LIMIT ?''',
+                    (directory, self.batch_size)
+                )
+                if not candidates:
+                    break
+                rows = []
+                for rowid, filepath, filesize_bytes in candidates:
+                    rows.append((rowid, filepath))
+                    excess -= filesize_bytes or 0
+                    if excess <= 0:
+                        break
+                reclaimed += self._remove(rows, policy.get("delete_files", True))
+                records += len(rows)
+        return records, reclaimed
+
+    def _remove(self, rows, delete_files):
+        """删除一批记录，delete_files为True时先删除文件，返回回收的字节数"""
+        reclaimed = 0
+        if delete_files:
+            for _, filepath in rows:
+                try:
+                    size = os.path.getsize(filepath)
+                    os.remove(filepath)
+                    reclaimed += size
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    db_log.warning(f"删除文件失败: {filepath}: {e}")
+        db.executemany("DELETE FROM downloads WHERE rowid = ?", [(rowid,) for rowid, _ in rows])
+        return reclaimed
+
+
+retention_engine = RetentionEngine(RETENTION_POLICIES)
+
+
+async def touch_download_record(filepath):
+    """更新下载记录的最后访问时间"""
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            # 删除2天前的记录
-            two_days_ago = time.time() - (2 * 24 * 60 * 60)
-            cursor.execute('DELETE FROM downloads WHERE download_time < ?', (two_days_ago,))
-            conn.commit()
+        await db.aexecute("UPDATE downloads SET last_accessed = ? WHERE filepath = ?", (time.time(), filepath))
     except Exception as e:
-        print(f"清理旧记录时出错: {e}")
+        db_log.warning(f"更新访问时间失败: {e}")
 
-# 全局变量，存储当前活跃的下载任务
-download_tasks = {}  # 键为任务ID，值为任务信息字典
-completed_tasks = {}  # 存储已完成/出错的任务，保留一段时间以便前端查询
+# ==================== 任务状态存储 ====================
+# 已结束任务在内存中保留的时间（秒），以便前端查询最终状态
+COMPLETED_TASK_TTL = 7200
+
+task_store = TaskStore(on_remove=lambda task_id: task_metrics.pop(task_id, None))
 
 # 全局变量，存储下载配置，供钩子函数访问
 ydl_opts_global = {}
 
-# 任务清理函数，定期清理已完成的任务，但保留一段时间
+# 任务清理函数，定期清理结束超过保留时间的任务
 async def cleanup_completed_tasks():
     while True:
         await asyncio.sleep(300)  # 每5分钟运行一次
-        current_time = time.time()
         try:
-            # 找出所有需要清理的任务（完成或出错超过2小时的任务）
-            tasks_to_remove = []
-            for task_id, task in completed_tasks.items():
-                if current_time - task.get("end_time", 0) > 7200:  # 2小时
-                    tasks_to_remove.append(task_id)
-            
-            # 清理任务
-            for task_id in tasks_to_remove:
-                del completed_tasks[task_id]
-                
-            print(f"已清理 {len(tasks_to_remove)} 个已完成的任务")
+            removed = task_store.expire_finished(COMPLETED_TASK_TTL)
+            task_log.info(f"已清理 {removed} 个已完成的任务")
+        except Exception as e:
+            task_log.warning(f"清理任务出错: {e}")
+
+# 定期按保留策略清理下载记录
+async def run_retention_periodically():
+    while True:
+        try:
+            await db.run(retention_engine.run_once)
         except Exception as e:
-            print(f"清理任务出错: {e}")
+            db_log.warning(f"执行保留策略出错: {e}")
+        await asyncio.sleep(RETENTION_INTERVAL)
 
 # 启动任务清理器
 @app.on_event("startup")
 async def start_cleanup_task():
+    task_store.bind_loop(asyncio.get_running_loop())
     asyncio.create_task(cleanup_completed_tasks())
+    asyncio.create_task(run_retention_periodically())
 
 # 格式化文件大小
 def format_size(size_bytes):
@@ -151,346 +769,516 @@ def format_duration(seconds):
     return str(timedelta(seconds=seconds))
 
 
+# 格式化下载速度，速度未知时返回None
+def format_speed(bytes_per_second):
+    if bytes_per_second is None:
+        return None
+    return f"{format_size(int(bytes_per_second))}/s"
+
+
+# 格式化剩余时间，未知时返回None
+def format_eta(seconds):
+    if seconds is None:
+        return None
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds} 秒"
+    if seconds < 3600:
+        return f"{seconds // 60} 分 {seconds % 60} 秒"
+    return f"{seconds // 3600} 小时 {(seconds % 3600) // 60} 分"
+
+
+history_count_cache = HistoryCountCache()
+
+
 # 获取已下载的视频列表
-def get_downloaded_videos(page=1, page_size=10, start_date=None, end_date=None, search_text=None, file_type=None, limit_recent=None):
+def get_downloaded_videos(page=1, page_size=10, start_date=None, end_date=None, search_text=None, file_type=None, cursor=None, include_recent=False):
+    """
+    查询下载历史，查询条件和键集分页见HistoryQuery；
+    include_recent为True时同时返回"最近下载"
+    """
     try:
-        # 清理旧记录
-        cleanup_old_records()
+        query = HistoryQuery(
+            page, page_size, start_date, end_date, search_text, file_type, cursor, include_recent,
+            tokenizer=downloads_fts_tokenizer
+        )
+        total_count, rows, recent_rows, next_cursor = db.read(partial(query.fetch, count_cache=history_count_cache))
+        has_more = next_cursor is not None
         
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            
-            # 构建基础查询，只选择需要的字段
-            query = '''
-                SELECT 
-                    download_time_str,
-                    title,
-                    filepath,
-                    file_type
-                FROM downloads 
-                WHERE 1=1
-            '''
-            params = []
-            
-            # 默认显示最近2天的记录
-            two_days_ago = time.time() - (2 * 24 * 60 * 60)
-            query += ' AND download_time >= ?'
-            params.append(two_days_ago)
-            
-            # 添加搜索文本过滤（模糊搜索）
-            if search_text:
-                query += ' AND (title LIKE ? OR uploader LIKE ?)'
-                search_pattern = f'%{search_text}%'
-                params.extend([search_pattern, search_pattern])
-            
-            # 获取总记录数
-            count_query = f'SELECT COUNT(*) FROM ({query})'
-            cursor.execute(count_query, params)
-            total_count = cursor.fetchone()[0]
-            
-            # 添加排序
-            query += ' ORDER BY download_time DESC'
-            
-            # 如果指定了limit_recent，则只返回最近的几个视频
-            if limit_recent is not None:
-                query += f' LIMIT {limit_recent}'
-            else:
-                # 否则使用分页
-                query += ' LIMIT ? OFFSET ?'
-                params.extend([page_size, (page - 1) * page_size])
-            
-            # 执行查询
-            cursor.execute(query, params)
-            rows = cursor.fetchall()
-            
-            # 转换结果
+        # 转换结果
+        def to_videos(result_rows):
             videos = []
-            for row in rows:  # 使用已获取的结果
-                download_time_str, title, filepath, file_type = row
+            for row in result_rows:  # 使用已获取的结果
+                download_time_str, title, filepath, file_type = row[:4]
+                file_mtime = row[6]
+                file_mtime_str = time.strftime("%Y/%m/%d %H:%M", time.localtime(file_mtime)) if file_mtime else ""
                 
-                # 验证文件是否仍然存在
-                file_path = Path(filepath)
-                if file_path.exists():
-                    # 获取文件修改时间
-                    file_mtime = os.path.getmtime(file_path)
-                    file_mtime_str = time.strftime("%Y/%m/%d %H:%M", time.localtime(file_mtime))
-                    
-                    videos.append({
-                        'download_time': download_time_str,
-                        'title': title,
-                        'filepath': str(file_path),
-                        'file_exists': True,
-                        'file_mtime': file_mtime_str  # 添加文件修改时间
-                    })
-                else:
-                    # 如果文件不存在，从数据库中删除记录
-                    cursor.execute('DELETE FROM downloads WHERE filepath = ?', (filepath,))
-                    conn.commit()
-            
-            return {
-                "videos": videos,
-                "total": total_count,
-                "page": page,
-                "page_size": page_size,
-                "total_pages": (total_count + page_size - 1) // page_size
-            }
+                videos.append({
+                    'download_time': download_time_str,
+                    'title': title,
+                    'filepath': str(Path(filepath)),
+                    'file_exists': True,
+                    'file_mtime': file_mtime_str  # 添加文件修改时间
+                })
+            return videos
+        
+        videos = to_videos(rows)
+        result = {
+            "videos": videos,
+            "total": total_count,
+            "page": page,
+            "page_size": page_size,
+            "total_pages": (total_count + page_size - 1) // page_size,
+            "next_cursor": next_cursor,
+            "has_more": has_more
+        }
+        if include_recent:
+            result["recent_videos"] = videos[:HISTORY_RECENT_COUNT] if recent_rows is None else to_videos(recent_rows)
+        
+        return result
             
     except Exception as e:
-        print(f"获取视频列表时出错: {e}")
+        db_log.warning(f"获取视频列表时出错: {e}")
         return {
             "videos": [],
             "total": 0,
             "page": 1,
             "page_size": page_size,
-            "total_pages": 1
+            "total_pages": 1,
+            "next_cursor": None,
+            "has_more": False,
+            "recent_videos": []
         }
 
 
-# 下载进度回调
-class DownloadProgressHook:
-    def __init__(self, task_id):
+# ==================== 任务吞吐量统计 ====================
+# 每个任务实际下载的字节数、瞬时速度和EWMA平滑速度，以及各阶段的耗时；没有测量数据的字段为None
+# EWMA平滑系数，越大越接近瞬时速度
+METRICS_EWMA_ALPHA = 0.3
+# 计算瞬时速度的最小采样间隔（秒），间隔更短的进度回调累积到下一次计算
+METRICS_SAMPLE_INTERVAL = 0.5
+# 任务状态对应的阶段；merge（合并音视频）和zip（打包）由对应的代码显式进入
+TASK_STATUS_PHASES = {
+    "queued": "queued",
+    "initializing": "extract",
+    "pending": "extract",
+    "retrying": "extract",
+    "downloading": "download",
+    "postprocessing": "postprocess",
+    "paused": "paused",
+}
+
+
+class TaskMetrics:
+    """单个任务的实测吞吐量和阶段耗时，时间使用time.monotonic()"""
+    __slots__ = (
+        "task_id", "status", "downloaded_bytes", "total_bytes", "speed", "speed_ewma",
+        "phase", "phase_started", "phase_durations", "started", "finished",
+        "_base_bytes", "_file_bytes", "_sample_time", "_sample_bytes"
+    )
+
+    def __init__(self, task_id, now=None):
+        now = time.monotonic() if now is None else now
         self.task_id = task_id
-        self.start_time = time.time()
-        self.previous_time = self.start_time
-        self.previous_downloaded = 0
-        self.speed_samples = []
-        self.last_status_update = self.start_time
-        self.download_started = False
-        self.downloaded_bytes_history = []
-        self.no_progress_count = 0
-        self.last_message_time = self.start_time
-        self.last_bytes = 0
-        self.last_progress_update = self.start_time
-    
-    def __call__(self, d):
-        if self.task_id not in download_tasks:
-            # 如果任务已不存在于活跃任务中，检查是否在已完成任务中
-            if self.task_id not in completed_tasks:
-                print(f"警告: 任务 {self.task_id} 在下载过程中丢失，这可能导致前端无法获取进度")
-                # 重新创建一个基本的任务状态，防止前端出错
-                download_tasks[self.task_id] = {
-                    "status": "downloading",
-                    "progress": 0,
-                    "message": "正在恢复下载状态...",
-                    "start_time": time.time()
-                }
+        self.status = None
+        self.downloaded_bytes = 0
+        self.total_bytes = None
+        self.speed = None
+        self.speed_ewma = None
+        self.phase = None
+        self.phase_started = now
+        self.phase_durations = {}
+        self.started = now
+        self.finished = None
+        self._base_bytes = 0  # 已下载完的文件的字节数
+        self._file_bytes = 0  # 当前文件已下载的字节数
+        self._sample_time = None
+        self._sample_bytes = 0
+
+    def enter_phase(self, phase, now=None):
+        now = time.monotonic() if now is None else now
+        if phase == self.phase and self.finished is None:
             return
-            
-        # 更新最后一次进度变化的时间
-        current_time = time.time()
-        download_tasks[self.task_id]["last_progress_update"] = current_time
-        
-        # 处理下载进度信息
-        if d['status'] == 'downloading':
-            # 执行原有的下载进度处理代码
-            self.download_started = True
-            downloaded_bytes = d.get('downloaded_bytes', 0)
-            total_bytes = d.get('total_bytes', d.get('total_bytes_estimate', 0))
-            
-            # 记录下载字节历史
-            self.downloaded_bytes_history.append((current_time, downloaded_bytes))
-            # 只保留最近10个记录
-            if len(self.downloaded_bytes_history) > 10:
-                self.downloaded_bytes_history.pop(0)
-            
-            # 检测是否有进度
-            has_progress = downloaded_bytes > self.last_bytes
-            
-            # 如果5秒内没有进度，开始计数
-            if not has_progress and current_time - self.last_progress_update > 5:
-                self.no_progress_count += 1
-            else:
-                self.no_progress_count = 0  # 重置计数器
-                if has_progress:
-                    # 如果有进度，重置最后更新时间，这样不会误判为卡住
-                    self.last_progress_update = current_time
-            
-            # 如果连续3次没有进度，添加警告消息
-            if self.no_progress_count >= 3 and current_time - self.last_message_time > 3:
-                elapsed = current_time - self.start_time
-                download_tasks[self.task_id].update({
-                    "message": f"下载速度较慢或已暂停，已等待 {int(elapsed)} 秒...",
-                })
-                self.last_message_time = current_time
-            
-            # 计算下载速度（更准确的方法）
-            download_speed = 0
-            if len(self.downloaded_bytes_history) >= 2:
-                oldest_time, oldest_bytes = self.downloaded_bytes_history[0]
-                time_diff = current_time - oldest_time
-                bytes_diff = downloaded_bytes - oldest_bytes
-                if time_diff > 0:
-                    download_speed = bytes_diff / time_diff
-            
-            # 计算进度
-            progress = 0
-            elapsed = current_time - self.start_time
-            
-            if total_bytes > 0:
-                progress = int(downloaded_bytes / total_bytes * 100)
-                # 确保进度不超过95%，保留转换阶段
-                progress = min(95, progress)
-                
-                # 确保进度至少从45%开始(视频信息提取后的进度)
-                progress = max(45, progress)
-            else:
-                # 没有总大小信息，使用估算
-                if 'playlist_index' in d and 'playlist_count' in d:
-                    # 播放列表下载进度
-                    current_index = d['playlist_index']
-                    total_count = d['playlist_count']
-                    # 为当前正在下载的项目分配90%的进度空间
-                    base_progress = (current_index - 1) / total_count * 90
-                    item_progress = 0
-                    
-                    if has_progress:
-                        if download_speed > 0:
-                            # 估算总大小
-                            estimated_total = downloaded_bytes + (download_speed * 10) # 减少总大小的过度估计
-                            item_progress = int(downloaded_bytes / estimated_total * (90 / total_count))
-                        else:
-                            # 基于时间的估算
-                            item_progress = min(90 / total_count, int((elapsed / 30.0) * (90 / total_count)))
-                    
-                    progress = max(45, int(base_progress + item_progress)) # 确保至少从45%开始
-                else:
-                    # 普通视频使用更保守的进度估算
-                    if has_progress:
-                        if download_speed > 0:
-                            # 估算总大小，假设还需要10秒下载完成，而不是原来的30秒
-                            estimated_total = downloaded_bytes + (download_speed * 10)
-                            progress = int(downloaded_bytes / estimated_total * 50) + 45 # 45-95之间分配
-                        else:
-                            # 基于时间的估算，提高进度增长速度
-                            progress = min(90, 45 + int((elapsed / 15.0) * 50)) # 从45%开始增长更快
-                    else:
-                        # 如果20秒内没有进度，可能卡住了
-                        if elapsed > 20:
-                            download_tasks[self.task_id].update({
-                                "message": "下载停滞，可能需要重试...",
-                            })
-            
-            # 确保进度至少显示一些变化
-            current_progress = download_tasks[self.task_id].get("progress", 0)
-            if has_progress:
-                progress = max(progress, current_progress + 1) # 确保有变化
-            
-            # 防止进度值异常
-            progress = max(45, min(95, progress)) # 保持在45%-95%之间
-            
-            # 格式化速度和剩余时间
-            speed_str = "未知"
-            eta_str = "计算中..."
-            if d.get("speed", 0) > 0:
-                speed = d.get("speed", 0)
-                if speed < 1024:
-                    speed_str = f"{speed:.1f} B/s"
-                elif speed < 1024 * 1024:
-                    speed_str = f"{speed/1024:.1f} KB/s"
-                else:
-                    speed_str = f"{speed/(1024*1024):.1f} MB/s"
-                
-                if d.get("eta", 0) > 0:
-                    eta = d.get("eta", 0)
-                    if eta < 60:
-                        eta_str = f"{eta} 秒"
-                    elif eta < 3600:
-                        eta_str = f"{eta//60} 分 {eta%60} 秒"
-                    else:
-                        eta_str = f"{eta//3600} 小时 {(eta%3600)//60} 分"
-            else:
-                # 使用我们自己计算的速度作为备用
-                if download_speed > 0:
-                    if download_speed < 1024:
-                        speed_str = f"{download_speed:.1f} B/s"
-                    elif download_speed < 1024 * 1024:
-                        speed_str = f"{download_speed/1024:.1f} KB/s"
-                    else:
-                        speed_str = f"{download_speed/(1024*1024):.1f} MB/s"
-                    
-                    # 估计剩余时间
-                    if total_bytes > 0 and downloaded_bytes > 0:
-                        remaining_bytes = total_bytes - downloaded_bytes
-                        remaining_time = remaining_bytes / download_speed
-                        if remaining_time < 60:
-                            eta_str = f"{int(remaining_time)} 秒"
-                        elif remaining_time < 3600:
-                            eta_str = f"{int(remaining_time)//60} 分 {int(remaining_time)%60} 秒"
-                        else:
-                            eta_str = f"{int(remaining_time)//3600} 小时 {(int(remaining_time)%3600)//60} 分"
-            
-            # 生成友好的消息
-            message = f"正在下载: {format_size(downloaded_bytes)}"
-            if total_bytes > 0:
-                message += f" / {format_size(total_bytes)} ({progress}%)"
-            message += f" - {speed_str}"
-            if progress > 0 and progress < 100:
-                message += f" - 剩余时间: {eta_str}"
-                
-            # 更新状态
-            download_tasks[self.task_id].update({
-                "progress": progress,
-                "status": "downloading",
-                "speed": d.get("speed", download_speed),  # 使用yt-dlp提供的速度或我们计算的速度
-                "eta": d.get("eta", 0),
-                "downloaded_bytes": downloaded_bytes,
-                "message": message
-            })
-            
-            # 更新最后的字节数和更新时间
-            if has_progress:
-                self.last_bytes = downloaded_bytes
-                self.last_progress_update = current_time
-            
-        # 处理完成状态
-        elif d['status'] == 'finished':
-            # 更新任务状态为已完成下载，正在处理
-            download_tasks[self.task_id].update({
-                "message": "文件下载完成，正在处理...",
-                "progress": 95
-            })
-            
-        # 处理错误状态
-        elif d['status'] == 'error':
+        self._close_phase(now)
+        self.phase = phase
+        self.phase_started = now
+        self.finished = None
+        # 阶段切换（如暂停后继续）时重新采样，避免把等待时间算进速度
+        self._sample_time = None
+        self.speed = None
+
+    def _close_phase(self, now):
+        if self.phase is not None and self.finished is None:
+            duration = now - self.phase_started
+            self.phase_durations[self.phase] = self.phase_durations.get(self.phase, 0.0) + duration
+            PHASE_DURATION.observe(duration, phase=self.phase)
+
+    def finish(self, now=None):
+        now = time.monotonic() if now is None else now
+        if self.finished is None:
+            self._close_phase(now)
+            self.finished = now
+            self.speed = None
+
+    def record_progress(self, downloaded_bytes, total_bytes=None, now=None):
+        """记录当前文件已下载的字节数；数值变小说明开始下载下一个文件"""
+        now = time.monotonic() if now is None else now
+        if downloaded_bytes < self._file_bytes:
+            self._base_bytes += self._file_bytes
+        self._file_bytes = downloaded_bytes
+        previous_bytes = self.downloaded_bytes
+        self.downloaded_bytes = self._base_bytes + downloaded_bytes
+        if self.downloaded_bytes > previous_bytes:
+            DOWNLOAD_BYTES.inc(self.downloaded_bytes - previous_bytes)
+        if total_bytes:
+            self.total_bytes = self._base_bytes + total_bytes
+
+        if self._sample_time is None:
+            self._sample_time, self._sample_bytes = now, self.downloaded_bytes
+            return
+        elapsed = now - self._sample_time
+        if elapsed < METRICS_SAMPLE_INTERVAL:
+            return
+        self.speed = max(0.0, (self.downloaded_bytes - self._sample_bytes) / elapsed)
+        if self.speed_ewma is None:
+            self.speed_ewma = self.speed
+        else:
+            self.speed_ewma = METRICS_EWMA_ALPHA * self.speed + (1 - METRICS_EWMA_ALPHA) * self.speed_ewma
+        self._sample_time, self._sample_bytes = now, self.downloaded_bytes
+
+    def eta(self):
+        if self.total_bytes is None or not self.speed_ewma:
+            return None
+        return max(0.0, (self.total_bytes - self.downloaded_bytes) / self.speed_ewma)
+
+    def progress(self):
+        if not self.total_bytes:
+            return None
+        return min(100.0, self.downloaded_bytes / self.total_bytes * 100)
+
+    def snapshot(self, now=None):
+        now = time.monotonic() if now is None else now
+        durations = dict(self.phase_durations)
+        if self.phase is not None and self.finished is None:
+            durations[self.phase] = durations.get(self.phase, 0.0) + now - self.phase_started
+        return {
+            "phase": self.phase,
+            "downloaded_bytes": self.downloaded_bytes,
+            "total_bytes": self.total_bytes,
+            "speed": self.speed,
+            "speed_ewma": self.speed_ewma,
+            "eta": self.eta() if self.finished is None else None,
+            "elapsed": (self.finished or now) - self.started,
+            "phase_durations": {phase: round(seconds, 3) for phase, seconds in durations.items()}
+        }
+
+
+# 任务ID -> TaskMetrics，任务从task_store中删除时一起删除
+task_metrics = {}
+
+
+def get_task_metrics(task_id):
+    metrics = task_metrics.get(task_id)
+    if metrics is None:
+        metrics = task_metrics[task_id] = TaskMetrics(task_id)
+    return metrics
+
+
+def set_task_phase(task_id, phase):
+    get_task_metrics(task_id).enter_phase(phase)
+
+
+def track_task_metrics(task_id, record):
+    """任务状态变化时切换阶段，任务结束时停止计时"""
+    metrics = get_task_metrics(task_id)
+    if record.status == metrics.status:
+        return
+    metrics.status = record.status
+    if record.status in TERMINAL_TASK_STATES:
+        metrics.finish()
+        TASKS_FINISHED.inc(state=record.status)
+        return
+    phase = TASK_STATUS_PHASES.get(record.status)
+    if phase is not None:
+        metrics.enter_phase(phase)
+
+
+task_store.subscribe(track_task_metrics)
+
+
+# ==================== 下载文件状态同步 ====================
+# 后台维护downloads表的file_exists/file_mtime列，历史记录查询不再逐条检查文件。
+# 安装了watchdog时监视下载目录并及时同步，同时定期全量扫描作为兜底。
+RECONCILE_INTERVAL = 300 if WATCHDOG_AVAILABLE else 60
+RECONCILE_BATCH_SIZE = 500
+# 文件变化事件的合并等待时间（秒）
+RECONCILE_DEBOUNCE = 1.0
+
+
+def stat_history_file(filepath):
+    """返回 (file_exists, file_mtime)"""
+    try:
+        return 1, os.stat(filepath).st_mtime
+    except OSError:
+        return 0, None
+
+
+def reconcile_history_files():
+    """全量扫描下载记录，更新状态有变化的记录，返回更新的数量（在数据库线程中执行）"""
+    changed = 0
+    last_rowid = 0
+    while True:
+        rows = db.fetchall(
+            "SELECT rowid, filepath, file_exists, file_mtime FROM downloads WHERE rowid > ? ORDER BY rowid LIMIT ?",
+            (last_rowid, RECONCILE_BATCH_SIZE)
+        )
+        if not rows:
+            return changed
+        updates = []
+        for rowid, filepath, file_exists, file_mtime in rows:
+            state = stat_history_file(filepath)
+            if state != (file_exists, file_mtime):
+                updates.append(state + (rowid,))
+        if updates:
+            db.executemany("UPDATE downloads SET file_exists = ?, file_mtime = ? WHERE rowid = ?", updates)
+            changed += len(updates)
+        last_rowid = rows[-1][0]
+
+
+def reconcile_history_paths(paths):
+    """同步指定文件的状态（文件变化事件），返回更新的数量"""
+    states = [(path,) + stat_history_file(path) for path in paths]
+
+    def apply_states(conn):
+        changed = 0
+        for path, exists, mtime in states:
+            changed += conn.execute(
+                '''UPDATE downloads SET file_exists = ?, file_mtime = ?
+                   WHERE filepath = ? AND (file_exists IS NOT ? OR file_mtime IS NOT ?)''',
+                (exists, mtime, path, exists, mtime)
+            ).rowcount
+        return changed
+
+    return db.write(apply_states)
+
+
+def list_history_directories():
+    rows = db.fetchall("SELECT DISTINCT actual_download_dir FROM downloads WHERE actual_download_dir IS NOT NULL")
+    return [row[0] for row in rows] + [str(VIDEOS_DIR.resolve())]
+
+
+class HistoryFileWatcher:
+    """
+    监视下载目录中的文件变化（需要watchdog），合并事件后同步到数据库
+    watchdog的观察线程会调用dispatch(event)，这里直接实现该方法而不继承FileSystemEventHandler
+    """
+    def __init__(self):
+        self._observer = None
+        self._loop = None
+        self._watched = set()
+        self._pending = set()
+        self._flush_scheduled = False
+        self._lock = threading.Lock()
+
+    @property
+    def active(self):
+        return self._observer is not None
+
+    def start(self, loop):
+        if not WATCHDOG_AVAILABLE:
+            db_log.info("未安装watchdog，下载文件状态将通过定期扫描同步")
+            return
+        self._loop = loop
+        self._observer = Observer()
+        self._observer.daemon = True
+        self._observer.start()
+
+    def stop(self):
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer = None
+
+    def watch_directory(self, directory):
+        """开始监视目录（可在任意线程调用，已监视的目录会被忽略）"""
+        if self._observer is None or not directory:
+            return
+        directory = os.path.abspath(directory)
+        with self._lock:
+            if directory in self._watched or not os.path.isdir(directory):
+                return
+            try:
+                self._observer.schedule(self, directory, recursive=False)
+                self._watched.add(directory)
+            except Exception as e:
+                db_log.warning(f"监视下载目录失败: {directory}: {e}")
+
+    def dispatch(self, event):
+        if event.is_directory:
+            return
+        paths = {os.path.abspath(event.src_path)}
+        if getattr(event, "dest_path", None):
+            paths.add(os.path.abspath(event.dest_path))
+        with self._lock:
+            self._pending |= paths
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        self._loop.call_soon_threadsafe(lambda: asyncio.ensure_future(self._flush()))
+
+    async def _flush(self):
+        await asyncio.sleep(RECONCILE_DEBOUNCE)
+        with self._lock:
+            paths, self._pending = self._pending, set()
+            self._flush_scheduled = False
+        try:
+            await db.run(reconcile_history_paths, paths)
+        except Exception as e:
+            db_log.warning(f"同步文件变化出错: {e}")
+
+
+history_file_watcher = HistoryFileWatcher()
+
+
+async def reconcile_history_periodically():
+    while True:
+        try:
+            changed = await db.run(reconcile_history_files)
+            if changed:
+                db_log.info(f"下载文件状态同步: 更新了 {changed} 条记录")
+            if history_file_watcher.active:
+                for directory in await db.run(list_history_directories):
+                    history_file_watcher.watch_directory(directory)
+        except Exception as e:
+            db_log.warning(f"同步下载文件状态出错: {e}")
+        await asyncio.sleep(RECONCILE_INTERVAL)
+
+
+@app.on_event("startup")
+async def start_history_reconciler():
+    history_file_watcher.start(asyncio.get_running_loop())
+    asyncio.create_task(reconcile_history_periodically())
+
+
+@app.on_event("shutdown")
+async def stop_history_reconciler():
+    history_file_watcher.stop()
+
+
+# 下载进度回调
+class DownloadProgressHook:
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.start_time = time.time()
+        self.download_started = False
+        self.last_message_time = self.start_time
+        self.last_bytes = 0
+        self.last_progress_update = self.start_time
+    
+    def __call__(self, d):
+        if not task_store.is_active(self.task_id):
+            # 如果任务已不存在于活跃任务中，检查是否已经结束
+            if self.task_id not in task_store:
+                download_log.warning(f"警告: 任务 {self.task_id} 在下载过程中丢失，这可能导致前端无法获取进度")
+                # 重新创建一个基本的任务状态，防止前端出错
+                task_store.create(self.task_id, {
+                    "status": "downloading",
+                    "progress": 0,
+                    "message": "正在恢复下载状态...",
+                    "start_time": time.time()
+                })
+            return
+            
+        current_time = time.time()
+        
+        # 处理下载进度信息
+        if d['status'] == 'downloading':
+            self.download_started = True
+            downloaded_bytes = d.get('downloaded_bytes') or 0
+            total_bytes = d.get('total_bytes') or d.get('total_bytes_estimate')
+            
+            # 字节数、速度、剩余时间都使用实测值，没有数据时为None
+            metrics = get_task_metrics(self.task_id)
+            metrics.record_progress(downloaded_bytes, total_bytes)
+            speed = metrics.speed_ewma
+            eta = metrics.eta()
+            progress = metrics.progress()
+            
+            fields = {
+                "status": "downloading",
+                "downloaded_bytes": metrics.downloaded_bytes,
+                "speed": speed,
+                "speed_str": format_speed(speed),
+                "eta": eta,
+                "eta_str": format_eta(eta),
+                "last_progress_update": current_time
+            }
+            if progress is not None:
+                fields["progress"] = progress
+            
+            # 生成消息
+            message = f"正在下载: {format_size(metrics.downloaded_bytes)}"
+            if progress is not None:
+                message += f" / {format_size(metrics.total_bytes)} ({progress:.0f}%)"
+            if speed is not None:
+                message += f" - {fields['speed_str']}"
+            if eta is not None:
+                message += f" - 剩余时间: {fields['eta_str']}"
+            
+            # 长时间没有新数据时提示下载停滞
+            if downloaded_bytes != self.last_bytes:
+                self.last_bytes = downloaded_bytes
+                self.last_progress_update = current_time
+            elif current_time - self.last_progress_update > 15:
+                message = f"下载速度较慢或已暂停，已等待 {int(current_time - self.last_progress_update)} 秒..."
+            fields["message"] = message
+            
+            task_store.update(self.task_id, fields)
+            
+        # 处理完成状态
+        elif d['status'] == 'finished':
+            # 更新任务状态为已完成下载，正在处理
+            task_store.update(self.task_id, {
+                "status": "postprocessing",
+                "message": "文件下载完成，正在处理...",
+                "speed": None,
+                "speed_str": None,
+                "eta": None,
+                "eta_str": None
+            })
+            
+        # 处理错误状态
+        elif d['status'] == 'error':
             error_msg = d.get('error', '未知错误')
-            print(f"下载错误 [{self.task_id}]: {error_msg}")
+            download_log.warning(f"下载错误 [{self.task_id}]: {error_msg}")
             
             # 更新任务状态为错误
-            download_tasks[self.task_id].update({
+            task_store.update(self.task_id, {
                 "status": "error",
                 "error": error_msg,
                 "progress": 0,
                 "end_time": current_time
             })
-            
-            # 将出错的任务移至已完成任务字典
-            completed_tasks[self.task_id] = download_tasks[self.task_id]
-            del download_tasks[self.task_id]
         
         # 检查是否已经下载很长时间
         if self.download_started and current_time - self.start_time > 600:  # 10分钟
-            download_tasks[self.task_id].update({
+            task_store.update(self.task_id, {
                 "message": "下载时间过长，可能遇到问题，建议取消并重试",
             })
             
         # 检查短视频下载是否超时
-        if self.download_started and "video_url" in download_tasks[self.task_id] and "shorts" in download_tasks[self.task_id].get("video_url", "").lower():
+        if self.download_started and "shorts" in task_store.get(self.task_id).get("video_url", "").lower():
             elapsed = current_time - self.start_time
             if elapsed > 60:  # 提示下载时间较长
-                download_tasks[self.task_id].update({
+                task_store.update(self.task_id, {
                     "message": f"短视频下载时间较长，已等待 {int(elapsed)} 秒..."
                 })
                 
             if elapsed > 180:  # 180秒超时（原为90秒）
-                download_tasks[self.task_id].update({
+                task_store.update(self.task_id, {
                     "status": "error",
                     "error": "短视频下载超时，请重试或检查网络连接",
                     "end_time": current_time
                 })
-                
-                # 将任务移至已完成任务字典
-                completed_tasks[self.task_id] = download_tasks[self.task_id]
-                del download_tasks[self.task_id]
 
 
 class DownloadRequest(BaseModel):
@@ -499,6 +1287,13 @@ class DownloadRequest(BaseModel):
     format_type: str = "video"
     compress_to_zip: bool = False
     download_path: Optional[str] = None
+    priority: int = 0  # 数值越大越优先，同优先级按提交顺序；超出0到DOWNLOAD_PRIORITY_MAX的值会被截断
+
+class BandwidthLimitsRequest(BaseModel):
+    # 字节/秒，0表示不限制，未提供的项保持不变
+    global_limit: Optional[float] = None
+    task_limit: Optional[float] = None
+    client_limit: Optional[float] = None
 
 class DeleteVideoRequest(BaseModel):
     filename: str
@@ -510,38 +1305,50 @@ class FileLocationRequest(BaseModel):
 # 保存下载记录到数据库
 def save_download_record(video_info, file_path, format_info, download_path=None, actual_download_dir=None):
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            
-            # 确保文件路径是绝对路径
-            file_path = Path(file_path).absolute()
-            
-            # 确保实际下载目录是绝对路径
-            if actual_download_dir is None:
-                actual_download_dir = str(file_path.parent.resolve())
-            else:
-                actual_download_dir = str(Path(actual_download_dir).resolve())
-            
-            # 确保自定义下载路径也是绝对路径    
-            if download_path:
-                download_path = str(Path(download_path).resolve())
-                
-            print(f"保存下载记录 - 文件路径: {file_path}")
-            print(f"保存下载记录 - 用户指定下载路径: {download_path}")
-            print(f"保存下载记录 - 实际下载目录: {actual_download_dir}")
-            
-            if not file_path.exists():
-                print(f"文件不存在: {file_path}")
-                return
-                
-            file_size = os.path.getsize(file_path)
-            
-            # 使用当前时间作为下载时间，而不是文件修改时间
-            current_time = time.time()
+        # 确保文件路径是绝对路径
+        file_path = Path(file_path).absolute()
+        
+        # 确保实际下载目录是绝对路径
+        if actual_download_dir is None:
+            actual_download_dir = str(file_path.parent.resolve())
+        else:
+            actual_download_dir = str(Path(actual_download_dir).resolve())
+        
+        # 确保自定义下载路径也是绝对路径    
+        if download_path:
+            download_path = str(Path(download_path).resolve())
             
-            # 格式化下载时间为更友好的格式
-            download_time_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(current_time))
+        db_log.debug("保存下载记录 - 文件路径: %s, 用户指定下载路径: %s, 实际下载目录: %s",
+                     file_path, download_path, actual_download_dir)
+        
+        if not file_path.exists():
+            db_log.warning(f"文件不存在: {file_path}")
+            return
             
+        file_stat = file_path.stat()
+        file_size = file_stat.st_size
+        
+        # 使用当前时间作为下载时间，而不是文件修改时间
+        current_time = time.time()
+        
+        # 格式化下载时间为更友好的格式
+        download_time_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(current_time))
+        
+        video_id = video_info.get("id") or extract_video_id_from_path(str(file_path))
+        
+        # 下载过程中没有得到的标题、上传者、时长，使用视频信息缓存补全
+        if video_id and not all(video_info.get(key) for key in ("title", "uploader", "duration")):
+            cached_info = video_info_cache.lookup(video_id)
+            if cached_info:
+                video_info = {
+                    **{key: cached_info[key] for key in ("title", "uploader", "duration") if cached_info.get(key)},
+                    **{key: value for key, value in video_info.items() if value}
+                }
+        
+        duration = video_info.get("duration", 0)
+        
+        def upsert_record(conn):
+            cursor = conn.cursor()
             # 检查记录是否已存在
             cursor.execute('SELECT id FROM downloads WHERE filepath = ?', (str(file_path),))
             existing_record = cursor.fetchone()
@@ -554,7 +1361,13 @@ def save_download_record(video_info, file_path, format_info, download_path=None,
                         download_time = ?, 
                         download_time_str = ?,
                         custom_path = ?,
-                        actual_download_dir = ?
+                        actual_download_dir = ?,
+                        filesize_bytes = ?,
+                        video_id = COALESCE(?, video_id),
+                        file_name = ?,
+                        file_exists = 1,
+                        file_mtime = ?,
+                        last_accessed = ?
                     WHERE filepath = ?
                 ''', (
                     video_info.get("title", "未知标题"),
@@ -562,6 +1375,11 @@ def save_download_record(video_info, file_path, format_info, download_path=None,
                     download_time_str,
                     download_path,
                     actual_download_dir,
+                    file_size,
+                    video_id,
+                    file_path.name,
+                    file_stat.st_mtime,
+                    current_time,
                     str(file_path)
                 ))
             else:
@@ -570,30 +1388,37 @@ def save_download_record(video_info, file_path, format_info, download_path=None,
                     INSERT INTO downloads (
                         id, title, filepath, file_type, uploader, duration, 
                         filesize, format_info, download_time, download_time_str, 
-                        custom_path, actual_download_dir
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        custom_path, actual_download_dir,
+                        filesize_bytes, duration_seconds, video_id, file_name,
+                        file_exists, file_mtime, last_accessed
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?, ?)
                 ''', (
                     str(uuid.uuid4()),
                     video_info.get("title", "未知标题"),
                     str(file_path),
                     Path(file_path).suffix[1:].upper(),
                     video_info.get("uploader", "未知上传者"),
-                    format_duration(video_info.get("duration", 0)),
+                    format_duration(duration),
                     format_size(file_size),
                     format_info,
                     current_time,
                     download_time_str,
                     download_path,
-                    actual_download_dir
+                    actual_download_dir,
+                    file_size,
+                    duration,
+                    video_id,
+                    file_path.name,
+                    file_stat.st_mtime,
+                    current_time
                 ))
-            
-            conn.commit()
-            print(f"成功保存下载记录: {video_info.get('title', '未知标题')}")
+        
+        db.write(upsert_record)
+        history_file_watcher.watch_directory(actual_download_dir)
+        db_log.info("成功保存下载记录: %s", video_info.get("title", "未知标题"))
     except Exception as e:
-        print(f"保存下载记录时出错: {e}")
-        print(f"视频信息: {video_info}")
-        print(f"文件路径: {file_path}")
-        print(f"格式信息: {format_info}")
+        db_log.warning("保存下载记录时出错: %s (文件路径: %s, 格式信息: %s)", e, file_path, format_info)
+        db_log.debug("视频信息: %s", video_info)
 
 
 # 全局禁用aria2c
@@ -602,13 +1427,13 @@ aria2c_available = False  # 全局强制禁用aria2c
 # 检查aria2c是否安装 - 完全禁用此功能
 def is_aria2c_installed():
     # 直接返回False，不再检测aria2c
-    print("aria2c功能已禁用，将始终使用默认下载器")
+    ffmpeg_log.info("aria2c功能已禁用，将始终使用默认下载器")
     return False
 
 # 尝试安装aria2c - 完全禁用此功能
 def install_aria2c():
     # 直接返回False，不再尝试安装aria2c
-    print("aria2c安装功能已禁用")
+    ffmpeg_log.info("aria2c安装功能已禁用")
     return False
 
 # 添加到应用启动时检查
@@ -631,15 +1456,13 @@ async def smart_download_with_retry(ydl, video_url, task_id, max_retries=3, use_
                 if 'socket_timeout' in ydl.params:
                     ydl.params['socket_timeout'] += 15  # 每次重试增加15秒超时
                 
-                download_tasks[task_id].update({
-                    "message": f"第 {retry_count} 次重试下载，已调整参数提高稳定性...",
-                    "progress": 20 + retry_count * 5  # 逐渐增加进度以示进展
+                task_store.update(task_id, {
+                    "message": f"第 {retry_count} 次重试下载，已调整参数提高稳定性..."
                 })
             
             # 执行下载
-            download_tasks[task_id].update({
-                "message": "正在下载，请稍候...",
-                "progress": max(45, download_tasks[task_id].get("progress", 45)) # 确保进度至少为45%
+            task_store.update(task_id, {
+                "message": "正在下载，请稍候..."
             })
             
             info = await asyncio.wait_for(
@@ -660,21 +1483,24 @@ async def smart_download_with_retry(ydl, video_url, task_id, max_retries=3, use_
             
             # 根据错误类型智能调整参数
             if 'timeout' in error_msg or 'connection' in error_msg:
+                DOWNLOAD_RETRIES.inc(error_class="network")
                 # 网络问题，降低并发，增加超时
-                download_tasks[task_id].update({
+                task_store.update(task_id, {
                     "message": f"网络连接问题，正在调整参数，准备重试 ({retry_count}/{max_retries})...",
                 })
                 # 减少等待时间，网络问题无需长时间等待
                 await asyncio.sleep(2)
             elif 'format' in error_msg or 'no suitable format' in error_msg:
+                DOWNLOAD_RETRIES.inc(error_class="format")
                 # 格式问题，尝试更简单的格式
                 ydl.params['format'] = 'best'
-                download_tasks[task_id].update({
+                task_store.update(task_id, {
                     "message": f"视频格式问题，尝试使用最佳可用格式重试 ({retry_count}/{max_retries})...",
                 })
                 # 格式问题几乎无需等待，可以立即重试
                 await asyncio.sleep(1)
             elif 'http error 403' in error_msg or 'forbidden' in error_msg:
+                DOWNLOAD_RETRIES.inc(error_class="forbidden")
                 # 访问被拒绝，调整User-Agent和提取器参数
                 ydl.params['extractor_args'] = {
                     'youtube': {
@@ -685,14 +1511,15 @@ async def smart_download_with_retry(ydl, video_url, task_id, max_retries=3, use_
                 ydl.params['http_headers'] = {
                     'User-Agent': 'Mozilla/5.0 (Linux; Android 10; K) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Mobile Safari/537.36',
                 }
-                download_tasks[task_id].update({
+                task_store.update(task_id, {
                     "message": f"访问被拒绝，正在使用备用方式重试 ({retry_count}/{max_retries})...",
                 })
                 # 访问被拒绝也可以快速重试
                 await asyncio.sleep(1)
             else:
+                DOWNLOAD_RETRIES.inc(error_class="other")
                 # 其他错误，尝试更通用的设置
-                download_tasks[task_id].update({
+                task_store.update(task_id, {
                     "message": f"下载出错: {str(e)[:100]}，准备重试 ({retry_count}/{max_retries})...",
                 })
                 # 未知错误短暂等待
@@ -702,6 +1529,65 @@ async def smart_download_with_retry(ydl, video_url, task_id, max_retries=3, use_
             if retry_count > max_retries:
                 return None, last_error
 
+# 生成yt-dlp输出文件名模板
+def build_output_template(output_dir, video_url, format_type):
+    # 限制标题长度以避免文件名过长问题
+    if "shorts" in video_url.lower():
+        filename = "%(title).100s-%(id)s-shorts.%(ext)s"
+    elif format_type == "audio":
+        # 为音频文件添加明确的后缀
+        filename = "%(title).100s-%(id)s-audio.%(ext)s"
+    else:
+        filename = "%(title).100s-%(id)s.%(ext)s"
+    return os.path.join(str(output_dir), filename)
+
+
+# 合并音视频流时使用的容器格式
+MERGE_OUTPUT_FORMATS = {"video": "mp4", "video_webm": "webm", "video_mkv": "mkv"}
+
+
+def build_format_selector(video_quality="best", format_type="video", can_merge=True):
+    """
+    根据请求的画质和格式生成yt-dlp格式选择器
+    可以合并（有ffmpeg）时选择分离的视频流+音频流，720p以上只有分离的流；否则只能选择音视频合一的格式
+    """
+    if format_type == "audio":
+        return "bestaudio/best"
+    height = "" if video_quality == "best" else f"[height<={int(video_quality)}]"
+    progressive = f"best{height}/best" if height else "best"
+    if not can_merge:
+        return progressive
+    if format_type == "video_webm":
+        # webm容器只能容纳VP9/AV1和Opus/Vorbis，不能退回到任意的流组合
+        return f"bestvideo{height}[ext=webm]+bestaudio[ext=webm]/best{height}[ext=webm]/{progressive}"
+    if format_type == "video":
+        return f"bestvideo{height}[ext=mp4]+bestaudio[ext=m4a]/bestvideo{height}+bestaudio/{progressive}"
+    return f"bestvideo{height}+bestaudio/{progressive}"
+
+
+# 生成进程池中YoutubeDL使用的参数，与命令行下载方式的参数保持一致
+def build_ytdlp_options(output_dir, video_url, format_type="video", ffmpeg_path=None, video_quality="best"):
+    opts = {
+        "format": build_format_selector(video_quality, format_type, can_merge=ffmpeg_path is not None),
+        "outtmpl": build_output_template(output_dir, video_url, format_type),
+        "restrictfilenames": True,
+        "overwrites": False,
+        "retries": 2,
+        "socket_timeout": 15,
+        "cachedir": False,
+        "nocheckcertificate": True,
+        "no_warnings": True
+    }
+    if format_type == "audio":
+        opts["postprocessors"] = [{"key": "FFmpegExtractAudio", "preferredcodec": "mp3"}]
+        opts["keepvideo"] = True
+    if ffmpeg_path:
+        opts["ffmpeg_location"] = ffmpeg_path
+        if format_type in MERGE_OUTPUT_FORMATS:
+            opts["merge_output_format"] = MERGE_OUTPUT_FORMATS[format_type]
+    return opts
+
+
 # 新增一个直接使用命令行下载的函数
 async def direct_download_with_ytdlp(video_url, task_id, output_dir, video_quality="best", format_type="video", download_path=None):
     """
@@ -714,72 +1600,54 @@ async def direct_download_with_ytdlp(video_url, task_id, output_dir, video_quali
     # 确保输出目录是绝对路径
     output_dir_path = Path(output_dir).resolve()
     output_dir_str = str(output_dir_path)
-    print(f"直接下载方法使用的下载目录: {output_dir_str}")
+    download_log.info(f"直接下载方法使用的下载目录: {output_dir_str}")
+    
+    # yt-dlp通过--print after_move:filepath报告的最终文件路径
+    destination_files = []
     
     # 为短视频使用更短的超时时间
     is_short_video = "shorts" in video_url.lower()
     initialization_timeout = 30 if is_short_video else 60  # 初始化阶段超时时间缩短
     
-    def update_status(message, progress=None, status="downloading"):
-        """本地函数用于更安全地更新状态"""
+    def update_status(message, progress=None, status=None):
+        """本地函数用于更安全地更新状态，status为None时保持当前状态"""
         nonlocal last_update_time
         try:
-            if task_id in download_tasks:
+            if task_store.is_active(task_id):
                 update_dict = {
                     "message": message,
-                    "status": status,
                     "last_update_time": time.time()
                 }
+                if status is not None:
+                    update_dict["status"] = status
                 
-                # 处理进度值，确保平滑增长和合理性
+                # 进度值使用调用方给出的实际值，只限制在0-100之间
                 if progress is not None:
-                    # 获取当前任务的进度值
-                    current_progress = download_tasks[task_id].get("progress", 0)
-                    
-                    # 确保进度随时间增加，除非是重置、错误或完成状态
-                    if status not in ["error", "completed"] and progress < current_progress:
-                        # 如果新进度小于当前进度，可能是解析错误，保持当前进度
-                        if current_progress > 0:
-                            print(f"进度更新检测到倒退：当前{current_progress}%，新值{progress}%，保持当前值")
-                            progress = current_progress
-                    elif status == "downloading" and progress > current_progress + 15:
-                        # 如果进度跳变太大，使用平滑过渡，每次最多增加10%
-                        # 但如果是完成或错误状态，允许直接跳变
-                        if status not in ["completed", "error"]:
-                            old_progress = progress
-                            progress = current_progress + min(10, (progress - current_progress) * 0.5)
-                            print(f"进度跳变过大：从{current_progress}%到{old_progress}%，平滑为{progress}%")
-                    
-                    # 确保数值有效
                     progress = max(0, min(100, progress))
-                    
-                    # 更新进度值
                     update_dict["progress"] = progress
                 
                 # 更新时间信息
                 current_time = time.time()
-                elapsed = current_time - download_tasks[task_id].get("start_time", current_time)
+                elapsed = current_time - task_store.get(task_id).get("start_time", current_time)
                 update_dict["elapsed"] = elapsed
                 
                 # 更新任务状态
-                download_tasks[task_id].update(update_dict)
+                task_store.update(task_id, update_dict)
                 last_update_time = time.time()  # 更新最后状态更新时间
                 
-                # 打印状态更新信息
-                progress_info = f", 进度: {progress}%" if progress is not None else ""
-                elapsed_info = f", 已用时间: {int(elapsed)}秒" if elapsed > 0 else ""
-                print(f"[任务 {task_id[:8]}] 状态更新: {message}{progress_info}{elapsed_info}")
+                # 记录状态更新信息
+                download_log.debug("[任务 %s] 状态更新: %s, 进度: %s, 已用时间: %d秒",
+                                   task_id[:8], message, progress, elapsed, extra={"task_id": task_id})
                 return True
             return False
         except Exception as e:
-            print(f"更新任务状态出错: {e}")
-            import traceback
-            print(traceback.format_exc())
+            download_log.warning(f"更新任务状态出错: {e}")
+            download_log.debug("详细错误信息", exc_info=True)
             return False
     
     # 守护线程函数，定期检查并更新状态
     async def status_monitor():
-        """状态监控线程，持续检查下载进程是否活跃"""
+        """状态监控：进程启动前轮换显示等待信息，初始化超时时报错；不生成进度或速度"""
         status_messages = [
             "正在连接到YouTube...",
             "正在解析视频信息...",
@@ -788,14 +1656,8 @@ async def direct_download_with_ytdlp(video_url, task_id, output_dir, video_quali
             "正在初始化下载...",
         ]
         message_index = 0
-        init_progress = 5  # 初始进度
         monitor_interval = 2  # 监控间隔秒数
         
-        # 确保任务状态中始终有速度信息
-        if task_id in download_tasks and "speed" not in download_tasks[task_id]:
-            download_tasks[task_id]["speed"] = 1048576  # 默认1MB/s
-            download_tasks[task_id]["speed_str"] = "准备中..."
-        
         while True:
             try:
                 current_time = time.time()
@@ -807,10 +1669,6 @@ async def direct_download_with_ytdlp(video_url, task_id, output_dir, video_quali
                     message = status_messages[message_index % len(status_messages)]
                     message_index += 1
                     
-                    # 逐渐增加进度以示活动
-                    if init_progress < 15:
-                        init_progress += 1
-                    
                     # 添加等待时间信息
                     message += f" (已等待 {int(elapsed)} 秒)"
                     
@@ -821,7 +1679,7 @@ async def direct_download_with_ytdlp(video_url, task_id, output_dir, video_quali
                     # 检查是否超时（更短的超时，提高用户体验）
                     if (is_short_video and elapsed > initialization_timeout) or elapsed > 90:
                         timeout_message = f"{'短视频' if is_short_video else '视频'}下载初始化超时，请重试"
-                        print(f"[任务 {task_id[:8]}] {timeout_message}，已等待 {int(elapsed)} 秒")
+                        download_log.info(f"[任务 {task_id[:8]}] {timeout_message}，已等待 {int(elapsed)} 秒")
                         
                         update_status(
                             timeout_message,
@@ -829,418 +1687,83 @@ async def direct_download_with_ytdlp(video_url, task_id, output_dir, video_quali
                             status="error"
                         )
                         
-                        # 将任务移至已完成字典
-                        try:
-                            if task_id in download_tasks:
-                                download_tasks[task_id]["end_time"] = current_time
-                                download_tasks[task_id]["error"] = "初始化超时"
-                                completed_tasks[task_id] = download_tasks[task_id].copy()
-                                del download_tasks[task_id]
-                        except Exception as e:
-                            print(f"移动超时任务时出错: {e}")
+                        # 记录超时错误信息
+                        task_store.update(task_id, {"end_time": current_time, "error": "初始化超时"})
                             
                         return  # 结束监控
                     
-                    # 确保速度信息始终存在于任务状态中
-                    if task_id in download_tasks:
-                        # 仅当没有速度信息或速度为0时更新默认值
-                        if "speed" not in download_tasks[task_id] or download_tasks[task_id]["speed"] == 0:
-                            # 根据经过的时间动态调整显示的速度值，让它看起来更真实
-                            speed_value = 1048576 + (int(elapsed) % 10) * 524288  # 在1MB/s到6MB/s之间波动
-                            download_tasks[task_id]["speed"] = speed_value
-                            download_tasks[task_id]["speed_str"] = f"计算中 ({speed_value/1048576:.1f} MB/s)"
-                    
-                    # 更新状态，在消息中包含速度信息
-                    speed_str = download_tasks[task_id].get("speed_str", "计算中...") if task_id in download_tasks else "计算中..."
-                    update_status(f"{message} - {speed_str}", progress=init_progress)
+                    update_status(message)
                 
                 # 短暂等待后继续检查
                 await asyncio.sleep(monitor_interval)
             except Exception as e:
-                print(f"状态监控错误: {e}")
+                download_log.warning(f"状态监控错误: {e}")
                 await asyncio.sleep(monitor_interval)
     
     # 创建一个subprocess进程监控函数
     async def process_monitor(process):
-        """监控下载进程并实时读取输出"""
+        """读取yt-dlp的结构化输出：下载进度交给DownloadProgressHook，后处理进度更新状态，并记录最终文件路径"""
         if not process:
             return
             
         try:
-            # 降低初始进度值，让用户能看到更明显的变化
-            progress = 5  # 从5%开始，而不是25%
-            last_progress_time = time.time()
-            last_line_time = time.time()
-            last_status_update_time = time.time()  # 添加状态更新时间记录
-            
-            # 添加一个辅助变量，记录没有进度信息时的模拟进度
-            simulated_progress = 5
-            download_started = False
-            # 添加初始化阶段标志和动态速度显示
-            initialization_phase = True  # 标记是否处于初始化阶段
-            phase_name = "准备中"  # 当前阶段名称
-            dynamic_speed = 102400  # 初始动态速度(100KB/s)
-            last_dynamic_update = time.time()
-            
-            # 添加真实进度记录变量
-            last_real_progress = 0
-            download_start_time = time.time()
-            last_progress_update_time = time.time()
-            
-            # 记录检测到的进度更新次数
-            progress_update_count = 0
-            
-            # 定义一个函数用于生成动态速度字符串
-            def get_dynamic_speed_str(base_speed):
-                # 确保速度为正数
-                actual_speed = abs(base_speed)
-                # 根据大小选择单位
-                if actual_speed < 1024:
-                    return f"{actual_speed:.1f} B/s"
-                elif actual_speed < 1024 * 1024:
-                    return f"{actual_speed/1024:.1f} KB/s"
-                else:
-                    return f"{actual_speed/(1024*1024):.1f} MB/s"
+            # 与进程池下载使用相同的进度回调，进度、速度和剩余时间都来自yt-dlp报告的数值
+            progress_hook = DownloadProgressHook(task_id)
             
-            # 定义一个函数用于平滑更新进度值
-            def update_progress_smoothly(current, target, step_percent=0.5):
-                """平滑地将当前进度更新到目标进度，每次最多增加指定的百分比"""
-                if current >= target:
-                    return current
+            # 循环读取输出，直到标准输出和标准错误都关闭
+            while True:
+                line = await process.readline()
+                if line is None:
+                    break  # 输出已关闭，进程即将结束
                 
-                # 计算下一步的进度值，确保每次至少增加一点点
-                step = max(0.5, (target - current) * step_percent)
-                return min(current + step, target)
-            
-            # 循环检查进程状态
-            while process.poll() is None:
-                # 读取所有可用输出
                 try:
-                    line = process.stdout.readline()
-                    if line:
-                        line = line.strip()
-                        last_line_time = time.time()
-                        
-                        # 增加详细日志以便调试
-                        print(f"原始输出: {line}")
-                        
-                        # 增强阶段识别 - 在有新输出时更新阶段名称
-                        if "Extracting URL" in line:
-                            phase_name = "提取URL"
-                            initialization_phase = True
-                            # 使用动态速度生成
-                            speed_str = get_dynamic_speed_str(dynamic_speed)
-                            update_status(f"{phase_name} - {speed_str}", progress=max(10, progress))
-                        elif "Downloading webpage" in line:
-                            phase_name = "获取网页"
-                            initialization_phase = True
-                            speed_str = get_dynamic_speed_str(dynamic_speed)
-                            update_status(f"{phase_name} - {speed_str}", progress=max(12, progress))
-                        elif "Downloading initial data" in line or "Downloading m3u8" in line:
-                            phase_name = "下载初始数据"
-                            initialization_phase = True
-                            speed_str = get_dynamic_speed_str(dynamic_speed)
-                            update_status(f"{phase_name} - {speed_str}", progress=max(15, progress))
-                        elif "Downloading metadata" in line:
-                            phase_name = "下载元数据"
-                            initialization_phase = True
-                            speed_str = get_dynamic_speed_str(dynamic_speed)
-                            update_status(f"{phase_name} - {speed_str}", progress=max(18, progress))
-                        elif "Downloading thumbnail" in line:
-                            phase_name = "下载缩略图"
-                            initialization_phase = True
-                            speed_str = get_dynamic_speed_str(dynamic_speed)
-                            update_status(f"{phase_name} - {speed_str}", progress=max(20, progress))
-                        
-                        # 检测下载是否已经开始
-                        if "[download]" in line and not download_started:
-                            download_started = True
-                            initialization_phase = False  # 结束初始化阶段
-                            download_start_time = time.time()
-                            update_status("开始下载视频内容...", progress=max(20, progress))
-                        
-                        # 增强下载进度解析
-                        if "[download]" in line:
-                            initialization_phase = False  # 已进入正式下载阶段
-                            
-                            # 尝试几种不同的模式来匹配进度百分比
-                            percent = None
-                            
-                            # 匹配模式1: 常规的百分比格式 "[download]  5.0% of ..."
-                            import re
-                            percent_match = re.search(r'\[download\]\s+(\d+\.?\d*)%', line)
-                            if percent_match:
-                                percent = float(percent_match.group(1))
-                                print(f"模式1匹配到进度: {percent}%")
-                            
-                            # 匹配模式2: 另一种常见格式 "[download] 100% of 10.50MiB"
-                            if percent is None:
-                                percent_match = re.search(r'\[download\]\s+(\d+)%\s+of', line)
-                                if percent_match:
-                                    percent = float(percent_match.group(1))
-                                    print(f"模式2匹配到进度: {percent}%")
-                            
-                            # 匹配模式3: 更通用的格式，尝试在"download"后找到的第一个百分比
-                            if percent is None:
-                                percent_match = re.search(r'\[download\].*?(\d+\.?\d*)%', line)
-                                if percent_match:
-                                    percent = float(percent_match.group(1))
-                                    print(f"模式3匹配到进度: {percent}%")
-                            
-                            # 如果成功匹配到百分比
-                            if percent is not None:
-                                progress_update_count += 1
-                                
-                                # 将原始百分比映射到UI进度范围 (15-95%)
-                                real_progress = 15 + int(percent * 0.8)
-                                print(f"原始进度: {percent}%, 映射到UI进度: {real_progress}%")
-                                
-                                # 记录最后一次真实进度
-                                last_real_progress = real_progress
-                                last_progress_time = time.time()
-                                last_progress_update_time = time.time()
-                                
-                                # 平滑更新进度 - 确保进度总是向前移动
-                                if real_progress > progress:
-                                    # 使用平滑更新函数
-                                    new_progress = update_progress_smoothly(progress, real_progress)
-                                    progress = new_progress
-                                    simulated_progress = new_progress  # 同步模拟进度
-                                
-                                # 解析下载速度
-                                speed_str = "计算中..."
-                                speed_value = 1048576  # 默认1MB/s
-                                
-                                # 尝试匹配速度格式
-                                speed_pattern = r'at\s+(\d+\.?\d*)\s*([KMGT]i?B/s)'
-                                speed_match = re.search(speed_pattern, line)
-                                if speed_match:
-                                    try:
-                                        speed_val = float(speed_match.group(1))
-                                        speed_unit = speed_match.group(2)
-                                        
-                                        # 转换为速度值和格式化字符串
-                                        if 'KB/s' in speed_unit or 'KiB/s' in speed_unit:
-                                            speed_value = speed_val * 1024
-                                        elif 'MB/s' in speed_unit or 'MiB/s' in speed_unit:
-                                            speed_value = speed_val * 1024 * 1024
-                                        elif 'GB/s' in speed_unit or 'GiB/s' in speed_unit:
-                                            speed_value = speed_val * 1024 * 1024 * 1024
-                                        else:  # B/s
-                                            speed_value = speed_val
-                                        
-                                        speed_str = f"{speed_val} {speed_unit}"
-                                        print(f"匹配到速度: {speed_str} ({speed_value} bytes/s)")
-                                    except Exception as e:
-                                        print(f"解析速度时出错: {e}")
-                                
-                                # 如果没有匹配到速度，生成一个合理的值
-                                if "at" not in line or speed_value == 1048576:
-                                    # 根据进度和已用时间生成合理的速度值
-                                    elapsed = time.time() - download_start_time
-                                    if elapsed > 0:
-                                        # 速度随着进度的增加而略微增加，添加一些随机变化
-                                        base_speed = 1048576 * (1 + (percent / 200))  # 基础速度略随进度增加
-                                        variation = random.randint(0, int(base_speed * 0.2))  # 20%以内的随机变化
-                                        speed_value = max(102400, int(base_speed + variation))  # 确保至少100KB/s
-                                        speed_str = get_dynamic_speed_str(speed_value)
-                                        print(f"生成的动态速度: {speed_str}")
-                                
-                                # 解析ETA(预计剩余时间)
-                                eta_str = "计算中..."
-                                eta_match = re.search(r'ETA\s+(\d+:?\d*:?\d*)', line)
-                                if eta_match:
-                                    eta_time = eta_match.group(1)
-                                    eta_str = f"剩余时间: {eta_time}"
-                                    print(f"匹配到ETA: {eta_str}")
-                                else:
-                                    # 如果没有解析到ETA，根据进度和速度计算一个估计值
-                                    if percent > 0 and speed_value > 0:
-                                        # 估算剩余时间 = (总时间/已完成百分比) * (100-已完成百分比)/100
-                                        elapsed = time.time() - download_start_time
-                                        estimated_total = elapsed / (percent/100)
-                                        eta_seconds = estimated_total * ((100-percent)/100)
-                                        
-                                        # 格式化剩余时间
-                                        if eta_seconds < 60:
-                                            eta_str = f"剩余时间: {int(eta_seconds)}秒"
-                                        elif eta_seconds < 3600:
-                                            minutes = int(eta_seconds // 60)
-                                            seconds = int(eta_seconds % 60)
-                                            eta_str = f"剩余时间: {minutes}分{seconds}秒"
-                                        else:
-                                            hours = int(eta_seconds // 3600)
-                                            minutes = int((eta_seconds % 3600) // 60)
-                                            eta_str = f"剩余时间: {hours}时{minutes}分"
-                                
-                                # 更新状态，包含所有解析到的信息
-                                status_message = f"下载中: {percent}% - {speed_str} - {eta_str}"
-                                print(f"更新下载状态: {status_message}, 进度: {progress}%")
-                                update_status(status_message, progress=progress)
-                                
-                                # 更新任务状态中的详细信息
-                                if task_id in download_tasks:
-                                    download_tasks[task_id].update({
-                                        "speed": speed_value,
-                                        "speed_str": speed_str,
-                                        "eta_str": eta_str,
-                                        "last_update_time": time.time()
-                                    })
-                        
-                        # 识别特定阶段并更新进度
-                        elif "Destination:" in line or "已完成" in line or "完成下载" in line:
-                            progress = max(progress, 90)  # 确保至少显示90%
-                            # 使用动态正数速度值
-                            speed_str = get_dynamic_speed_str(1048576 + random.randint(0, 262144))
-                            update_status(f"即将完成: {line} - {speed_str}", progress=progress)
-                            last_status_update_time = time.time()
-                        elif "正在合并" in line or "Merging" in line:
-                            progress = max(progress, 92)  # 合并阶段
-                            # 使用动态正数速度值
-                            speed_str = get_dynamic_speed_str(1048576 + random.randint(0, 262144))
-                            update_status(f"正在合并视频: {line} - {speed_str}", progress=progress)
-                            last_status_update_time = time.time()
-                        elif "正在编写元数据" in line or "Writing metadata" in line:
-                            progress = max(progress, 94)  # 写入元数据阶段
-                            # 使用动态正数速度值
-                            speed_str = get_dynamic_speed_str(1048576 + random.randint(0, 262144))
-                            update_status(f"正在处理元数据: {line} - {speed_str}", progress=progress)
-                            last_status_update_time = time.time()
-                    else:
-                        # 如果没有新输出，处理不同的情况
-                        current_time = time.time()
-                        
-                        # 初始化阶段 - 动态更新速度和阶段显示
-                        if initialization_phase:
-                            # 每0.5秒更新一次状态，生成动态变化的速度
-                            if current_time - last_dynamic_update > 0.5:
-                                # 随机变化动态速度以更真实，始终保持为正数
-                                dynamic_speed = max(51200, dynamic_speed + random.randint(0, 30720))  # 50KB/s到变化的速度，始终为正
-                                
-                                # 使用辅助函数获取速度字符串
-                                speed_str = get_dynamic_speed_str(dynamic_speed)
-                                
-                                # 更新显示状态
-                                status_message = f"{phase_name} - {speed_str}"
-                                
-                                # 缓慢增加进度，最多到20%
-                                progress = min(progress + 0.2, 20)  # 减慢进度增加速度
-                                simulated_progress = progress
-                                
-                                update_status(status_message, progress=progress)
-                                print(f"初始化阶段更新状态: {status_message}")
-                                
-                                last_dynamic_update = current_time
-                                last_status_update_time = current_time
-                        
-                        # 如果下载已开始但一段时间内没有新的进度更新，使用智能模拟进度
-                        elif download_started and current_time - last_progress_update_time > 2.0:
-                            # 检查是否已经有过真实的进度更新
-                            if progress_update_count > 0:
-                                # 如果有过真实进度更新，基于已有数据进行更平滑的模拟
-                                # 计算经过的时间与上次进度更新的时间比
-                                time_since_last = current_time - last_progress_update_time
-                                # 估算每秒应该增加的进度(基于过去的进度更新)
-                                elapsed_since_start = max(0.1, current_time - download_start_time)
-                                progress_rate = last_real_progress / elapsed_since_start
-                                
-                                # 计算应该增加的进度，但设置上限以避免过快增长
-                                progress_increase = min(3.0, progress_rate * time_since_last)
-                                
-                                # 缓慢增加模拟进度，但确保不超过一定限制
-                                simulated_progress = min(95, simulated_progress + progress_increase * 0.1)
-                                
-                                # 只有当模拟进度大于当前显示进度时才更新
-                                if simulated_progress > progress:
-                                    progress = simulated_progress
-                                    
-                                    # 生成动态速度和ETA信息
-                                    speed_value = max(512000, int(1048576 * (progress / 50)))  # 根据进度调整速度
-                                    variation = random.randint(0, 262144)  # 随机变化
-                                    speed_value += variation
-                                    speed_str = get_dynamic_speed_str(speed_value)
-                                    
-                                    # 估算剩余时间
-                                    if progress < 95:  # 只有在进度未接近完成时才估算
-                                        percent_done = progress / 95.0 * 100.0  # 转换回0-100%
-                                        elapsed = current_time - download_start_time
-                                        if percent_done > 0:
-                                            total_time = elapsed / (percent_done / 100.0)
-                                            remaining = total_time - elapsed
-                                            
-                                            # 格式化剩余时间
-                                            if remaining < 60:
-                                                eta_str = f"剩余: {int(remaining)}秒"
-                                            elif remaining < 3600:
-                                                eta_str = f"剩余: {int(remaining // 60)}分{int(remaining % 60)}秒"
-                                            else:
-                                                eta_str = f"剩余: {int(remaining // 3600)}时{int((remaining % 3600) // 60)}分"
-                                        else:
-                                            eta_str = "计算中..."
-                                    else:
-                                        eta_str = "即将完成"
-                                    
-                                    # 更新状态
-                                    status_message = f"下载中... {progress:.1f}% - {speed_str} - {eta_str}"
-                                    update_status(status_message, progress=progress)
-                                    print(f"模拟进度更新: {status_message}")
-                                    last_status_update_time = current_time
-                            else:
-                                # 如果还没有真实进度更新，使用更保守的模拟
-                                # 每2秒缓慢增加一点进度
-                                simulated_progress = min(40, simulated_progress + 0.5)
-                                
-                                if simulated_progress > progress:
-                                    progress = simulated_progress
-                                    speed_str = get_dynamic_speed_str(512000 + random.randint(0, 262144))
-                                    status_message = f"下载准备中... - {speed_str}"
-                                    update_status(status_message, progress=progress)
-                                    print(f"初始模拟进度更新: {status_message}")
-                                    last_status_update_time = current_time
-                        
-                        # 如果5秒内没有任何状态更新，显示活动状态以防用户认为程序卡住
-                        elif current_time - last_status_update_time > 5.0:
-                            # 生成一个动态的速度显示
-                            speed_value = 512000 + random.randint(0, 512000)  # 0.5-1MB范围内的随机速度
-                            speed_str = get_dynamic_speed_str(speed_value)
-                            
-                            status_message = f"{'处理中' if download_started else phase_name} - {speed_str}"
-                            # 不更新进度，只更新状态消息，保持进度连续性
-                            update_status(status_message, progress=progress)
-                            print(f"长时间无状态更新，发送保持活动状态: {status_message}")
-                            last_status_update_time = current_time
+                    kind, payload = parse_ytdlp_output_line(line)
+                    if kind == "progress":
+                        if payload.get("status") == "downloading":
+                            track_partial_file(task_id, payload.get("tmpfilename"))
+                        progress_hook(payload)
+                    elif kind == "postprocess":
+                        # 后处理进度由yt-dlp写到stderr，YtdlpProcess按标记转发到这里
+                        started = describe_postprocess(payload)
+                        if started:
+                            message, phase = started
+                            update_status(message, status="postprocessing")
+                            if phase:
+                                set_task_phase(task_id, phase)
+                    elif kind == "filepath":
+                        # 记录yt-dlp报告的最终文件路径，用于下载完成后确定输出文件
+                        destination_files.append(payload)
+                        download_log.info("[任务 %s] 输出文件: %s", task_id[:8], payload, extra={"task_id": task_id})
+                    elif line.strip():
+                        # 逐行的输出按任务限流，避免刷屏
+                        download_log.debug("yt-dlp输出: %s", line.strip(),
+                                           extra={"task_id": task_id, "rate_key": f"ytdlp-output:{task_id}"})
                 except Exception as e:
-                    print(f"读取进程输出时出错: {e}")
-                    import traceback
-                    print(traceback.format_exc())
-                
-                # 短暂等待后继续检查，缩短检查间隔提高响应速度
-                await asyncio.sleep(0.5)  # 从1秒改为0.5秒
+                    download_log.warning(f"读取进程输出时出错: {e}")
+                    download_log.debug("详细错误信息", exc_info=True)
             
             # 进程完成，检查退出码
-            exit_code = process.returncode
+            exit_code = await process.wait()
+            if is_task_interrupted(task_id):
+                return  # 进程被暂停/取消操作终止，不视为错误
             if exit_code == 0:
-                print(f"下载进程成功完成，退出码: {exit_code}")
-                update_status("下载完成，正在处理文件...", progress=95)
+                download_log.info(f"下载进程成功完成，退出码: {exit_code}")
+                update_status("下载完成，正在处理文件...")
             else:
-                stderr_output = ""
-                try:
-                    stderr_output = process.stderr.read() if process.stderr else ""
-                except:
-                    pass
+                stderr_output = process.stderr_text()
                 
                 # 检查是否是ffmpeg错误
                 if stderr_output and ("ffprobe and ffmpeg not found" in stderr_output or "ffmpeg not found" in stderr_output or "Postprocessing:" in stderr_output and ("ffmpeg" in stderr_output or "ffprobe" in stderr_output)):
                     error_msg = "下载MP3需要ffmpeg工具，系统未找到ffmpeg。正在尝试自动下载..."
-                    print(error_msg)
-                    update_status(error_msg, progress=10, status="warning")
+                    download_log.info(error_msg)
+                    update_status(error_msg, status="warning")
                     
                     # 尝试下载ffmpeg
                     ffmpeg_path = await download_ffmpeg()
                     if ffmpeg_path:
                         # 如果成功下载，提示用户重试
                         success_msg = "已成功下载ffmpeg工具！请重新尝试下载MP3。"
-                        print(success_msg)
+                        download_log.info(success_msg)
                         update_status(success_msg, progress=0, status="error")
                         
                         # 将错误信息更新为更友好的提示
@@ -1248,7 +1771,7 @@ async def direct_download_with_ytdlp(video_url, task_id, output_dir, video_quali
                     else:
                         # 如果下载失败，给出手动安装建议
                         install_guide = "无法自动下载ffmpeg，请手动安装: https://ffmpeg.org/download.html"
-                        print(install_guide)
+                        download_log.info(install_guide)
                         update_status(install_guide, progress=0, status="error")
                         
                         # 更新错误信息
@@ -1258,23 +1781,22 @@ async def direct_download_with_ytdlp(video_url, task_id, output_dir, video_quali
                     if stderr_output:
                         error_msg += f", 错误: {stderr_output}"
                 
-                print(error_msg)
+                download_log.info(error_msg)
                 update_status(error_msg, progress=0, status="error")
         except Exception as e:
-            print(f"监控进程时出错: {e}")
-            import traceback
-            print(traceback.format_exc())
+            download_log.warning(f"监控进程时出错: {e}")
+            download_log.debug("详细错误信息", exc_info=True)
     
     try:
         # 安全更新初始任务状态
-        update_status("准备开始下载...", progress=5)
+        update_status("准备开始下载...")
         
         # 启动状态监控
         monitor_task = asyncio.create_task(status_monitor())
         
         # 确保下载目录是绝对路径并且存在
         output_dir_path = Path(output_dir).resolve()
-        print(f"下载目录路径: {output_dir_path}")
+        download_log.info(f"下载目录路径: {output_dir_path}")
         
         # 保存原始用户选择的路径，用于后续记录
         original_output_dir = str(output_dir_path)
@@ -1283,10 +1805,10 @@ async def direct_download_with_ytdlp(video_url, task_id, output_dir, video_quali
         if not output_dir_path.exists():
             try:
                 output_dir_path.mkdir(parents=True, exist_ok=True)
-                print(f"创建了下载目录: {output_dir_path}")
+                download_log.info(f"创建了下载目录: {output_dir_path}")
             except Exception as e:
                 # 如果无法创建目录，回退到默认videos目录
-                print(f"无法创建指定的下载目录: {e}，回退到默认videos目录")
+                download_log.warning(f"无法创建指定的下载目录: {e}，回退到默认videos目录")
                 output_dir_path = VIDEOS_DIR.resolve()
                 output_dir_path.mkdir(parents=True, exist_ok=True)
         
@@ -1296,20 +1818,20 @@ async def direct_download_with_ytdlp(video_url, task_id, output_dir, video_quali
             with open(test_file_path, 'w') as f:
                 f.write('test')
             test_file_path.unlink()  # 删除测试文件
-            print(f"目录 {output_dir_path} 可写")
+            download_log.info(f"目录 {output_dir_path} 可写")
         except Exception as e:
             # 如果目录不可写，回退到默认videos目录
-            print(f"目录 {output_dir_path} 不可写: {e}，回退到默认videos目录")
+            download_log.info(f"目录 {output_dir_path} 不可写: {e}，回退到默认videos目录")
             
             # 记录错误消息，告知用户下载位置已更改
-            update_status(f"您选择的目录 {original_output_dir} 无法写入，已更改到默认videos目录", progress=10)
+            update_status(f"您选择的目录 {original_output_dir} 无法写入，已更改到默认videos目录")
             
             output_dir_path = VIDEOS_DIR.resolve()
             output_dir_path.mkdir(parents=True, exist_ok=True)
         
         # 更新输出目录变量
         output_dir = str(output_dir_path)
-        update_status(f"将下载到目录: {output_dir}", progress=10)
+        update_status(f"将下载到目录: {output_dir}")
         
         # 设置环境变量临时覆盖Windows的用户目录 - 避免权限问题
         env = os.environ.copy()
@@ -1329,18 +1851,26 @@ async def direct_download_with_ytdlp(video_url, task_id, output_dir, video_quali
         # 配置更加简化的参数，尝试减少失败可能性
         cmd.extend(["--no-warnings", "--no-check-certificate"])
         
-        # 启用进度显示，取消之前禁用进度条的设置
-        cmd.extend(["--newline", "--progress"])
+        # 进度、后处理进度和最终文件路径以JSON/固定前缀逐行输出，不再解析面向人的文本
+        cmd.extend(["--newline", "--progress", *YTDLP_STRUCTURED_OUTPUT_ARGS])
         
         # 检查是否需要ffmpeg（音频格式转换需要）
         ffmpeg_needed = format_type in ["audio", "mp3"] or "-x" in " ".join(cmd)
-        if ffmpeg_needed:
+        ffmpeg_path = None
+        if not ffmpeg_needed:
+            # 视频格式有ffmpeg时才能下载分离的视频流和音频流并合并，不自动下载ffmpeg
+            ffmpeg_path = get_ffmpeg_path()
+            if ffmpeg_path:
+                cmd.extend(["--ffmpeg-location", ffmpeg_path])
+                if format_type in MERGE_OUTPUT_FORMATS:
+                    cmd.extend(["--merge-output-format", MERGE_OUTPUT_FORMATS[format_type]])
+        else:
             # 尝试获取ffmpeg路径，如果没有则尝试下载
-            print("检测到需要ffmpeg，开始检查并确保ffmpeg可用...")
+            download_log.info("检测到需要ffmpeg，开始检查并确保ffmpeg可用...")
             ffmpeg_path = await get_ffmpeg_path_async()
             
             if ffmpeg_path:
-                print(f"找到ffmpeg路径: {ffmpeg_path}")
+                download_log.info(f"找到ffmpeg路径: {ffmpeg_path}")
                 # 确保命令行中包含ffmpeg路径
                 cmd.extend(["--ffmpeg-location", ffmpeg_path])
                 
@@ -1348,26 +1878,20 @@ async def direct_download_with_ytdlp(video_url, task_id, output_dir, video_quali
                 ffmpeg_dir = Path(ffmpeg_path).parent
                 ffprobe_path = ffmpeg_dir / "ffprobe.exe" if platform.system() == "Windows" else ffmpeg_dir / "ffprobe"
                 if ffprobe_path.exists():
-                    print(f"同时找到ffprobe路径: {ffprobe_path}")
+                    download_log.info(f"同时找到ffprobe路径: {ffprobe_path}")
                 else:
-                    print(f"未找到ffprobe，可能会影响某些功能")
+                    download_log.warning(f"未找到ffprobe，可能会影响某些功能")
             else:
                 # 如果尝试下载后仍然找不到ffmpeg
-                print("警告: 未能获取ffmpeg路径，下载可能会失败...")
+                download_log.warning("警告: 未能获取ffmpeg路径，下载可能会失败...")
                 update_status("警告: 未能获取ffmpeg工具，如果下载失败，请尝试重新下载或选择视频格式", 
-                             progress=10, status="warning")
+                             status="warning")
         
-        # 为短视频使用更简单的格式
-        cmd.extend(["-f", "best"])  # 始终使用best格式
+        # 按请求的画质和格式选择下载的流
+        cmd.extend(["-f", build_format_selector(video_quality, format_type, can_merge=ffmpeg_path is not None)])
         
         # 修复-o参数以避免文件名过长问题
-        output_template = f"{output_dir}%(title).100s-%(id)s-shorts.%(ext)s"
-        if "shorts" not in video_url.lower():
-            if format_type == "audio":
-                # 为音频文件添加明确的后缀
-                output_template = f"{output_dir}%(title).100s-%(id)s-audio.%(ext)s"
-            else:
-                output_template = f"{output_dir}%(title).100s-%(id)s.%(ext)s"
+        output_template = build_output_template(output_dir, video_url, format_type)
         
         # 添加更多限制性文件名，避免Windows路径问题
         cmd.extend(["-o", output_template, "--restrict-filenames"])
@@ -1384,49 +1908,45 @@ async def direct_download_with_ytdlp(video_url, task_id, output_dir, video_quali
         # 限制重试次数
         cmd.extend(["--retries", "2", "--socket-timeout", "15", "--no-cache-dir"])
         
+        # 按分配的带宽限速（子进程启动后无法调整，使用启动时的速率）
+        rate_limit = bandwidth_manager.task_rate(task_id)
+        if rate_limit:
+            cmd.extend(["--limit-rate", str(int(rate_limit))])
+        
         # 添加视频URL
         cmd.append(video_url)
         
         # 更新任务状态
         command_str = " ".join(cmd)
-        update_status(f"正在启动下载进程: {command_str}", progress=15)
-        print(f"执行下载命令: {command_str}")
+        update_status(f"正在启动下载进程: {command_str}")
+        download_log.info(f"执行下载命令: {command_str}")
         
         # 创建进程
         try:
             # 启动下载进程，使用修改过的环境变量
-            process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                encoding='utf-8',
-                errors='ignore',
-                bufsize=1,  # 行缓冲
-                creationflags=subprocess.CREATE_NO_WINDOW,  # 防止命令行窗口闪现
-                env=env  # 使用自定义环境变量
-            )
+            process = YtdlpProcess(cmd, env=env, route_stderr=is_ytdlp_structured_line)
+            await process.start()
+            attach_task_process(task_id, process)
             
             # 进程启动后通知用户
-            update_status("下载进程已启动，等待视频信息...", progress=20)
+            update_status("下载进程已启动，等待视频信息...")
             
             # 停止状态监控，启动专用的进程监控
             if 'monitor_task' in locals() and not monitor_task.done():
                 monitor_task.cancel()
             process_mon_task = asyncio.create_task(process_monitor(process))
             
-            # 等待进程完成
-            stdout, stderr = await asyncio.get_event_loop().run_in_executor(
-                None, 
-                lambda: (process.communicate())
-            )
+            # 等待监控任务读完全部输出，再等待进程退出
+            await process_mon_task
+            await process.wait()
             
-            # 取消进程监控任务
-            if 'process_mon_task' in locals() and not process_mon_task.done():
-                process_mon_task.cancel()
+            # 用户暂停或取消时进程被终止，.part文件保留用于续传或由取消流程清理
+            if is_task_interrupted(task_id):
+                raise DownloadInterrupted("下载已被用户中断")
             
             # 检查进程结果
             if process.returncode != 0:
+                stderr = process.stderr_text()
                 if stderr:
                     error_message = stderr
                     error_lines = error_message.splitlines()
@@ -1434,7 +1954,7 @@ async def direct_download_with_ytdlp(video_url, task_id, output_dir, video_quali
                     if len(error_lines) > 3:
                         error_message = "\n".join(error_lines[-3:])
                     
-                    print(f"下载失败: {error_message}")
+                    download_log.warning(f"下载失败: {error_message}")
                     update_status(f"下载失败: {error_message}", progress=0, status="error")
                     raise Exception(f"下载失败: {error_message}")
                 else:
@@ -1442,100 +1962,69 @@ async def direct_download_with_ytdlp(video_url, task_id, output_dir, video_quali
                     update_status(error_message, progress=0, status="error")
                     raise Exception(error_message)
             
-            # 确定实际下载的文件路径
-            output_file = None
-            
-            # 尝试查找下载的文件
-            if stdout:
-                # 分析输出找到文件名
-                file_lines = [line for line in stdout.splitlines() if "[download] Destination:" in line]
-                for line in file_lines:
-                    try:
-                        file_path = line.split("[download] Destination:")[1].strip()
-                        if os.path.exists(file_path):
-                            output_file = file_path
-                            print(f"找到下载文件: {output_file}")
-                            break
-                    except:
-                        pass
-            
-            # 如果上面方法找不到文件，使用目录扫描方法
-            if not output_file:
-                print("在标准输出中未找到文件路径，尝试扫描目录...")
-                
-                # 获取目录下的所有文件并按修改时间排序
-                all_files = list(output_dir_path.glob("*"))
-                recent_files = sorted(
-                    all_files, 
-                    key=lambda f: f.stat().st_mtime if f.exists() else 0,
-                    reverse=True
-                )
-                
-                # 使用最近修改的文件
-                if recent_files:
-                    output_file = str(recent_files[0])
-                    print(f"通过目录扫描找到最新文件: {output_file}")
-            
-            # 如果仍然找不到，设置一个默认值（作为最终后备）
+            # yt-dlp在文件移动到最终位置后输出的路径就是本任务的下载结果，不扫描目录猜测
+            output_file = next((path for path in reversed(destination_files) if os.path.exists(path)), None)
             if not output_file:
-                print("无法确定下载的文件名")
-                # 使用一个假的文件名以防万一
-                output_file = str(output_dir_path / "downloaded_video.mp4")
+                error_message = "下载已结束，但yt-dlp没有报告输出文件"
+                update_status(error_message, progress=0, status="error")
+                raise Exception(error_message)
+            download_log.info(f"找到下载文件: {output_file}")
             
-            # 更新任务状态为完成
-            update_status("下载已完成!", progress=100, status="completed")
-            
-            if task_id in download_tasks:
-                download_tasks[task_id].update({
-                    "filepath": output_file,
+            # 更新任务状态为完成（需要打包ZIP时进入打包阶段）
+            if task_store.is_active(task_id):
+                task_store.update(task_id, {
+                    **download_finished_fields(task_id, output_file),
                     "actual_download_dir": output_dir,  # 设置实际下载目录
-                    "speed_str": "下载完成"  # 确保下载完成后不再显示"准备中"
+                    "speed_str": "下载完成"
                 })
             
             # 保存下载记录到数据库
             try:
                 # 从任务中获取基本视频信息
                 video_info = {}
-                if task_id in download_tasks:
+                if task_store.is_active(task_id):
                     # 提取所有可用的视频信息
                     video_info = {
-                        "title": download_tasks[task_id].get("title", os.path.basename(output_file)),
-                        "uploader": download_tasks[task_id].get("uploader", "未知上传者"),
-                        "duration": download_tasks[task_id].get("duration", 0)
+                        "title": task_store.get(task_id).get("title", os.path.basename(output_file)),
+                        "uploader": task_store.get(task_id).get("uploader", "未知上传者"),
+                        "duration": task_store.get(task_id).get("duration", 0)
                     }
                 
                 # 生成格式信息
                 format_info = f"{format_type.upper()} - {video_quality}"
                 
                 # 保存记录
-                print(f"调用save_download_record保存记录: {output_file}")
-                save_download_record(
+                download_log.info(f"调用save_download_record保存记录: {output_file}")
+                await db.run(
+                    save_download_record,
                     video_info=video_info,
                     file_path=output_file,
                     format_info=format_info,
                     download_path=download_path,
                     actual_download_dir=output_dir
                 )
-                print(f"成功保存下载记录")
+                download_log.info(f"成功保存下载记录")
             except Exception as save_error:
-                print(f"保存下载记录时出错: {save_error}")
-                import traceback
-                print(traceback.format_exc())
+                download_log.warning(f"保存下载记录时出错: {save_error}")
+                download_log.debug("详细错误信息", exc_info=True)
             
             return output_dir, output_file
             
         except asyncio.CancelledError:
-            print("下载任务被取消")
+            download_log.info("下载任务被取消")
             try:
+                if 'process_mon_task' in locals() and not process_mon_task.done():
+                    process_mon_task.cancel()
                 if 'process' in locals() and process:
                     process.terminate()
-                    print("已终止下载进程")
+                    download_log.info("已终止下载进程")
             except Exception as e:
-                print(f"终止进程时出错: {e}")
+                download_log.warning(f"终止进程时出错: {e}")
             raise
         except Exception as proc_error:
-            print(f"下载过程中出错: {proc_error}")
-            update_status(f"下载错误: {str(proc_error)}", progress=0, status="error")
+            download_log.warning(f"下载过程中出错: {proc_error}")
+            if not isinstance(proc_error, DownloadInterrupted):
+                update_status(f"下载错误: {str(proc_error)}", progress=0, status="error")
             # 确保监控任务被取消
             try:
                 if 'process_mon_task' in locals() and not process_mon_task.done():
@@ -1547,21 +2036,2157 @@ async def direct_download_with_ytdlp(video_url, task_id, output_dir, video_quali
             raise
             
     except Exception as e:
-        print(f"下载视频时出错: {e}")
-        update_status(f"下载失败: {str(e)}", progress=0, status="error")
+        download_log.warning(f"下载视频时出错: {e}")
+        if not isinstance(e, DownloadInterrupted):
+            update_status(f"下载失败: {str(e)}", progress=0, status="error")
         
         # 确保所有任务都被取消
         try:
-            if 'monitor_task' in locals() and not monitor_task.done():
-                monitor_task.cancel()
-            if 'process_mon_task' in locals() and not process_mon_task.done():
-                process_mon_task.cancel()
-        except:
-            pass
-        
-        raise
-        
-    return output_dir, None  # 如果所有尝试都失败，返回空文件
+            if 'monitor_task' in locals() and not monitor_task.done():
+                monitor_task.cancel()
+            if 'process_mon_task' in locals() and not process_mon_task.done():
+                process_mon_task.cancel()
+        except:
+            pass
+        
+        raise
+        
+    return output_dir, None  # 如果所有尝试都失败，返回空文件
+
+
+# ==================== 下载调度器 ====================
+# 全局并发上限：同时运行的下载任务数
+MAX_CONCURRENT_DOWNLOADS = 4
+# 等待队列长度上限，超过后返回429
+MAX_QUEUE_SIZE = 50
+# 按来源限制并发数，来源由scheduler.get_download_origins确定，每个任务只占用一个来源。
+# YouTube（含googlevideo媒体CDN）的上限与全局上限相同，只有YouTube任务时由全局上限决定并发；
+# 调低该值可以给其他站点保留名额
+HOST_CONCURRENCY_LIMITS = {
+    "youtube.com": MAX_CONCURRENT_DOWNLOADS,
+}
+
+
+download_scheduler = DownloadScheduler(
+    MAX_CONCURRENT_DOWNLOADS,
+    MAX_QUEUE_SIZE,
+    HOST_CONCURRENCY_LIMITS
+)
+
+
+# ==================== 带宽限制 ====================
+# 带宽上限（字节/秒），0表示不限制，运行时可以通过/admin/bandwidth调整
+# 全局上限：所有下载任务合计
+BANDWIDTH_GLOBAL_LIMIT = 0
+# 单个任务的上限
+BANDWIDTH_TASK_LIMIT = 0
+# 单个客户端（按请求来源IP区分）所有任务合计的上限
+BANDWIDTH_CLIENT_LIMIT = 0
+
+bandwidth_manager = BandwidthManager(
+    BANDWIDTH_GLOBAL_LIMIT,
+    BANDWIDTH_TASK_LIMIT,
+    BANDWIDTH_CLIENT_LIMIT,
+    on_rate_change=lambda task_id, rate: ytdlp_pool.set_rate_limit(task_id, rate)
+)
+
+
+# ==================== yt-dlp 常驻进程池 ====================
+# 工作进程的入口函数在ytdlp_worker.py中（只依赖yt_dlp，导入时没有副作用），
+# 工作进程不会创建应用、打开数据库或启动日志线程
+# 是否使用预热的yt-dlp进程池执行下载，进程池不可用时自动回退到命令行子进程方式
+YTDLP_POOL_ENABLED = True
+# 进程池大小（每个工作进程常驻一个yt-dlp解释器）。默认与调度器全局并发上限相同，
+# 并行下载的音视频流在工作进程不足时排队；内存充足时可调大到MAX_CONCURRENT_DOWNLOADS * 2，让所有任务的两个流同时下载
+YTDLP_POOL_SIZE = MAX_CONCURRENT_DOWNLOADS
+
+
+class YtdlpWorkerPool:
+    """
+    预热的yt-dlp工作进程池
+    工作进程启动时已导入yt_dlp并缓存YoutubeDL实例，进度通过队列转发给主进程中的DownloadProgressHook
+    """
+    def __init__(self, size):
+        self.size = size
+        self.available = False
+        self._executor = None
+        self._manager = None
+        self._progress_queue = None
+        self._control_states = None  # 跨进程共享的任务控制状态 task_id -> paused/cancelled
+        self._rate_limits = None  # 跨进程共享的任务速率上限 task_id -> 字节/秒
+        self._hooks = {}  # (task_id, stream) -> 进度回调
+        self._loop = None
+
+    def start(self):
+        try:
+            ctx = multiprocessing.get_context("spawn")
+            self._loop = asyncio.get_running_loop()
+            self._progress_queue = ctx.Queue()
+            self._manager = ctx.Manager()
+            self._control_states = self._manager.dict()
+            self._rate_limits = self._manager.dict()
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.size,
+                mp_context=ctx,
+                initializer=ytdlp_worker.init_worker,
+                initargs=(self._progress_queue, self._control_states, self._rate_limits)
+            )
+            # 提前启动所有工作进程，避免第一个下载任务承担启动开销
+            for _ in range(self.size):
+                self._executor.submit(ytdlp_worker.ping)
+            threading.Thread(target=self._forward_progress, daemon=True).start()
+            self.available = True
+            pool_log.info(f"yt-dlp进程池已启动，工作进程数: {self.size}")
+        except Exception as e:
+            pool_log.warning(f"启动yt-dlp进程池失败，将使用命令行下载方式: {e}")
+            self.available = False
+
+    def shutdown(self):
+        self.available = False
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        if self._progress_queue:
+            self._progress_queue.put(None)
+        if self._manager:
+            self._manager.shutdown()
+
+    def set_control(self, task_id, state):
+        """通知工作进程暂停或取消任务"""
+        if self._control_states is None:
+            return
+        try:
+            self._control_states[task_id] = state
+        except Exception as e:
+            pool_log.warning(f"下发任务控制指令失败 [{task_id[:8]}]: {e}")
+
+    def set_rate_limit(self, task_id, rate):
+        """设置任务的速率上限（字节/秒），0表示不限制"""
+        if self._rate_limits is None:
+            return
+        try:
+            if rate:
+                self._rate_limits[task_id] = rate
+            else:
+                self._rate_limits.pop(task_id, None)
+        except Exception as e:
+            pool_log.warning(f"下发限速设置失败 [{task_id[:8]}]: {e}")
+
+    def clear_control(self, task_id):
+        if self._control_states is None:
+            return
+        try:
+            self._control_states.pop(task_id, None)
+        except Exception:
+            pass
+
+    def _forward_progress(self):
+        """后台线程：从队列读取进度，交给事件循环线程处理"""
+        while True:
+            try:
+                item = self._progress_queue.get()
+            except (EOFError, OSError):
+                break
+            if item is None:
+                break
+            self._loop.call_soon_threadsafe(self._dispatch_progress, *item)
+
+    def _dispatch_progress(self, task_id, message):
+        if message.get("status") == "downloading":
+            track_partial_file(task_id, message.get("tmpfilename"))
+        hook = self._hooks.get((task_id, message.get("stream")))
+        if hook is None:
+            return
+        try:
+            hook(message)
+        except Exception as e:
+            pool_log.warning(f"处理进度回调时出错 [{task_id[:8]}]: {e}")
+
+    async def download(self, task_id, video_url, ydl_opts, progress_hook, info=None, stream=None):
+        # 工作进程只在进度回调中检查暂停/取消，已被暂停或取消的任务不再提交
+        check_task_interrupted(task_id)
+        self._hooks[(task_id, stream)] = progress_hook
+        try:
+            future = self._executor.submit(ytdlp_worker.download, task_id, video_url, ydl_opts, info, stream)
+            return await asyncio.wrap_future(future)
+        except BrokenProcessPool:
+            self.available = False
+            raise
+        finally:
+            self._hooks.pop((task_id, stream), None)
+
+
+ytdlp_pool = YtdlpWorkerPool(YTDLP_POOL_SIZE)
+
+
+@app.on_event("startup")
+async def start_ytdlp_pool():
+    if YTDLP_POOL_ENABLED:
+        ytdlp_pool.start()
+
+
+@app.on_event("shutdown")
+async def stop_ytdlp_pool():
+    ytdlp_pool.shutdown()
+
+
+# ==================== 视频信息缓存 ====================
+# 内存中缓存的视频信息条数上限，超过后淘汰最久未使用的条目
+VIDEO_INFO_CACHE_SIZE = 512
+# 视频信息有效期（秒），过期后重新提取（数据库中的过期记录在写入新记录时清理）
+VIDEO_INFO_TTL = 6 * 3600
+# 提取视频信息的线程数，与下载使用的进程池分开，避免被长时间的下载任务阻塞
+VIDEO_INFO_WORKERS = 2
+# 缓存中保留的字段
+VIDEO_INFO_FIELDS = (
+    "id", "title", "uploader", "channel", "duration", "upload_date", "view_count",
+    "thumbnail", "webpage_url", "extractor_key", "_type", "playlist_count"
+)
+# 从URL中解析YouTube视频ID
+VIDEO_ID_IN_URL = re.compile(r"(?:[?&]v=|youtu\.be/|/shorts/|/embed/|/live/)([A-Za-z0-9_-]{11})")
+
+# 每个提取线程复用的YoutubeDL实例（YoutubeDL不是线程安全的，因此每个线程各用一个）
+_info_thread_local = threading.local()
+
+
+def video_info_key(video_url):
+    """缓存键：能解析出视频ID时使用视频ID，否则使用URL本身"""
+    match = VIDEO_ID_IN_URL.search(video_url)
+    return match.group(1) if match else video_url.strip()
+
+
+def _summarize_video_info(info):
+    """只保留需要的字段；播放列表只保留条目的ID、链接、标题和时长"""
+    summary = {key: info[key] for key in VIDEO_INFO_FIELDS if info.get(key) is not None}
+    if info.get("_type") == "playlist":
+        entries = [entry for entry in info.get("entries") or [] if entry]
+        summary["entries"] = [
+            {
+                "id": entry.get("id"),
+                "url": entry.get("url") or entry.get("webpage_url"),
+                "title": entry.get("title"),
+                "duration": entry.get("duration")
+            }
+            for entry in entries
+        ]
+        summary.setdefault("playlist_count", len(entries))
+    return summary
+
+
+def _extract_video_info(video_url, playlist=False):
+    """
+    在提取线程中运行：不下载，只获取视频信息
+    playlist为True时展开整个播放列表（只获取条目列表，不解析每个视频）
+    """
+    attr = "playlist_ydl" if playlist else "ydl"
+    ydl = getattr(_info_thread_local, attr, None)
+    if ydl is None:
+        ydl = yt_dlp.YoutubeDL({
+            "quiet": True,
+            "no_warnings": True,
+            "skip_download": True,
+            "noplaylist": not playlist,
+            "extract_flat": "in_playlist",
+            "socket_timeout": 15,
+            "cachedir": False,
+            "nocheckcertificate": True
+        })
+        setattr(_info_thread_local, attr, ydl)
+    info = ydl.extract_info(video_url, download=False)
+    return _summarize_video_info(ydl.sanitize_info(info))
+
+
+class VideoInfoCache:
+    """
+    视频信息缓存：内存中按LRU保留最近使用的条目，同时持久化到video_info_cache表
+    同一视频的并发请求只提取一次
+    """
+    def __init__(self, max_entries=VIDEO_INFO_CACHE_SIZE, ttl=VIDEO_INFO_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (提取时间, 信息)
+        self._lock = threading.Lock()
+        self._pending = {}  # key -> 正在进行的提取Future
+        self._executor = None
+
+    def _get_memory(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[0] > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def _put_memory(self, key, fetched_at, info):
+        with self._lock:
+            self._entries[key] = (fetched_at, info)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def lookup(self, key):
+        """同步查找（内存优先，其次数据库），不会触发提取；未命中或已过期时返回None"""
+        if not key:
+            return None
+        info = self._get_memory(key)
+        if info is not None:
+            return info
+        row = db.fetchone(
+            "SELECT info, fetched_at FROM video_info_cache WHERE video_id = ? AND fetched_at >= ?",
+            (key, time.time() - self.ttl)
+        )
+        if row is None:
+            return None
+        try:
+            info = json.loads(row[0])
+        except ValueError:
+            return None
+        self._put_memory(key, row[1], info)
+        return info
+
+    async def get_cached(self, video_url):
+        """在事件循环中查找缓存，不会触发提取"""
+        key = video_info_key(video_url)
+        info = self._get_memory(key)
+        if info is not None:
+            return info
+        return await db.run(self.lookup, key)
+
+    async def get(self, video_url, refresh=False):
+        """返回(视频信息, 是否来自缓存)；未命中时在提取线程池中提取并写入缓存"""
+        key = video_info_key(video_url)
+        if not refresh:
+            info = await self.get_cached(video_url)
+            if info is not None:
+                return info, True
+
+        future = self._pending.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch(key, video_url))
+            self._pending[key] = future
+            future.add_done_callback(lambda _: self._pending.pop(key, None))
+        # shield避免一个请求断开时取消其他请求共享的提取
+        return await asyncio.shield(future), False
+
+    async def _fetch(self, key, video_url):
+        info = await self.extract(video_url)
+        self.store(key, video_url, info)
+        return info
+
+    async def extract(self, video_url, playlist=False):
+        """在提取线程池中提取信息，不使用缓存"""
+        return await self.run(_extract_video_info, video_url, playlist)
+
+    async def run(self, func, *args):
+        """在提取线程池中执行func"""
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=VIDEO_INFO_WORKERS, thread_name_prefix="video-info"
+            )
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def store(self, key, video_url, info):
+        """写入内存缓存并异步持久化，同时清理数据库中已过期的记录"""
+        fetched_at = time.time()
+        self._put_memory(key, fetched_at, info)
+
+        def persist(conn):
+            conn.execute(
+                "INSERT OR REPLACE INTO video_info_cache (video_id, url, info, fetched_at) VALUES (?, ?, ?, ?)",
+                (key, video_url, json.dumps(info, ensure_ascii=False), fetched_at)
+            )
+            conn.execute("DELETE FROM video_info_cache WHERE fetched_at < ?", (fetched_at - self.ttl,))
+
+        def report(future):
+            if future.exception() is not None:
+                info_log.warning(f"保存视频信息缓存失败 [{key}]: {future.exception()}")
+
+        db.submit_write(persist).add_done_callback(report)
+
+    def shutdown(self):
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+video_info_cache = VideoInfoCache()
+
+
+@app.on_event("shutdown")
+async def stop_video_info_cache():
+    video_info_cache.shutdown()
+
+
+# ==================== 分段下载 ====================
+# 内置的HTTP分段下载器（代替已禁用的aria2c）：每个文件用多个连接并行请求不同的字节范围，
+# 直接写入预分配的.part文件。分段状态保存在同名的.segments文件中，暂停或中断后从已下载的位置继续
+SEGMENTED_DOWNLOAD_ENABLED = True
+# 每个文件的并行连接数
+SEGMENTED_CONNECTIONS = 4
+# 小于该大小的文件交给yt-dlp下载
+SEGMENTED_MIN_FILE_SIZE = 8 * 1024 * 1024
+# 分段大小范围：初始按文件大小划分，空闲连接会拆分剩余最多的分段
+SEGMENT_MIN_SIZE = 1024 * 1024
+# 单个请求的最大范围，YouTube对单次请求较大的范围会限速
+SEGMENT_MAX_SIZE = 10 * 1024 * 1024
+# 单个分段连续失败的最多重试次数（有新数据写入后重新计数）
+SEGMENT_RETRIES = 5
+SEGMENT_READ_SIZE = 64 * 1024
+# 连接和读取超时（秒）
+SEGMENT_TIMEOUT = 15
+# 保存分段状态和报告进度的间隔（秒）
+SEGMENT_STATE_INTERVAL = 1.0
+# 最多跟随的重定向次数
+SEGMENT_MAX_REDIRECTS = 5
+
+
+class SegmentError(Exception):
+    """分段请求失败，可以重试"""
+
+
+class RangeNotSupported(Exception):
+    """服务器不支持按范围请求"""
+
+
+def can_segment_download(fmt):
+    """只有大小已知的普通HTTP格式可以分段下载（DASH清单、HLS等交给yt-dlp）"""
+    return (
+        SEGMENTED_DOWNLOAD_ENABLED
+        and fmt.get("protocol") in ("http", "https")
+        and bool(fmt.get("url"))
+        and (fmt.get("filesize") or 0) >= SEGMENTED_MIN_FILE_SIZE
+    )
+
+
+async def open_http_range(url, headers, start, end, ssl_context):
+    """请求url的[start, end]字节范围（包含end），返回(reader, writer, 内容长度)"""
+    for _ in range(SEGMENT_MAX_REDIRECTS + 1):
+        parts = urlsplit(url)
+        secure = parts.scheme == "https"
+        port = parts.port or (443 if secure else 80)
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(parts.hostname, port, ssl=ssl_context if secure else None),
+            SEGMENT_TIMEOUT
+        )
+        try:
+            target = parts.path or "/"
+            if parts.query:
+                target += "?" + parts.query
+            lines = [
+                f"GET {target} HTTP/1.1",
+                f"Host: {parts.netloc}",
+                f"Range: bytes={start}-{end}",
+                "Accept-Encoding: identity",
+                "Connection: close"
+            ]
+            lines.extend(
+                f"{name}: {value}" for name, value in headers.items()
+                if name.lower() not in ("host", "range", "accept-encoding", "connection")
+            )
+            writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+            await writer.drain()
+
+            status_line = await asyncio.wait_for(reader.readline(), SEGMENT_TIMEOUT)
+            try:
+                status = int(status_line.split()[1])
+            except (IndexError, ValueError):
+                raise SegmentError(f"无效的HTTP响应: {status_line[:100]!r}")
+            response_headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), SEGMENT_TIMEOUT)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                response_headers[name.strip().lower()] = value.strip()
+        except BaseException:
+            writer.close()
+            raise
+
+        if status in (301, 302, 303, 307, 308) and "location" in response_headers:
+            writer.close()
+            url = urljoin(url, response_headers["location"])
+            continue
+        if status == 200:
+            writer.close()
+            raise RangeNotSupported("服务器不支持范围请求")
+        if status != 206 or "content-length" not in response_headers:
+            writer.close()
+            raise SegmentError(f"HTTP {status}")
+        return reader, writer, int(response_headers["content-length"])
+    raise SegmentError("重定向次数过多")
+
+
+class SegmentedDownloader:
+    """
+    基于asyncio的HTTP分段下载器
+    segments中每一项为[起始位置, 结束位置(不含), 已写入到的位置]，与.segments文件中保存的格式相同
+    """
+    def __init__(self, url, filepath, total_size, headers=None, connections=SEGMENTED_CONNECTIONS,
+                 verify_ssl=True, progress_callback=None, should_stop=None, throttle=None):
+        self.url = url
+        self.filepath = str(filepath)
+        self.part_path = self.filepath + ".part"
+        self.map_path = self.filepath + ".segments"
+        self.total_size = total_size
+        self.headers = headers or {}
+        self.connections = connections
+        self.progress_callback = progress_callback
+        self.should_stop = should_stop
+        self.throttle = throttle  # 每写入一块数据后调用的限速协程函数
+        self.ssl_context = ssl.create_default_context()
+        if not verify_ssl:
+            self.ssl_context.check_hostname = False
+            self.ssl_context.verify_mode = ssl.CERT_NONE
+        self.segments = []
+        self._active = set()  # 正在下载的分段下标
+        self._downloaded = 0
+        self._speed = 0
+        self._last_sample = (time.time(), 0)
+
+    def _load_or_create(self):
+        """读取已保存的分段状态；没有可用状态时预分配文件并重新划分分段"""
+        if os.path.exists(self.part_path) and os.path.exists(self.map_path):
+            try:
+                with open(self.map_path, "r", encoding="utf-8") as f:
+                    state = json.load(f)
+                if state.get("size") == self.total_size and os.path.getsize(self.part_path) == self.total_size:
+                    self.segments = [list(segment) for segment in state["segments"]]
+                    download_log.info(f"从已下载的分段继续: {self.filepath}")
+            except (OSError, ValueError, KeyError) as e:
+                download_log.warning(f"读取分段状态失败，重新下载: {e}")
+                self.segments = []
+        if not self.segments:
+            with open(self.part_path, "wb") as f:
+                f.truncate(self.total_size)  # 预分配（支持稀疏文件的文件系统上不占用实际空间）
+            size = min(SEGMENT_MAX_SIZE, max(SEGMENT_MIN_SIZE, self.total_size // (self.connections * 4)))
+            self.segments = [
+                [start, min(start + size, self.total_size), start]
+                for start in range(0, self.total_size, size)
+            ]
+        self._downloaded = sum(position - start for start, _, position in self.segments)
+        self._last_sample = (time.time(), self._downloaded)
+
+    def _save_state(self):
+        temp_path = self.map_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"size": self.total_size, "segments": self.segments}, f)
+        os.replace(temp_path, self.map_path)
+
+    def _next_segment(self):
+        """取下一个未开始的分段；没有时拆分剩余最多的进行中分段（后半段交给空闲连接）"""
+        for index, (_, end, position) in enumerate(self.segments):
+            if position < end and index not in self._active:
+                return index
+        candidates = [index for index in self._active if self.segments[index][1] - self.segments[index][2] >= 2 * SEGMENT_MIN_SIZE]
+        if not candidates:
+            return None
+        index = max(candidates, key=lambda i: self.segments[i][1] - self.segments[i][2])
+        _, end, position = self.segments[index]
+        middle = position + (end - position) // 2
+        self.segments[index][1] = middle
+        self.segments.append([middle, end, middle])
+        return len(self.segments) - 1
+
+    @staticmethod
+    def _write(fd, data, offset):
+        if hasattr(os, "pwrite"):
+            os.pwrite(fd, data, offset)
+        else:
+            # Windows没有pwrite；定位和写入之间没有await，不会与其他分段交错
+            os.lseek(fd, offset, os.SEEK_SET)
+            os.write(fd, data)
+
+    def _report(self, force=False):
+        now = time.time()
+        sample_time, sample_bytes = self._last_sample
+        if not force and now - sample_time < SEGMENT_STATE_INTERVAL:
+            return
+        if now > sample_time:
+            current = (self._downloaded - sample_bytes) / (now - sample_time)
+            self._speed = current if not self._speed else self._speed * 0.7 + current * 0.3
+        self._last_sample = (now, self._downloaded)
+        if self.progress_callback:
+            remaining = self.total_size - self._downloaded
+            self.progress_callback({
+                "status": "downloading",
+                "downloaded_bytes": self._downloaded,
+                "total_bytes": self.total_size,
+                "speed": self._speed,
+                "eta": remaining / self._speed if self._speed > 0 else None,
+                "filename": self.filepath,
+                "tmpfilename": self.part_path
+            })
+
+    async def _read_range(self, fd, segment):
+        reader, writer, _ = await open_http_range(
+            self.url, self.headers, segment[2], segment[1] - 1, self.ssl_context
+        )
+        try:
+            # 分段可能在下载过程中被拆分，每次读取前检查新的结束位置
+            while segment[2] < segment[1]:
+                if self.should_stop and self.should_stop():
+                    raise DownloadInterrupted("分段下载已中断")
+                data = await asyncio.wait_for(
+                    reader.read(min(SEGMENT_READ_SIZE, segment[1] - segment[2])), SEGMENT_TIMEOUT
+                )
+                if not data:
+                    raise SegmentError("连接提前关闭")
+                data = data[:segment[1] - segment[2]]
+                self._write(fd, data, segment[2])
+                segment[2] += len(data)
+                self._downloaded += len(data)
+                self._report()
+                if self.throttle:
+                    await self.throttle(len(data))
+        finally:
+            writer.close()
+
+    async def _worker(self, fd):
+        while True:
+            index = self._next_segment()
+            if index is None:
+                return
+            self._active.add(index)
+            segment = self.segments[index]
+            failures = 0
+            try:
+                while segment[2] < segment[1]:
+                    position = segment[2]
+                    try:
+                        await self._read_range(fd, segment)
+                    except (OSError, asyncio.TimeoutError, SegmentError) as e:
+                        failures = 1 if segment[2] > position else failures + 1
+                        if failures > SEGMENT_RETRIES:
+                            raise SegmentError(f"分段 {segment[0]}-{segment[1]} 下载失败: {e}")
+                        download_log.info(f"分段 {segment[0]}-{segment[1]} 第 {failures} 次重试: {e}")
+                        await asyncio.sleep(min(10, 0.5 * 2 ** failures))
+            finally:
+                self._active.discard(index)
+
+    async def _save_periodically(self):
+        while True:
+            await asyncio.sleep(SEGMENT_STATE_INTERVAL)
+            self._save_state()
+
+    async def run(self):
+        """下载完成后把.part文件重命名为目标文件并返回其路径"""
+        self._load_or_create()
+        fd = os.open(self.part_path, os.O_RDWR | getattr(os, "O_BINARY", 0))
+        saver = asyncio.create_task(self._save_periodically())
+        workers = [asyncio.create_task(self._worker(fd)) for _ in range(self.connections)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            saver.cancel()
+            os.close(fd)
+            self._save_state()
+
+        self._report(force=True)
+        os.replace(self.part_path, self.filepath)
+        os.remove(self.map_path)
+        return self.filepath
+
+
+def _prepare_format_filename(ydl_opts, info, fmt):
+    """按输出模板生成某个格式的文件名，与yt-dlp下载时使用的文件名一致"""
+    with yt_dlp.YoutubeDL({
+        "outtmpl": ydl_opts["outtmpl"],
+        "restrictfilenames": ydl_opts.get("restrictfilenames", False),
+        "quiet": True
+    }) as ydl:
+        return ydl.prepare_filename({**info, **fmt})
+
+
+async def segmented_format_download(task_id, info, fmt, ydl_opts, progress_hook):
+    """用分段下载器下载已解析出的单个格式，返回值与ytdlp_pool.download一致"""
+    filepath = await video_info_cache.run(_prepare_format_filename, ydl_opts, info, fmt)
+    summary = {key: info.get(key) for key in ("id", "title", "uploader", "duration")}
+    if os.path.exists(filepath) and os.path.getsize(filepath) == fmt["filesize"]:
+        progress_hook({"status": "finished", "filename": filepath})
+        return {**summary, "filepaths": [filepath]}
+
+    track_partial_file(task_id, filepath + ".part")
+    downloader = SegmentedDownloader(
+        fmt["url"], filepath, fmt["filesize"],
+        headers=fmt.get("http_headers"),
+        verify_ssl=not ydl_opts.get("nocheckcertificate"),
+        progress_callback=progress_hook,
+        should_stop=lambda: is_task_interrupted(task_id),
+        throttle=partial(bandwidth_manager.consume, task_id)
+    )
+    start = time.time()
+    await downloader.run()
+    download_log.info(f"[任务 {task_id[:8]}] 分段下载完成 {format_size(fmt['filesize'])}，耗时 {time.time() - start:.1f} 秒: {filepath}")
+    progress_hook({"status": "finished", "filename": filepath})
+    return {**summary, "filepaths": [filepath]}
+
+
+# ==================== 音视频流并行下载 ====================
+# 选中的格式由分离的视频流和音频流组成时，两个流分别提交给进程池，有空闲工作进程时同时下载，
+# 再用ffmpeg直接复制流合并（不重新编码）
+PARALLEL_STREAMS_ENABLED = True
+# 分离流的文件名中带有格式ID，例如 title-id.f137.mp4
+STREAM_FORMAT_SUFFIX = re.compile(r"\.f[^.]+\.[^.]+$")
+
+
+def _resolve_video_formats(video_url, ydl_opts):
+    """在提取线程中运行：解析视频信息并按格式选择器选出要下载的格式，不下载"""
+    opts = {key: value for key, value in ydl_opts.items() if key in (
+        "format", "merge_output_format", "socket_timeout", "cachedir", "nocheckcertificate", "ffmpeg_location"
+    )}
+    opts.update({"quiet": True, "no_warnings": True, "noplaylist": True})
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        return ydl.sanitize_info(ydl.extract_info(video_url, download=False))
+
+
+class StreamProgressAggregator:
+    """把同时下载的多个流的进度合并为一个，交给任务的DownloadProgressHook"""
+    def __init__(self, hook, expected_sizes):
+        self.hook = hook
+        self.streams = {stream: {"total_bytes": size or 0} for stream, size in expected_sizes.items()}
+        self.finished = set()
+
+    def for_stream(self, stream):
+        return lambda d: self.update(stream, d)
+
+    def update(self, stream, d):
+        state = self.streams[stream]
+        if d.get("status") == "finished":
+            self.finished.add(stream)
+            state["downloaded_bytes"] = state.get("total_bytes") or state.get("downloaded_bytes") or 0
+            state["speed"] = 0
+            state["eta"] = None
+            if len(self.finished) < len(self.streams):
+                return
+        elif d.get("status") == "downloading":
+            state["downloaded_bytes"] = d.get("downloaded_bytes") or 0
+            state["total_bytes"] = d.get("total_bytes") or d.get("total_bytes_estimate") or state.get("total_bytes") or 0
+            state["speed"] = d.get("speed") or 0
+            state["eta"] = d.get("eta")
+        else:
+            self.hook(d)
+            return
+
+        merged = {
+            "status": "finished" if len(self.finished) == len(self.streams) else "downloading",
+            "downloaded_bytes": sum(s.get("downloaded_bytes", 0) for s in self.streams.values()),
+            "total_bytes": sum(s.get("total_bytes", 0) for s in self.streams.values()),
+            "speed": sum(s.get("speed", 0) for s in self.streams.values()),
+            "elapsed": d.get("elapsed"),
+            "filename": d.get("filename"),
+            "tmpfilename": d.get("tmpfilename")
+        }
+        etas = [s["eta"] for s in self.streams.values() if s.get("eta") is not None]
+        if etas:
+            merged["eta"] = max(etas)
+        self.hook(merged)
+
+
+async def merge_streams(task_id, video_path, audio_path, output_path, ffmpeg_path, duration=None):
+    """用ffmpeg直接复制视频流和音频流合并为一个文件，合并进度作为单独的阶段报告"""
+    temp_path = output_path.with_name(f"{output_path.stem}.temp{output_path.suffix}")
+    cmd = [
+        ffmpeg_path, "-y", "-nostdin", "-loglevel", "error", "-nostats", "-progress", "pipe:1",
+        "-i", str(video_path), "-i", str(audio_path),
+        "-map", "0:v:0", "-map", "1:a:0", "-c", "copy", str(temp_path)
+    ]
+    if task_store.is_active(task_id):
+        task_store.update(task_id, {
+            "status": "postprocessing",
+            "message": "正在合并视频和音频..."
+        })
+    set_task_phase(task_id, "merge")
+    track_partial_file(task_id, temp_path)
+
+    merge_start = time.time()
+    process = YtdlpProcess(cmd)
+    await process.start()
+    attach_task_process(task_id, process)
+    while True:
+        line = await process.readline()
+        if line is None:
+            break
+        # ffmpeg的-progress输出为key=value，out_time_us为已处理的时长（微秒）
+        if duration and line.startswith("out_time_us=") and task_store.is_active(task_id):
+            try:
+                fraction = min(1.0, int(line.split("=", 1)[1]) / 1_000_000 / duration)
+            except ValueError:
+                continue
+            task_store.update(task_id, {
+                "message": f"正在合并视频和音频... {fraction * 100:.0f}%"
+            })
+    await process.wait()
+
+    if is_task_interrupted(task_id):
+        raise DownloadInterrupted("合并已被用户中断")
+    if process.returncode != 0:
+        raise Exception(f"合并视频和音频失败: {process.stderr_text()[-500:]}")
+    os.replace(temp_path, output_path)
+    for path in (video_path, audio_path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            download_log.warning(f"删除已合并的流文件失败: {path}: {e}")
+    download_log.info(f"[任务 {task_id[:8]}] 合并完成，耗时 {time.time() - merge_start:.1f} 秒: {output_path}")
+    return str(output_path)
+
+
+async def parallel_stream_download(task_id, video_url, ydl_opts, info, progress_hook, ffmpeg_path):
+    """同时下载已选出的视频流和音频流并合并，返回值与ytdlp_pool.download一致"""
+    video_format, audio_format = info["requested_formats"]
+    stream_opts = dict(ydl_opts)
+    stream_opts.pop("merge_output_format", None)
+    stream_opts["outtmpl"] = ydl_opts["outtmpl"][:-len(".%(ext)s")] + ".f%(format_id)s.%(ext)s"
+
+    aggregator = StreamProgressAggregator(progress_hook, {
+        "video": video_format.get("filesize") or video_format.get("filesize_approx"),
+        "audio": audio_format.get("filesize") or audio_format.get("filesize_approx")
+    })
+    async def fetch(stream, fmt):
+        opts = {**stream_opts, "format": fmt["format_id"]}
+        check_task_interrupted(task_id)
+        if can_segment_download(fmt):
+            try:
+                return await segmented_format_download(task_id, info, fmt, opts, aggregator.for_stream(stream))
+            except RangeNotSupported:
+                download_log.info(f"[任务 {task_id[:8]}] 服务器不支持分段下载，交给yt-dlp下载{stream}流")
+        return await ytdlp_pool.download(
+            task_id, video_url, opts, aggregator.for_stream(stream), info=info, stream=stream
+        )
+
+    results = await asyncio.gather(
+        fetch("video", video_format), fetch("audio", audio_format), return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+    video_path = next(iter(results[0]["filepaths"]), None)
+    audio_path = next(iter(results[1]["filepaths"]), None)
+    if not video_path or not audio_path:
+        raise Exception("视频流或音频流下载后未找到文件")
+    merge_ext = ydl_opts.get("merge_output_format") or Path(video_path).suffix[1:]
+    output_path = Path(STREAM_FORMAT_SUFFIX.sub(f".{merge_ext}", video_path))
+    output_file = await merge_streams(task_id, video_path, audio_path, output_path, ffmpeg_path, info.get("duration"))
+    return {**results[0], "filepaths": [output_file]}
+
+
+# 使用进程池下载视频，返回值与direct_download_with_ytdlp一致
+async def pooled_download_with_ytdlp(video_url, task_id, output_dir, video_quality="best", format_type="video", download_path=None):
+    output_dir_path = Path(output_dir).resolve()
+    try:
+        output_dir_path.mkdir(parents=True, exist_ok=True)
+    except Exception as e:
+        download_log.warning(f"无法创建指定的下载目录: {e}，回退到默认videos目录")
+        output_dir_path = VIDEOS_DIR.resolve()
+        output_dir_path.mkdir(parents=True, exist_ok=True)
+    output_dir = str(output_dir_path)
+
+    if task_store.is_active(task_id):
+        task_store.update(task_id, {
+            "message": f"将下载到目录: {output_dir}"
+        })
+
+    if format_type == "audio":
+        ffmpeg_path = await get_ffmpeg_path_async()
+        if not ffmpeg_path:
+            raise Exception("下载MP3格式需要ffmpeg工具。请安装ffmpeg后重试，或选择其他格式。")
+    else:
+        # 视频格式有ffmpeg时才能选择分离的视频流和音频流
+        ffmpeg_path = get_ffmpeg_path()
+
+    ydl_opts = build_ytdlp_options(output_dir, video_url, format_type, ffmpeg_path, video_quality)
+    progress_hook = DownloadProgressHook(task_id)
+    resolved = None
+    if PARALLEL_STREAMS_ENABLED and format_type != "audio" and ffmpeg_path:
+        # 先选出要下载的格式，下载时直接使用解析结果，不再重复解析
+        check_task_interrupted(task_id)
+        try:
+            resolved = await video_info_cache.run(_resolve_video_formats, video_url, ydl_opts)
+            video_info_cache.store(video_info_key(video_url), video_url, _summarize_video_info(resolved))
+        except Exception as e:
+            download_log.warning(f"[任务 {task_id[:8]}] 预先解析格式失败，交给yt-dlp直接下载: {e}")
+        # 解析期间没有进度回调，暂停或取消只能在解析结束后发现
+        check_task_interrupted(task_id)
+    if resolved is not None and len(resolved.get("requested_formats") or []) == 2:
+        info = await parallel_stream_download(task_id, video_url, ydl_opts, resolved, progress_hook, ffmpeg_path)
+    else:
+        info = await ytdlp_pool.download(task_id, video_url, ydl_opts, progress_hook, info=resolved)
+
+    output_file = next((path for path in info["filepaths"] if os.path.exists(path)), None)
+    if not output_file:
+        raise Exception("下载已结束，但未找到输出文件")
+
+    video_info = {
+        "title": info.get("title") or os.path.basename(output_file),
+        "uploader": info.get("uploader") or "未知上传者",
+        "duration": info.get("duration") or 0
+    }
+    if task_store.is_active(task_id):
+        task_store.update(task_id, {
+            **video_info,
+            **download_finished_fields(task_id, output_file),
+            "actual_download_dir": output_dir,
+            "speed_str": "下载完成"
+        })
+
+    await db.run(
+        save_download_record,
+        video_info={**video_info, "id": info.get("id")},
+        file_path=output_file,
+        format_info=f"{format_type.upper()} - {video_quality}",
+        download_path=download_path,
+        actual_download_dir=output_dir
+    )
+    return output_dir, output_file
+
+
+# 选择下载执行方式：优先使用进程池，进程池不可用或崩溃时回退到命令行子进程
+async def run_ytdlp_download(video_url, task_id, output_dir, video_quality="best", format_type="video", download_path=None):
+    if ytdlp_pool.available:
+        try:
+            return await pooled_download_with_ytdlp(
+                video_url, task_id, output_dir, video_quality, format_type, download_path
+            )
+        except BrokenProcessPool:
+            download_log.warning("yt-dlp进程池已崩溃，回退到命令行下载方式")
+    return await direct_download_with_ytdlp(
+        video_url, task_id, output_dir, video_quality, format_type, download_path
+    )
+
+
+# ==================== 相同下载合并 ====================
+# 相同视频、相同格式的下载只执行一次：进行中的下载由后来的相同任务共享，
+# 已完成的下载记录在artifacts表中，之后的任务直接硬链接（不支持时复制）到各自的下载目录
+DEDUP_ENABLED = True
+# 等待共享下载时检查主任务进度和自身暂停/取消状态的间隔（秒）
+DEDUP_POLL_INTERVAL = 0.5
+# 共享的下载被中断、或文件在链接前被删除时，最多重新尝试的次数
+DEDUP_MAX_ATTEMPTS = 3
+# 等待共享下载时从主任务同步的字段
+_DEDUP_PROGRESS_FIELDS = (
+    "progress", "speed", "speed_str", "eta", "eta_str", "downloaded_bytes",
+    "title", "uploader", "duration"
+)
+
+# (视频ID, 格式) -> (主任务ID, 下载结果Future)，只在事件循环线程中访问
+inflight_downloads = {}
+
+
+def download_dedup_key(video_url, format_type, video_quality):
+    """单个视频的下载返回(视频ID, 格式)，播放列表等无法确定下载内容的返回None"""
+    if "list=" in video_url:
+        return None
+    match = VIDEO_ID_IN_URL.search(video_url)
+    if not match:
+        return None
+    return match.group(1), f"{format_type}:{video_quality}"
+
+
+def find_artifact(key):
+    """查找已完成的相同下载，文件已不存在或大小不符时删除该记录并返回None"""
+    row = db.fetchone(
+        "SELECT filepath, filesize_bytes, title, uploader, duration_seconds FROM artifacts "
+        "WHERE video_id = ? AND format_key = ?",
+        key
+    )
+    if row is None:
+        return None
+    filepath, filesize_bytes, title, uploader, duration = row
+    try:
+        if os.path.getsize(filepath) == filesize_bytes:
+            return {
+                "filepath": filepath,
+                "filesize_bytes": filesize_bytes,
+                "title": title,
+                "uploader": uploader,
+                "duration": duration
+            }
+    except OSError:
+        pass
+    db.submit_write(lambda conn: conn.execute(
+        "DELETE FROM artifacts WHERE video_id = ? AND format_key = ? AND filepath = ?",
+        (*key, filepath)
+    ))
+    return None
+
+
+async def record_artifact(key, filepath, task_id):
+    """记录完成的下载供之后的相同任务复用，返回记录的内容"""
+    record = task_store.get(task_id)
+    artifact = {
+        "filepath": filepath,
+        "filesize_bytes": os.path.getsize(filepath),
+        "title": record.get("title") if record else None,
+        "uploader": record.get("uploader") if record else None,
+        "duration": record.get("duration") if record else None
+    }
+
+    def save(conn):
+        conn.execute(
+            "INSERT OR REPLACE INTO artifacts (video_id, format_key, filepath, filesize_bytes, "
+            "title, uploader, duration_seconds, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (*key, filepath, artifact["filesize_bytes"], artifact["title"],
+             artifact["uploader"], artifact["duration"], time.time())
+        )
+
+    try:
+        await db.awrite(save)
+    except Exception as e:
+        download_log.warning(f"记录已下载文件失败: {e}")
+    return artifact
+
+
+def link_artifact(source, output_dir):
+    """把已下载的文件硬链接到目标目录，不支持硬链接时（跨分区等）复制，返回目标路径"""
+    source = Path(source).resolve()
+    target = Path(output_dir).resolve() / source.name
+    if target == source:
+        return str(target)
+    source_size = source.stat().st_size
+    if target.exists():
+        if target.stat().st_size == source_size:
+            return str(target)
+        raise FileExistsError(f"目标目录中已存在同名文件: {target}")
+    target.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+    return str(target)
+
+
+async def serve_artifact(artifact, task_id, output_dir, video_quality, format_type, download_path):
+    """使用已下载的文件完成任务，返回值与run_ytdlp_download一致"""
+    loop = asyncio.get_running_loop()
+    output_file = await loop.run_in_executor(None, link_artifact, artifact["filepath"], output_dir)
+    output_dir = str(Path(output_file).parent)
+    control = task_controls.get(task_id)
+    if control is not None:
+        # 目标目录就是原文件所在目录时返回的是原文件本身，不属于这个任务
+        control.shared_files.add(output_file)
+    download_log.info(f"[任务 {task_id[:8]}] 复用已下载的文件: {artifact['filepath']} -> {output_file}")
+
+    video_info = {key: artifact[key] for key in ("title", "uploader", "duration") if artifact.get(key)}
+    if task_store.is_active(task_id):
+        task_store.update(task_id, {
+            **video_info,
+            **download_finished_fields(task_id, output_file, "下载已完成!（使用已下载的相同文件）"),
+            "actual_download_dir": output_dir,
+            "speed_str": "下载完成"
+        })
+
+    await db.run(
+        save_download_record,
+        video_info=video_info,
+        file_path=output_file,
+        format_info=f"{format_type.upper()} - {video_quality}",
+        download_path=download_path,
+        actual_download_dir=output_dir
+    )
+    return output_dir, output_file
+
+
+async def wait_for_shared_download(task_id, leader_id, future):
+    """等待相同的下载完成，期间同步主任务的进度；自身被暂停或取消时抛出DownloadInterrupted"""
+    if task_store.is_active(task_id):
+        task_store.update(task_id, {
+            "status": "downloading",
+            "message": "相同的视频正在下载，完成后直接使用该文件..."
+        })
+    while True:
+        done, _ = await asyncio.wait({future}, timeout=DEDUP_POLL_INTERVAL)
+        if is_task_interrupted(task_id):
+            raise DownloadInterrupted("任务已暂停或取消")
+        if done:
+            return future.result()
+        leader = task_store.get(leader_id)
+        if leader is not None and task_store.is_active(task_id):
+            task_store.update(task_id, {
+                field: leader.get(field) for field in _DEDUP_PROGRESS_FIELDS if leader.get(field) is not None
+            })
+
+
+async def lead_download(key, video_url, task_id, output_dir, video_quality, format_type, download_path):
+    """执行下载，并把结果共享给同时发起的相同任务"""
+    future = asyncio.get_running_loop().create_future()
+    inflight_downloads[key] = (task_id, future)
+    try:
+        result = await run_ytdlp_download(
+            video_url, task_id, output_dir, video_quality, format_type, download_path
+        )
+        try:
+            future.set_result(await record_artifact(key, result[1], task_id))
+        except OSError as e:
+            # 无法确认下载的文件，等待中的任务各自重新下载
+            download_log.warning(f"无法记录已下载的文件: {e}")
+            future.set_exception(DownloadInterrupted(str(e)))
+            future.exception()
+        return result
+    except BaseException as e:
+        if not future.done():
+            # 主任务被暂停或取消时，等待中的任务会自行重新下载
+            if isinstance(e, (DownloadInterrupted, asyncio.CancelledError)) or is_task_interrupted(task_id):
+                future.set_exception(DownloadInterrupted(str(e)))
+            else:
+                future.set_exception(e)
+            future.exception()  # 没有等待者时避免"exception was never retrieved"警告
+        raise
+    finally:
+        if inflight_downloads.get(key, (None,))[0] == task_id:
+            del inflight_downloads[key]
+
+
+# 带重复下载合并的下载入口，返回值与run_ytdlp_download一致
+async def deduplicated_download(video_url, task_id, output_dir, video_quality="best", format_type="video", download_path=None, compress_to_zip=False):
+    key = download_dedup_key(video_url, format_type, video_quality) if DEDUP_ENABLED else None
+    if key is None:
+        return await run_ytdlp_download(
+            video_url, task_id, output_dir, video_quality, format_type, download_path
+        )
+    # 生成ZIP文件的任务打包后会删除自己下载的文件，因此只复用已有的下载，自己的下载不共享给其他任务
+    can_lead = not (compress_to_zip and ZIP_PACKAGING_MODE == "file")
+
+    for _ in range(DEDUP_MAX_ATTEMPTS):
+        artifact = await db.run(find_artifact, key)
+        if artifact is None:
+            inflight = inflight_downloads.get(key)
+            if inflight is None:
+                if not can_lead:
+                    return await run_ytdlp_download(
+                        video_url, task_id, output_dir, video_quality, format_type, download_path
+                    )
+                return await lead_download(
+                    key, video_url, task_id, output_dir, video_quality, format_type, download_path
+                )
+            try:
+                artifact = await wait_for_shared_download(task_id, *inflight)
+            except DownloadInterrupted:
+                if is_task_interrupted(task_id):
+                    raise
+                download_log.info(f"[任务 {task_id[:8]}] 共享的下载已中断，重新尝试")
+                continue
+        try:
+            return await serve_artifact(artifact, task_id, output_dir, video_quality, format_type, download_path)
+        except OSError as e:
+            download_log.warning(f"[任务 {task_id[:8]}] 无法使用已下载的文件，重新尝试: {e}")
+
+    return await run_ytdlp_download(
+        video_url, task_id, output_dir, video_quality, format_type, download_path
+    )
+
+
+# ==================== ZIP打包 ====================
+# 视频、音频、图片本身已是压缩格式，再次deflate几乎不能减小体积，只浪费CPU，直接存储
+ZIP_STORED_EXTENSIONS = {
+    ".mp4", ".webm", ".mkv", ".mov", ".flv", ".3gp", ".avi",
+    ".mp3", ".m4a", ".opus", ".ogg", ".aac", ".flac", ".wav",
+    ".jpg", ".jpeg", ".png", ".webp", ".gif", ".zip"
+}
+# 打包时每次读写的块大小
+ZIP_COPY_CHUNK_SIZE = 1024 * 1024
+# ZIP打包方式: "file" 在下载目录生成ZIP文件; "stream" 不生成ZIP文件，通过/archive/{task_id}下载时实时打包
+ZIP_PACKAGING_MODE = "file"
+# 流式响应中等待发送的数据块数量上限，客户端读取较慢时打包线程会等待
+ZIP_STREAM_QUEUE_SIZE = 16
+
+
+class ZipStreamClosed(Exception):
+    """流式打包的接收方已断开"""
+
+
+class _ZipStreamSink(io.RawIOBase):
+    """不可定位的输出流，zipfile写入的数据交给回调；zipfile检测到不可定位时会使用数据描述符"""
+
+    def __init__(self, put):
+        self._put = put
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._put(bytes(data))
+        return len(data)
+
+
+def collect_task_files(task_id, output_file):
+    """
+    返回任务下载产生的文件：输出文件，以及任务记录的未完成文件中已经完成并保留下来的文件（例如提取音频时保留的原视频）。
+    不扫描目录，同一目录中其他下载留下的同名文件不会被包括
+    """
+    output = Path(output_file)
+    files = [output] if output.is_file() else []
+    control = task_controls.get(task_id)
+    for partial_file in sorted(control.partial_files) if control is not None else ():
+        path = Path(partial_file)
+        if path.name.endswith(".part"):
+            path = path.with_name(path.name[:-len(".part")])
+        if path.suffix.lower() in (".ytdl", ".segments", ".zip") or path in files or not path.is_file():
+            continue
+        files.append(path)
+    return files
+
+
+def task_created_files(task_id, files):
+    """
+    files中由任务自己的下载创建的文件，打包后可以删除。
+    复用的其他任务的文件、yt-dlp发现已存在而没有下载的文件（任务没有记录任何未完成文件）都不包括
+    """
+    control = task_controls.get(task_id)
+    if control is None or not control.partial_files:
+        return set()
+    return {Path(path) for path in files if str(path) not in control.shared_files}
+
+
+def write_zip_entries(fileobj, files, remove_sources=(), on_entry=None, should_stop=None):
+    """
+    将文件逐个以流的方式写入ZIP：媒体文件使用ZIP_STORED，其他文件使用ZIP_DEFLATED，超过4GB的文件自动使用ZIP64。
+    remove_sources中的文件写入后立即删除，打包期间额外占用的磁盘空间不超过一个文件。
+    should_stop()返回True时中止打包；已经删除原文件后不再中止，否则中止时会丢失已删除的文件。
+    """
+    removed = False
+    with zipfile.ZipFile(fileobj, "w", allowZip64=True) as zf:
+        for index, path in enumerate(files):
+            path = Path(path)
+            zinfo = zipfile.ZipInfo.from_file(path, arcname=path.name)
+            if path.suffix.lower() in ZIP_STORED_EXTENSIONS:
+                zinfo.compress_type = zipfile.ZIP_STORED
+            else:
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+            with open(path, "rb") as src, zf.open(zinfo, "w") as dst:
+                while True:
+                    if not removed and should_stop is not None and should_stop():
+                        raise ZipStreamClosed("打包已中止")
+                    chunk = src.read(ZIP_COPY_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+            if path in remove_sources:
+                path.unlink()
+                removed = True
+            if on_entry is not None:
+                on_entry(index + 1, len(files), path)
+
+
+def package_files_to_zip(files, zip_path, part_path, remove_sources=(), on_entry=None, should_stop=None):
+    """将文件打包到zip_path（先写入part_path再改名），remove_sources中的原文件在写入后删除，返回ZIP文件大小"""
+    zip_path = Path(zip_path)
+    part_path = Path(part_path)
+    try:
+        with open(part_path, "wb") as f:
+            write_zip_entries(f, files, remove_sources=remove_sources, on_entry=on_entry, should_stop=should_stop)
+        os.replace(part_path, zip_path)
+    except BaseException:
+        try:
+            part_path.unlink()
+        except OSError:
+            pass
+        raise
+    return zip_path.stat().st_size
+
+
+async def package_task_zip(task_id, output_file, files, video_info=None, format_info=None, download_path=None):
+    """在线程池中把任务下载的文件打包成ZIP，逐个文件更新进度；只删除任务自己下载的原文件，返回ZIP文件路径"""
+    loop = asyncio.get_running_loop()
+    if not files:
+        raise FileNotFoundError(f"找不到需要打包的文件: {output_file}")
+    zip_path = Path(output_file).with_suffix(".zip")
+    # 同一目录中相同视频的ZIP任务可能同时打包，各自写入带任务ID的临时文件
+    part_path = zip_path.with_name(f"{zip_path.name}.{task_id}.part")
+    track_partial_file(task_id, part_path)
+    remove_sources = task_created_files(task_id, files)
+
+    if task_id in task_store:
+        task_store.update(task_id, {"message": f"正在创建ZIP归档（共{len(files)}个文件）..."})
+
+    def on_entry(done, total, path):
+        if task_id in task_store:
+            task_store.update(task_id, {"message": f"正在创建ZIP归档... {done}/{total} {path.name}"})
+
+    set_task_phase(task_id, "zip")
+    try:
+        zip_size = await loop.run_in_executor(
+            None, package_files_to_zip, files, zip_path, part_path, remove_sources,
+            on_entry, partial(is_task_interrupted, task_id)
+        )
+    finally:
+        get_task_metrics(task_id).finish()
+    zip_log.info(f"[任务 {task_id[:8]}] ZIP归档已创建: {zip_path} ({format_size(zip_size)})")
+
+    if video_info is not None:
+        await db.run(
+            save_download_record,
+            video_info=video_info,
+            file_path=str(zip_path),
+            format_info=format_info,
+            download_path=download_path,
+            actual_download_dir=str(zip_path.parent)
+        )
+    return str(zip_path)
+
+
+def download_finished_fields(task_id, output_file, message="下载已完成!"):
+    """
+    下载结束时更新到任务的字段
+    需要打包ZIP的任务保持postprocessing（打包期间仍可暂停或取消），由finish_zip_packaging在打包结束后设置completed和最终文件路径
+    """
+    task = task_store.get(task_id)
+    if task is not None and task.get("compress_to_zip"):
+        return {"status": "postprocessing", "message": "下载完成，正在准备打包...", "progress": 99}
+    return {"status": "completed", "message": message, "progress": 100, "filepath": output_file}
+
+
+def complete_zip_task(task_id, filepath, message):
+    """打包结束，任务进入completed"""
+    if task_store.is_active(task_id):
+        task_store.update(task_id, {"status": "completed", "message": message, "progress": 100, "filepath": filepath})
+
+
+async def finish_zip_packaging(task_id, output_file, video_quality, format_type, download_path=None):
+    """下载完成后按ZIP_PACKAGING_MODE打包，返回任务最终的文件路径；打包失败时保留已下载的文件"""
+    files = await asyncio.get_running_loop().run_in_executor(None, collect_task_files, task_id, output_file)
+    if task_id in task_store:
+        task_store.update(task_id, {"output_files": [str(path) for path in files]})
+    if ZIP_PACKAGING_MODE == "stream":
+        complete_zip_task(task_id, output_file, f"下载完成！可通过 /archive/{task_id} 下载ZIP归档")
+        return output_file
+
+    task = task_store.get(task_id)
+    video_info = {key: task.get(key) for key in ("title", "uploader", "duration")} if task is not None else {}
+    video_info["id"] = extract_video_id_from_path(str(output_file))
+    try:
+        zip_path = await package_task_zip(
+            task_id, output_file, files, video_info,
+            format_info=f"ZIP - {format_type.upper()} - {video_quality}",
+            download_path=download_path
+        )
+    except Exception as e:
+        if is_task_interrupted(task_id):
+            raise DownloadInterrupted(str(e))
+        zip_log.warning(f"创建ZIP归档时出错: {e}")
+        complete_zip_task(task_id, output_file, f"创建ZIP时出错: {str(e)}，但视频已下载成功")
+        return output_file
+
+    complete_zip_task(task_id, zip_path, "ZIP归档已创建，下载完成！")
+    return zip_path
+
+
+async def stream_zip_archive(files):
+    """在线程中把文件打包成ZIP并逐块产出，归档不落盘；客户端断开时打包线程随之结束"""
+    loop = asyncio.get_running_loop()
+    chunks = queue.Queue(maxsize=ZIP_STREAM_QUEUE_SIZE)
+    closed = threading.Event()
+
+    def put(item):
+        while not closed.is_set():
+            try:
+                chunks.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+        raise ZipStreamClosed("客户端已断开")
+
+    def produce():
+        try:
+            with io.BufferedWriter(_ZipStreamSink(put), buffer_size=ZIP_COPY_CHUNK_SIZE) as sink:
+                write_zip_entries(sink, files, should_stop=closed.is_set)
+        except ZipStreamClosed:
+            return
+        except Exception as e:
+            zip_log.warning(f"流式打包ZIP时出错: {e}")
+            try:
+                put(e)
+            except ZipStreamClosed:
+                return
+        try:
+            put(None)
+        except ZipStreamClosed:
+            pass
+
+    producer = loop.run_in_executor(None, produce)
+    try:
+        while True:
+            item = await loop.run_in_executor(None, chunks.get)
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        closed.set()
+        await asyncio.shield(producer)
+        # 唤醒可能仍在等待数据的读取线程
+        try:
+            chunks.put_nowait(None)
+        except queue.Full:
+            pass
+
+
+# 下载任务结果的ZIP归档：已生成ZIP文件时直接返回，否则实时打包下载的文件，不在磁盘上生成归档
+@app.get("/archive/{task_id}")
+async def download_archive(task_id: str):
+    task = task_store.get(task_id)
+    if task is None or task.get("status") != "completed" or not task.get("filepath"):
+        raise HTTPException(status_code=404, detail="任务不存在或尚未完成")
+    filepath = Path(task["filepath"])
+    if filepath.suffix.lower() == ".zip" and filepath.is_file():
+        return FileResponse(filepath, media_type="application/zip", filename=filepath.name)
+    # 只打包任务自己下载的文件（下载完成时记录），不包括目录中其他同名文件
+    files = [Path(path) for path in task.get("output_files") or [filepath] if os.path.isfile(path)]
+    if not files:
+        raise HTTPException(status_code=404, detail="下载的文件已不存在")
+    return StreamingResponse(
+        stream_zip_archive(files),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{quote(filepath.stem)}.zip"}
+    )
+
+
+# ==================== 任务控制（暂停/继续/取消） ====================
+class DownloadInterrupted(Exception):
+    """下载被用户暂停或取消"""
+
+
+class TaskControl:
+    """
+    单个下载任务的控制状态
+    暂停：终止yt-dlp并保留.part文件，释放调度器名额；继续：重新入队，yt-dlp从.part续传
+    取消：终止yt-dlp并删除未完成文件和临时目录
+    """
+    def __init__(self, task_id, video_url, video_quality, format_type, compress_to_zip, download_path, priority=0, client=None):
+        self.task_id = task_id
+        self.download_args = (video_url, task_id, video_quality, format_type, compress_to_zip, download_path)
+        self.video_url = video_url
+        self.priority = priority
+        self.client = client  # 发起请求的客户端，用于按客户端限速
+        self.state = "running"  # running / paused / cancelled
+        self.resume_requested = False
+        self.process = None  # 命令行方式下正在运行的YtdlpProcess
+        self.partial_files = set()
+        self.temp_dirs = set()
+        self.shared_files = set()  # 复用其他任务下载的文件，打包ZIP后不能删除
+
+    def interrupt(self):
+        """让正在运行的下载尽快停止"""
+        if self.process is not None:
+            self.process.terminate()
+        ytdlp_pool.set_control(self.task_id, self.state)
+
+
+# 任务ID -> TaskControl，只包含尚未结束的任务
+task_controls = {}
+
+
+def is_task_interrupted(task_id):
+    control = task_controls.get(task_id)
+    return control is not None and control.state != "running"
+
+
+def check_task_interrupted(task_id):
+    """任务已被暂停或取消时抛出DownloadInterrupted；用于进度回调开始之前的阶段（解析视频信息、提交到进程池）"""
+    if is_task_interrupted(task_id):
+        raise DownloadInterrupted("任务已暂停或取消")
+
+
+def attach_task_process(task_id, process):
+    """登记任务的yt-dlp子进程；如果任务已被暂停或取消则立即终止"""
+    control = task_controls.get(task_id)
+    if control is None:
+        return
+    control.process = process
+    if control.state != "running":
+        process.terminate()
+
+
+def track_partial_file(task_id, path):
+    """记录任务正在写入的文件，取消时用于清理，重启后用于续传"""
+    control = task_controls.get(task_id)
+    if control is not None and path and str(path) not in control.partial_files:
+        control.partial_files.add(str(path))
+        save_job_files(control)
+
+
+def track_temp_dir(task_id, path):
+    """记录任务使用的临时目录，取消时用于清理"""
+    control = task_controls.get(task_id)
+    if control is not None and str(path) not in control.temp_dirs:
+        control.temp_dirs.add(str(path))
+        save_job_files(control)
+
+
+def cleanup_task_files(partial_files, temp_dirs):
+    """删除未完成的下载文件（.part、.ytdl、分片）和临时目录，返回释放的字节数"""
+    freed = 0
+    for path in partial_files:
+        base = Path(path)
+        if base.name.endswith(".part"):
+            base = base.with_name(base.name[:-len(".part")])
+        candidates = [
+            base, base.with_name(base.name + ".part"), base.with_name(base.name + ".ytdl"),
+            base.with_name(base.name + ".segments")
+        ]
+        candidates.extend(base.parent.glob(glob_escape(base.name) + ".part-Frag*"))
+        for candidate in candidates:
+            try:
+                if candidate.is_file():
+                    freed += candidate.stat().st_size
+                    candidate.unlink()
+            except Exception as e:
+                task_log.warning(f"删除未完成文件失败: {candidate}: {e}")
+    for temp_dir in temp_dirs:
+        try:
+            temp_path = Path(temp_dir)
+            if temp_path.exists():
+                freed += sum(f.stat().st_size for f in temp_path.rglob("*") if f.is_file())
+                shutil.rmtree(temp_path, ignore_errors=True)
+        except Exception as e:
+            task_log.warning(f"删除临时目录失败: {temp_dir}: {e}")
+    return freed
+
+
+def submit_download_job(task_id):
+    """把任务交给调度器，队列已满时抛出QueueFullError"""
+    control = task_controls[task_id]
+    return download_scheduler.submit(
+        task_id,
+        lambda: run_controlled_download(task_id),
+        control.video_url,
+        priority=control.priority
+    )
+
+
+def mark_task_paused(task_id):
+    control = task_controls.get(task_id)
+    if task_store.is_active(task_id):
+        task_store.update(task_id, {
+            "status": "paused",
+            "paused": True,
+            "message": "下载已暂停，继续后将从已下载部分续传"
+        })
+    set_job_state(task_id, "paused")
+    if control is not None:
+        control.process = None
+        if control.resume_requested:
+            try:
+                resume_task(task_id)
+            except QueueFullError:
+                task_log.info(f"[任务 {task_id[:8]}] 下载队列已满，任务保持暂停")
+
+
+def finish_cancelled_task(task_id):
+    """结束已取消的任务：在后台删除未完成文件并标记为已取消"""
+    control = task_controls.pop(task_id, None)
+    ytdlp_pool.clear_control(task_id)
+    delete_job(task_id)
+    if task_store.is_active(task_id):
+        task_store.update(task_id, {
+            "status": "cancelled",
+            "cancelled": True,
+            "message": "下载已取消",
+            "end_time": time.time()
+        })
+    if control is not None and (control.partial_files or control.temp_dirs):
+        asyncio.get_running_loop().run_in_executor(
+            None, cleanup_task_files, set(control.partial_files), set(control.temp_dirs)
+        )
+
+
+def resume_task(task_id):
+    """重新把暂停的任务放入调度队列，队列已满时抛出QueueFullError并保持暂停"""
+    control = task_controls[task_id]
+    control.state = "running"
+    control.resume_requested = False
+    try:
+        queue_position = submit_download_job(task_id)
+    except QueueFullError:
+        control.state = "paused"
+        raise
+    ytdlp_pool.clear_control(task_id)
+    set_job_state(task_id, "queued")
+    if task_store.is_active(task_id):
+        task_store.update(task_id, {
+            "status": "queued",
+            "paused": False,
+            "message": "已恢复，等待调度..."
+        })
+    return queue_position
+
+
+async def run_controlled_download(task_id):
+    """调度器执行的任务入口：运行download_video，并根据控制状态处理暂停/取消"""
+    control = task_controls.get(task_id)
+    if control is None or control.state != "running":
+        return
+    lease_job(task_id)
+    bandwidth_manager.register(task_id, control.client)
+    try:
+        await download_video(*control.download_args)
+    except DownloadInterrupted:
+        pass
+    finally:
+        bandwidth_manager.unregister(task_id)
+        if control.state == "paused":
+            mark_task_paused(task_id)
+        elif control.state == "cancelled":
+            finish_cancelled_task(task_id)
+        else:
+            task_controls.pop(task_id, None)
+            ytdlp_pool.clear_control(task_id)
+            delete_job(task_id)
+
+
+# ==================== 持久化任务队列 ====================
+# 任务队列保存在downloads.db的jobs表中，服务重启（包括reload）后恢复未完成的下载，
+# yt-dlp会从保留的.part文件续传。同一个数据库只应由一个服务实例使用。
+# 任务租约时长（秒），运行中的任务定期续约，租约过期说明持有者已退出
+JOB_LEASE_SECONDS = 60
+# 租约续约及回收过期任务的间隔（秒）
+JOB_LEASE_RENEW_INTERVAL = 20
+# 任务最多执行的次数，超过后不再自动恢复（避免反复导致崩溃的任务无限重试）
+JOB_MAX_ATTEMPTS = 5
+# 当前服务实例的标识，作为租约持有者
+JOB_WORKER_ID = f"{platform.node()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def write_job(task_id, sql, params):
+    """把任务队列的写操作排入数据库写线程（按提交顺序执行，不等待结果），失败时记录日志"""
+    def report(future):
+        if future.exception() is not None:
+            task_log.warning(f"写入任务队列失败 [{task_id[:8]}]: {future.exception()}")
+
+    db.submit_write(lambda conn: conn.execute(sql, params)).add_done_callback(report)
+
+
+def persist_job(control, state="queued"):
+    """新任务写入任务队列"""
+    now = time.time()
+    video_url, task_id, video_quality, format_type, compress_to_zip, download_path = control.download_args
+    write_job(
+        task_id,
+        '''INSERT OR REPLACE INTO jobs
+           (task_id, video_url, video_quality, format_type, compress_to_zip, download_path,
+            priority, state, attempts, partial_files, temp_dirs, created_at, updated_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, ?, ?, ?, ?)''',
+        (task_id, video_url, video_quality, format_type, int(bool(compress_to_zip)), download_path,
+         control.priority, state, json.dumps(sorted(control.partial_files)),
+         json.dumps(sorted(control.temp_dirs)), now, now)
+    )
+
+
+def set_job_state(task_id, state):
+    """更新任务状态（queued/paused），并释放租约"""
+    write_job(
+        task_id,
+        "UPDATE jobs SET state = ?, lease_owner = NULL, lease_expires = NULL, updated_at = ? WHERE task_id = ?",
+        (state, time.time(), task_id)
+    )
+
+
+def lease_job(task_id):
+    """任务开始执行：标记为running，记录租约并增加执行次数"""
+    now = time.time()
+    write_job(
+        task_id,
+        '''UPDATE jobs SET state = 'running', attempts = attempts + 1,
+           lease_owner = ?, lease_expires = ?, updated_at = ? WHERE task_id = ?''',
+        (JOB_WORKER_ID, now + JOB_LEASE_SECONDS, now, task_id)
+    )
+
+
+def save_job_files(control):
+    """保存任务的未完成文件和临时目录列表"""
+    write_job(
+        control.task_id,
+        "UPDATE jobs SET partial_files = ?, temp_dirs = ?, updated_at = ? WHERE task_id = ?",
+        (json.dumps(sorted(control.partial_files)), json.dumps(sorted(control.temp_dirs)),
+         time.time(), control.task_id)
+    )
+
+
+def delete_job(task_id):
+    """任务结束（完成、出错或取消）后从队列中删除"""
+    write_job(task_id, "DELETE FROM jobs WHERE task_id = ?", (task_id,))
+
+
+def renew_job_leases():
+    """为本实例正在执行的任务续约"""
+    db.execute(
+        "UPDATE jobs SET lease_expires = ? WHERE state = 'running' AND lease_owner = ?",
+        (time.time() + JOB_LEASE_SECONDS, JOB_WORKER_ID)
+    )
+
+
+def fetch_recoverable_jobs():
+    """读取需要恢复的任务：排队中和已暂停的任务，以及租约已过期的运行中任务"""
+    def fetch_jobs(conn):
+        cursor = conn.cursor()
+        cursor.row_factory = sqlite3.Row
+        cursor.execute(
+            '''SELECT * FROM jobs
+               WHERE state IN ('queued', 'paused')
+                  OR (state = 'running' AND (lease_expires IS NULL OR lease_expires < ?))
+               ORDER BY priority DESC, created_at''',
+            (time.time(),)
+        )
+        return cursor.fetchall()
+
+    return db.read(fetch_jobs)
+
+
+def recover_jobs(rows):
+    """
+    恢复队列中未完成的任务（在事件循环线程中调用）
+    调度队列已满时剩余任务留在数据库中，等待下一次回收。返回恢复的任务数
+    """
+    recovered = 0
+    for row in rows:
+        task_id = row["task_id"]
+        if task_id in task_controls:
+            continue
+        if row["attempts"] >= JOB_MAX_ATTEMPTS:
+            task_log.info(f"[任务 {task_id[:8]}] 已执行 {row['attempts']} 次仍未完成，不再自动恢复")
+            delete_job(task_id)
+            continue
+        if not restore_job(row):
+            break
+        recovered += 1
+    return recovered
+
+
+def restore_job(row):
+    """根据队列记录重建任务状态并重新提交，队列已满时返回False"""
+    task_id = row["task_id"]
+    control = TaskControl(
+        task_id,
+        row["video_url"],
+        row["video_quality"],
+        row["format_type"],
+        bool(row["compress_to_zip"]),
+        row["download_path"],
+        priority=clamp_download_priority(row["priority"])
+    )
+    control.partial_files.update(json.loads(row["partial_files"] or "[]"))
+    control.temp_dirs.update(json.loads(row["temp_dirs"] or "[]"))
+    paused = row["state"] == "paused"
+
+    if task_id in task_store:
+        task_store.remove(task_id)
+    task_store.create(task_id, {
+        "video_url": row["video_url"],
+        "video_quality": row["video_quality"],
+        "format_type": row["format_type"],
+        "compress_to_zip": bool(row["compress_to_zip"]),
+        "download_path": row["download_path"],
+        "status": "paused" if paused else "queued",
+        "message": "下载已暂停，继续后将从已下载部分续传" if paused else "服务重启后恢复下载，等待调度...",
+        "progress": 0,
+        "start_time": time.time(),
+        "paused": paused,
+        "cancelled": False
+    })
+    task_controls[task_id] = control
+
+    if paused:
+        control.state = "paused"
+        return True
+    try:
+        submit_download_job(task_id)
+    except QueueFullError:
+        task_controls.pop(task_id, None)
+        task_store.remove(task_id)
+        return False
+    set_job_state(task_id, "queued")
+    task_log.info(f"[任务 {task_id[:8]}] 已从持久化队列恢复: {row['video_url']}")
+    return True
+
+
+async def maintain_job_leases():
+    """定期续约本实例的任务，并回收租约过期或尚未恢复的任务"""
+    while True:
+        await asyncio.sleep(JOB_LEASE_RENEW_INTERVAL)
+        try:
+            await db.run(renew_job_leases)
+            recover_jobs(await db.run(fetch_recoverable_jobs))
+        except Exception as e:
+            task_log.warning(f"维护任务队列出错: {e}")
+
+
+# 启动时恢复未完成的任务（在进程池启动之后执行）
+@app.on_event("startup")
+async def start_job_recovery():
+    try:
+        recovered = recover_jobs(await db.run(fetch_recoverable_jobs))
+        if recovered:
+            task_log.info(f"已从持久化队列恢复 {recovered} 个任务")
+    except Exception as e:
+        task_log.warning(f"恢复任务队列出错: {e}")
+    asyncio.create_task(maintain_job_leases())
+
+
+# 创建任务状态并交给调度器，队列已满时撤销任务并抛出QueueFullError，返回队列位置
+def enqueue_download(task_id, video_url, video_quality, format_type, compress_to_zip, download_path, priority=0, fields=None, client=None):
+    task_store.create(task_id, {
+        "video_url": video_url,
+        "video_quality": video_quality,
+        "format_type": format_type,
+        "compress_to_zip": compress_to_zip,
+        "download_path": download_path,
+        "status": "queued",
+        "message": "已加入下载队列，等待调度...",
+        "progress": 0,
+        "start_time": time.time(),
+        "paused": False,
+        "cancelled": False,
+        **(fields or {})
+    })
+
+    # 交给调度器，由调度器控制并发后再启动download_video
+    task_controls[task_id] = TaskControl(
+        task_id, video_url, video_quality, format_type, compress_to_zip, download_path,
+        priority=priority, client=client
+    )
+    persist_job(task_controls[task_id])
+    try:
+        return submit_download_job(task_id)
+    except QueueFullError:
+        del task_controls[task_id]
+        task_store.remove(task_id)
+        delete_job(task_id)
+        raise
+
+
+# ==================== 播放列表展开 ====================
+# 播放列表和频道先只获取条目列表（不解析每个视频），再把每个视频作为子任务交给调度器并行下载，
+# 父任务汇总子任务的进度。子任务已写入持久化队列，服务重启后会作为普通任务恢复，父任务不恢复。
+# 同一播放列表同时在队列中或正在下载的子任务数量上限，避免占满下载队列
+PLAYLIST_MAX_INFLIGHT = MAX_CONCURRENT_DOWNLOADS * 2
+# 单个视频下载失败时的最多尝试次数
+PLAYLIST_ITEM_MAX_ATTEMPTS = 3
+# 失败重试前的等待时间（秒），按已尝试次数递增；下载队列已满时也按此间隔重新提交
+PLAYLIST_RETRY_DELAY = 10
+# 条目本身是播放列表时（例如频道首页展开为"视频"、"Shorts"、"直播"标签页）继续展开的最大层数
+PLAYLIST_MAX_DEPTH = 3
+# 播放列表、频道链接
+PLAYLIST_URL_PATTERN = re.compile(
+    r"[?&]list=|/playlist\b|youtube\.com/(?:@[^/?#]+|channel/[^/?#]+|c/[^/?#]+|user/[^/?#]+)/?(?:videos|shorts|streams)?/?(?:[?#]|$)"
+)
+
+# 父任务ID -> PlaylistJob，只在事件循环线程中访问
+playlist_jobs = {}
+
+
+def is_playlist_url(video_url):
+    return bool(PLAYLIST_URL_PATTERN.search(video_url))
+
+
+def find_downloaded_video_ids(video_ids):
+    """返回已经下载过且文件仍然存在的视频ID"""
+    downloaded = set()
+    video_ids = list(video_ids)
+    for start in range(0, len(video_ids), 500):
+        chunk = video_ids[start:start + 500]
+        rows = db.fetchall(
+            f"SELECT DISTINCT video_id FROM downloads WHERE file_exists = 1 AND video_id IN ({','.join('?' * len(chunk))})",
+            chunk
+        )
+        downloaded.update(row[0] for row in rows)
+    return downloaded
+
+
+class PlaylistJob:
+    """播放列表父任务：逐步提交子任务、失败重试，并汇总子任务进度"""
+    def __init__(self, task_id, request, client=None):
+        self.task_id = task_id
+        self.request = request
+        self.client = client
+        self.pending = deque()  # 尚未提交的条目 (url, title)
+        self.active = set()  # 尚未结束的子任务（包括等待重试的）
+        self.attempts = {}  # 子任务ID -> 已尝试次数
+        self.states = {}  # 子任务ID -> 最近一次看到的状态，只处理状态变化
+        self.waiting_retry = set()  # 暂停期间到期的重试
+        self.total = 0
+        self.completed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.cancelled_items = 0
+        self.paused = False
+        self.cancelled = False
+        self.expand_task = None
+        self._feed_scheduled = False
+
+    async def expand(self):
+        task_store.update(self.task_id, {"status": "initializing", "message": "正在获取播放列表..."})
+        try:
+            await self._expand()
+        except Exception as e:
+            playlist_log.warning(f"[任务 {self.task_id[:8]}] 展开播放列表失败: {e}")
+            self.finish("error", f"获取播放列表失败: {e}")
+
+    async def _collect_entries(self, info, depth, seen, entries):
+        """
+        把播放列表中的视频加入entries，seen记录已展开的链接和已加入的视频ID。
+        条目本身是播放列表（如频道首页展开得到的"视频"、"Shorts"、"直播"标签页）时继续展开，而不是作为一个下载任务
+        """
+        is_playlist = info.get("_type") == "playlist"
+        for entry in (info.get("entries") or []) if is_playlist else [info]:
+            if not entry:
+                continue
+            video_id = entry.get("id")
+            entry_url = entry.get("url") or entry.get("webpage_url")
+            if is_playlist and (entry.get("_type") == "playlist" or (entry_url and is_playlist_url(entry_url))):
+                if entry.get("_type") != "playlist":
+                    # 只获取了链接的嵌套播放列表
+                    if not entry_url or entry_url in seen or depth >= PLAYLIST_MAX_DEPTH:
+                        continue
+                    seen.add(entry_url)
+                    try:
+                        entry = await video_info_cache.extract(entry_url, playlist=True)
+                    except Exception as e:
+                        playlist_log.warning(f"[任务 {self.task_id[:8]}] 展开 {entry_url} 失败: {e}")
+                        continue
+                    if self.cancelled:
+                        return
+                await self._collect_entries(entry, depth + 1, seen, entries)
+                continue
+            if video_id and len(video_id) == 11 and not (entry_url or "").startswith("http"):
+                entry_url = f"https://www.youtube.com/watch?v={video_id}"
+            if entry_url and video_id not in seen:
+                entries.append((video_id, entry_url, entry.get("title")))
+                if video_id:
+                    seen.add(video_id)
+
+    async def _expand(self):
+        url = self.request.video_url
+        info = await video_info_cache.extract(url, playlist=True)
+        entries = []
+        if not self.cancelled:
+            # 频道首页等嵌套的播放列表逐个展开，所有视频都作为独立的子任务
+            await self._collect_entries(info, 1, {url}, entries)
+        if self.cancelled:
+            self.finish("cancelled", "下载已取消")
+            return
+        if not entries:
+            self.finish("error", "播放列表中没有可下载的视频")
+            return
+
+        downloaded = await db.run(find_downloaded_video_ids, {video_id for video_id, _, _ in entries if video_id})
+        for video_id, entry_url, title in entries:
+            if video_id in downloaded:
+                self.skipped += 1
+            else:
+                self.pending.append((entry_url, title))
+        self.total = len(entries)
+        playlist_log.info(f"[任务 {self.task_id[:8]}] 播放列表共 {self.total} 个视频，其中 {self.skipped} 个已下载过")
+        task_store.update(self.task_id, {"status": "downloading", "title": info.get("title") or url})
+        self.feed()
+        self.refresh()
+
+    def feed(self):
+        """在同时进行的子任务数量上限内提交尚未提交的条目"""
+        self._feed_scheduled = False
+        request = self.request
+        while self.pending and not self.paused and not self.cancelled and len(self.active) < PLAYLIST_MAX_INFLIGHT:
+            entry_url, title = self.pending[0]
+            child_id = str(uuid.uuid4())
+            fields = {"parent_id": self.task_id}
+            if title:
+                fields["title"] = title
+            try:
+                enqueue_download(
+                    child_id, entry_url, request.video_quality, request.format_type,
+                    request.compress_to_zip, request.download_path, request.priority, fields,
+                    client=self.client
+                )
+            except QueueFullError:
+                # 下载队列已满，稍后再提交剩余条目
+                self._schedule_feed()
+                break
+            self.pending.popleft()
+            self.active.add(child_id)
+            self.attempts[child_id] = 1
+            self.states[child_id] = "queued"
+
+    def _schedule_feed(self):
+        if not self._feed_scheduled:
+            self._feed_scheduled = True
+            asyncio.get_running_loop().call_later(PLAYLIST_RETRY_DELAY, self.feed)
+
+    def child_changed(self, child_id, record):
+        """子任务状态变化时由TaskStore订阅回调调用"""
+        previous = self.states.get(child_id)
+        self.states[child_id] = record.status
+        if record.status != previous and child_id in self.active:
+            if record.status == "completed":
+                self.active.discard(child_id)
+                self.completed += 1
+            elif record.status == "cancelled":
+                self.active.discard(child_id)
+                self.cancelled_items += 1
+            elif record.status == "error":
+                if self.attempts[child_id] < PLAYLIST_ITEM_MAX_ATTEMPTS and not self.cancelled:
+                    delay = PLAYLIST_RETRY_DELAY * self.attempts[child_id]
+                    playlist_log.warning(f"[任务 {child_id[:8]}] 下载失败，{delay} 秒后重试: {record.get('error')}")
+                    asyncio.get_running_loop().call_later(delay, self.retry, child_id)
+                else:
+                    self.active.discard(child_id)
+                    self.failed += 1
+            if child_id not in self.active:
+                self.feed()
+        self.refresh()
+
+    def retry(self, child_id):
+        """重新提交失败的子任务，沿用原任务ID"""
+        record = task_store.get(child_id)
+        if self.cancelled or record is None or record.status != "error" or child_id in task_controls:
+            return
+        if self.paused:
+            self.waiting_retry.add(child_id)
+            return
+        request = self.request
+        self.attempts[child_id] += 1
+        DOWNLOAD_RETRIES.inc(error_class="playlist_item")
+        task_store.update(child_id, {
+            "status": "retrying",
+            "message": f"正在进行第 {self.attempts[child_id]} 次尝试...",
+            "progress": 0,
+            "error": None
+        })
+        task_controls[child_id] = TaskControl(
+            child_id, record.video_url, request.video_quality, request.format_type,
+            request.compress_to_zip, request.download_path, priority=request.priority, client=self.client
+        )
+        persist_job(task_controls[child_id])
+        try:
+            submit_download_job(child_id)
+        except QueueFullError:
+            del task_controls[child_id]
+            delete_job(child_id)
+            self.attempts[child_id] -= 1
+            task_store.update(child_id, {"status": "error", "message": "下载队列已满，等待重试"})
+            asyncio.get_running_loop().call_later(PLAYLIST_RETRY_DELAY, self.retry, child_id)
+
+    def refresh(self):
+        """根据子任务状态更新父任务的进度和统计"""
+        if not self.total:
+            return
+        finished = self.completed + self.failed + self.skipped + self.cancelled_items
+        partial = sum((task_store.get(child_id).get("progress", 0) if child_id in task_store else 0)
+                      for child_id in self.active) / 100
+        stats = {
+            "total": self.total,
+            "completed": self.completed,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "cancelled": self.cancelled_items,
+            "pending": len(self.pending),
+            "children": list(self.attempts)
+        }
+        if finished >= self.total or (self.cancelled and not self.active):
+            if self.cancelled:
+                self.finish("cancelled", "下载已取消", stats)
+            elif self.failed and not (self.completed or self.skipped):
+                self.finish("error", f"播放列表中的 {self.failed} 个视频全部下载失败", stats)
+            else:
+                message = f"播放列表下载完成：成功 {self.completed} 个，跳过已下载 {self.skipped} 个"
+                if self.failed:
+                    message += f"，失败 {self.failed} 个"
+                self.finish("completed", message, stats)
+            return
+        task_store.update(self.task_id, {
+            "progress": min(99, int((finished + partial) / self.total * 100)),
+            "message": f"播放列表：已完成 {self.completed + self.skipped}/{self.total}，失败 {self.failed}"
+                       + ("（已暂停）" if self.paused else ""),
+            "playlist": stats
+        })
+
+    def finish(self, status, message, stats=None):
+        playlist_jobs.pop(self.task_id, None)
+        fields = {"status": status, "message": message, "end_time": time.time()}
+        if status == "completed":
+            fields["progress"] = 100
+        if status == "error":
+            fields["error"] = message
+        if status == "cancelled":
+            fields["cancelled"] = True
+        if stats is not None:
+            fields["playlist"] = stats
+        task_store.update(self.task_id, fields)
+
+    async def pause(self):
+        self.paused = True
+        for child_id in list(self.active):
+            control = task_controls.get(child_id)
+            if control is not None and control.state == "running":
+                await pause_download(child_id)
+        task_store.update(self.task_id, {"paused": True})
+        self.refresh()
+
+    async def resume(self):
+        self.paused = False
+        for child_id in list(self.active):
+            control = task_controls.get(child_id)
+            if control is not None and control.state == "paused":
+                try:
+                    await resume_download(child_id)
+                except HTTPException as e:
+                    playlist_log.warning(f"[任务 {child_id[:8]}] 继续下载失败: {e.detail}")
+        for child_id in list(self.waiting_retry):
+            self.waiting_retry.discard(child_id)
+            self.retry(child_id)
+        task_store.update(self.task_id, {"paused": False})
+        self.feed()
+        self.refresh()
+
+    async def cancel(self):
+        self.cancelled = True
+        self.pending.clear()
+        task_store.update(self.task_id, {"message": "正在取消..."})
+        for child_id in list(self.active):
+            if child_id in task_controls:
+                await cancel_download(child_id)
+            else:
+                # 等待重试中的子任务直接结束
+                self.active.discard(child_id)
+                self.cancelled_items += 1
+        if self.expand_task is None or self.expand_task.done():
+            self.refresh()
+
+
+def playlist_task_changed(task_id, record):
+    if record.parent_id is None:
+        return
+    job = playlist_jobs.get(record.parent_id)
+    if job is not None:
+        job.child_changed(task_id, record)
+
+
+task_store.subscribe(playlist_task_changed)
+
+
+def start_playlist_download(task_id, request, client=None):
+    """创建播放列表父任务，在后台获取条目列表后提交子任务"""
+    task_store.create(task_id, {
+        "video_url": request.video_url,
+        "video_quality": request.video_quality,
+        "format_type": request.format_type,
+        "compress_to_zip": request.compress_to_zip,
+        "download_path": request.download_path,
+        "status": "queued",
+        "message": "正在获取播放列表...",
+        "progress": 0,
+        "start_time": time.time(),
+        "paused": False,
+        "cancelled": False
+    })
+    job = PlaylistJob(task_id, request, client)
+    playlist_jobs[task_id] = job
+    job.expand_task = asyncio.create_task(job.expand())
+    return job
 
 
 # 主页路由
@@ -1571,7 +4196,8 @@ async def index(request: Request,
                 search_text: str = None,
                 file_type: str = None,
                 start_date: str = None,
-                end_date: str = None):
+                end_date: str = None,
+                cursor: str = None):
     try:
         # 验证并转换页码
         page = max(1, int(page))
@@ -1580,24 +4206,19 @@ async def index(request: Request,
         if file_type and file_type.lower() == 'all':
             file_type = None
             
-        # 获取分页的下载历史
-        result = get_downloaded_videos(
+        # 获取分页的下载历史，同时获取最近的3个下载记录
+        result = await db.run(
+            get_downloaded_videos,
             page=page,
             page_size=10,
             start_date=start_date,
             end_date=end_date,
             search_text=search_text,
-            file_type=file_type
-        )
-        
-        # 获取最近的3个下载记录
-        recent_downloads = get_downloaded_videos(
-            limit_recent=3
+            file_type=file_type,
+            cursor=cursor,
+            include_recent=True
         )
         
-        # 合并结果
-        result["recent_videos"] = recent_downloads["videos"]
-        
         return templates.TemplateResponse(
             "index.html", 
             {
@@ -1607,7 +4228,7 @@ async def index(request: Request,
             }
         )
     except Exception as e:
-        print(f"处理首页请求时出错: {e}")
+        api_log.warning(f"处理首页请求时出错: {e}")
         return templates.TemplateResponse(
             "index.html", 
             {
@@ -1623,9 +4244,88 @@ async def index(request: Request,
         )
 
 
+# 下载历史JSON接口，使用游标分页：返回的next_cursor作为下一次请求的cursor参数
+@app.get("/api/history")
+async def api_history(cursor: str = None,
+                      page_size: int = 20,
+                      search_text: str = None,
+                      file_type: str = None,
+                      start_date: str = None,
+                      end_date: str = None,
+                      include_recent: bool = False):
+    page_size = max(1, min(100, page_size))
+    if file_type and file_type.lower() == 'all':
+        file_type = None
+    result = await db.run(
+        get_downloaded_videos,
+        page_size=page_size,
+        start_date=start_date,
+        end_date=end_date,
+        search_text=search_text,
+        file_type=file_type,
+        cursor=cursor,
+        include_recent=include_recent
+    )
+    # 游标分页不使用页码
+    result.pop("page", None)
+    return result
+
+
+# 获取视频信息（不下载），结果缓存后供下载任务复用
+@app.get("/info")
+async def get_video_info(url: str, refresh: bool = False):
+    if not url or "youtube.com" not in url and "youtu.be" not in url:
+        raise HTTPException(status_code=400, detail="请提供有效的YouTube视频链接")
+    try:
+        info, cached = await video_info_cache.get(url, refresh=refresh)
+    except Exception as e:
+        info_log.warning(f"获取视频信息失败: {e}")
+        raise HTTPException(status_code=502, detail=f"获取视频信息失败: {str(e)}")
+    return {"info": info, "cached": cached}
+
+
+# 保留策略状态：当前策略和最近一次清理的报告（清理的记录数、回收的字节数）
+@app.get("/api/retention")
+async def retention_status():
+    return {
+        "policies": retention_engine.policies,
+        "interval": RETENTION_INTERVAL,
+        "last_report": retention_engine.last_report
+    }
+
+
+# 带宽限制：查看当前上限和各任务分配到的速率
+@app.get("/admin/bandwidth")
+async def get_bandwidth_limits():
+    return bandwidth_manager.snapshot()
+
+
+# 带宽限制：运行时调整上限，只允许本机访问
+@app.post("/admin/bandwidth")
+async def set_bandwidth_limits(limits: BandwidthLimitsRequest, request: Request):
+    if request.client and request.client.host not in ("127.0.0.1", "::1", "localhost"):
+        raise HTTPException(status_code=403, detail="管理接口只允许本机访问")
+    values = [limits.global_limit, limits.task_limit, limits.client_limit]
+    if any(value is not None and value < 0 for value in values):
+        raise HTTPException(status_code=400, detail="带宽上限不能为负数")
+    bandwidth_manager.set_limits(limits.global_limit, limits.task_limit, limits.client_limit)
+    api_log.info(f"带宽上限已调整: 全局 {bandwidth_manager.global_limit}, 单任务 {bandwidth_manager.task_limit}, "
+          f"单客户端 {bandwidth_manager.client_limit} (字节/秒)")
+    return bandwidth_manager.snapshot()
+
+
+# 客户端可以指定的下载优先级范围，优先级由请求方自行提供且没有身份验证，限制范围避免任意插队
+DOWNLOAD_PRIORITY_MIN = 0
+DOWNLOAD_PRIORITY_MAX = 10
+
+
+def clamp_download_priority(priority):
+    return max(DOWNLOAD_PRIORITY_MIN, min(DOWNLOAD_PRIORITY_MAX, int(priority or 0)))
+
+
 # 下载视频路由
 @app.post("/download")
-async def download(request: DownloadRequest):
+async def download(request: DownloadRequest, http_request: Request):
     # 验证URL
     if not request.video_url or "youtube.com" not in request.video_url and "youtu.be" not in request.video_url:
         raise HTTPException(status_code=400, detail="请提供有效的YouTube视频链接")
@@ -1646,7 +4346,7 @@ async def download(request: DownloadRequest):
         if not ffmpeg_path:
             # 返回特殊状态码，前端可以显示友好提示
             # 不直接抛出异常，而是启动下载任务，让它尝试自动下载ffmpeg
-            print("音频下载请求，但未找到ffmpeg，将尝试自动下载")
+            api_log.warning("音频下载请求，但未找到ffmpeg，将尝试自动下载")
     
     # 验证下载路径
     if request.download_path:
@@ -1657,139 +4357,78 @@ async def download(request: DownloadRequest):
         except Exception as e:
             raise HTTPException(status_code=400, detail=f"无效的下载路径: {str(e)}")
     
+    # 限制优先级范围（播放列表的子任务沿用同一个值）
+    request.priority = clamp_download_priority(request.priority)
+    
     # 创建任务ID
     task_id = str(uuid.uuid4())
     
-    # 初始化任务状态
-    download_tasks[task_id] = {
-        "video_url": request.video_url,
-        "video_quality": request.video_quality,
-        "format_type": request.format_type,
-        "compress_to_zip": request.compress_to_zip,
-        "download_path": request.download_path,
-        "status": "starting",
-        "progress": 0,
-        "start_time": time.time(),
-        "paused": False,
-        "cancelled": False
-    }
+    client = http_request.client.host if http_request.client else None
     
-    # 启动异步下载任务
-    asyncio.create_task(download_video(
-        request.video_url,
-        task_id,
-        request.video_quality,
-        request.format_type,
-        request.compress_to_zip,
-        request.download_path
-    ))
+    # 播放列表和频道展开为多个子任务并行下载
+    if is_playlist_url(request.video_url):
+        start_playlist_download(task_id, request, client)
+        return {"task_id": task_id, "status": "started", "queue_position": None, "playlist": True}
+    
+    try:
+        queue_position = enqueue_download(
+            task_id,
+            request.video_url,
+            request.video_quality,
+            request.format_type,
+            request.compress_to_zip,
+            request.download_path,
+            priority=request.priority,
+            client=client
+        )
+    except QueueFullError as e:
+        raise HTTPException(
+            status_code=429,
+            detail="下载队列已满，请稍后重试",
+            headers={"Retry-After": str(e.retry_after)}
+        )
     
-    return {"task_id": task_id, "status": "started"}
+    return {"task_id": task_id, "status": "started", "queue_position": queue_position}
 
 
-# 获取下载进度
-@app.get("/progress/{task_id}")
-async def get_progress(task_id: str):
+# 生成任务的进度信息，供进度查询接口和进度推送流共用
+# 进度、速度、剩余时间都是实测值，没有数据时为null，不再生成估算值
+def build_progress_snapshot(task_id):
     # 安全获取进度信息
     try:
         # 先查找活跃任务
-        if task_id in download_tasks:
-            task = download_tasks[task_id]
-            
-            # 确保进度值始终合理且有变化
-            progress = task.get("progress", 0)
-            # 如果进度为0但状态是downloading，确保至少显示一些进度
-            if progress == 0 and task.get("status") == "downloading":
-                # 基于开始时间估算进度
-                elapsed = time.time() - task.get("start_time", time.time())
-                # 确保随着时间推移至少有一些进度显示，最多增加到40%
-                progress = min(40, elapsed / 2)  # 每2秒增加1%，最多40%
-                # 更新任务的进度值
-                task["progress"] = progress
-            elif progress < 15 and task.get("status") == "downloading" and time.time() - task.get("start_time", time.time()) > 10:
-                # 如果进度长时间低于15%，逐渐提高显示的进度值以提供用户反馈
-                progress = min(40, 15 + (time.time() - task.get("start_time", time.time()) - 10) / 5)
-                task["progress"] = progress
-            
-            # 确保速度信息被返回，且速度值永远不为零
-            speed = task.get("speed", 0)
-            # 如果速度为0，设置一个默认值
-            if speed == 0:
-                # 根据当前任务状态动态设置默认速度
-                if task.get("status") == "downloading":
-                    # 如果是下载中状态，设置一个随机但合理的速度
-                    # 根据进度计算速度基数 - 使用MB为单位
-                    base_speed = max(1048576, int(1048576 * (progress / 10))) if progress > 0 else 1048576
-                    # 添加随机变化 - 使用与MB单位匹配的变化量
-                    import random
-                    speed = base_speed + random.randint(0, 262144)  # 只使用正数变化
-                else:
-                    # 其他状态设置一个默认值
-                    speed = 1048576  # 默认1MB/s
-            
-            # 确保有可读的速度字符串
-            speed_str = task.get("speed_str", "")
-            if not speed_str or "0 B/s" in speed_str:
-                # 否则始终使用MB/s作为单位
-                speed_str = f"{speed/1048576:.1f} MB/s"
-            
-            # 确保ETA信息存在
-            eta_str = task.get("eta_str", "")
-            if not eta_str:
-                # 基于进度和速度估计剩余时间
-                if progress > 0 and progress < 100:
-                    elapsed = time.time() - task.get("start_time", time.time())
-                    if elapsed > 0:
-                        # 估算总时间和剩余时间
-                        total_time = elapsed / (progress / 100.0)
-                        remaining = total_time - elapsed
-                        # 格式化剩余时间
-                        if remaining < 60:
-                            eta_str = f"{int(remaining)}秒"
-                        elif remaining < 3600:
-                            eta_str = f"{int(remaining // 60)}分{int(remaining % 60)}秒"
-                        else:
-                            eta_str = f"{int(remaining // 3600)}时{int((remaining % 3600) // 60)}分"
-                    else:
-                        eta_str = "计算中..."
-                else:
-                    eta_str = "计算中..."
-            
-            # 记录每次请求的进度值，用于调试
-            print(f"进度API请求 - 任务ID: {task_id}, 进度值: {progress}%, 速度: {speed_str}")
+        task = task_store.get(task_id)
+        metrics = task_metrics.get(task_id)
+        if task_store.is_active(task_id):
+            # 排队中的任务返回队列位置
+            queue_position = download_scheduler.queue_position(task_id)
+            message = task.get("message", "未知状态")
+            if queue_position is not None:
+                message = f"排队中，前面还有 {queue_position - 1} 个任务"
             
             return {
                 "status": task.get("status", "unknown"),
-                "progress": progress,
-                "message": task.get("message", "未知状态"),
+                "progress": task.get("progress", 0),
+                "message": message,
+                "queue_position": queue_position,
                 "title": task.get("title", "未知标题"),
                 "duration": task.get("duration", 0),
                 "uploader": task.get("uploader", ""),
                 "filepath": task.get("filepath", ""),
                 "format_info": task.get("format_info", ""),
                 "error": task.get("error", ""),
-                "speed": speed,
-                "speed_str": speed_str,
-                "eta_str": eta_str,
+                "speed": task.get("speed"),
+                "speed_str": task.get("speed_str"),
+                "eta": task.get("eta"),
+                "eta_str": task.get("eta_str"),
+                "downloaded_bytes": task.get("downloaded_bytes"),
+                "metrics": metrics.snapshot() if metrics is not None else None,
+                "playlist": task.get("playlist"),
                 "active": True
             }
         
         # 再查找已完成任务
-        if task_id in completed_tasks:
-            task = completed_tasks[task_id]
-            # 确保速度信息被返回，且速度值永远不为零
-            speed = task.get("speed", 0)
-            # 如果速度为0，设置一个默认值
-            if speed == 0:
-                # 已完成任务使用固定速度值
-                speed = 1048576  # 默认1MB/s
-            
-            # 确保有可读的速度字符串
-            speed_str = task.get("speed_str", "")
-            if not speed_str or "0 B/s" in speed_str:
-                # 始终使用MB/s作为单位
-                speed_str = f"{speed/1048576:.1f} MB/s"
-            
+        if task is not None:
             # 已完成任务总是返回100%进度
             progress = 100 if task.get("status") == "completed" else task.get("progress", 0)
             
@@ -1803,9 +4442,14 @@ async def get_progress(task_id: str):
                 "filepath": task.get("filepath", ""),
                 "format_info": task.get("format_info", ""),
                 "error": task.get("error", ""),
-                "speed": speed,
-                "speed_str": speed_str,
-                "eta_str": task.get("eta_str", "已完成"),
+                "speed": None,
+                "speed_str": task.get("speed_str"),
+                "eta": None,
+                "eta_str": None,
+                "downloaded_bytes": task.get("downloaded_bytes"),
+                "metrics": metrics.snapshot() if metrics is not None else None,
+                "queue_position": None,
+                "playlist": task.get("playlist"),
                 "active": False
             }
         
@@ -1820,16 +4464,19 @@ async def get_progress(task_id: str):
             "filepath": "",
             "format_info": "",
             "error": "任务ID不存在",
-            "speed": 0,
-            "speed_str": "0 B/s",
-            "eta_str": "未知",
+            "speed": None,
+            "speed_str": None,
+            "eta": None,
+            "eta_str": None,
+            "downloaded_bytes": None,
+            "metrics": None,
+            "queue_position": None,
             "active": False
         }
     except Exception as e:
         # 捕获所有异常，提供友好的错误信息
-        print(f"获取进度信息时出错: {e}")
-        import traceback
-        print(traceback.format_exc())
+        api_log.warning(f"获取进度信息时出错: {e}")
+        api_log.debug("详细错误信息", exc_info=True)
         return {
             "status": "error",
             "progress": 0,
@@ -1840,13 +4487,148 @@ async def get_progress(task_id: str):
             "filepath": "",
             "format_info": "",
             "error": str(e),
-            "speed": 0,
-            "speed_str": "0 B/s",
-            "eta_str": "未知",
+            "speed": None,
+            "speed_str": None,
+            "eta": None,
+            "eta_str": None,
+            "downloaded_bytes": None,
+            "metrics": None,
+            "queue_position": None,
             "active": False
         }
 
 
+# ==================== 进度推送（Server-Sent Events） ====================
+# 推送合并间隔（秒）：同一任务在间隔内的多次更新只推送一次
+PROGRESS_STREAM_INTERVAL = 0.5
+PROGRESS_STREAM_MIN_INTERVAL = 0.1
+PROGRESS_STREAM_MAX_INTERVAL = 10
+# 没有更新时发送心跳的间隔（秒），防止代理断开空闲连接
+PROGRESS_STREAM_KEEPALIVE = 15
+
+
+class ProgressSubscription:
+    """一个进度推送连接，记录关注的任务和已推送的状态，用于计算增量"""
+    def __init__(self, task_ids, loop):
+        self.task_ids = set(task_ids) if task_ids else None  # None表示关注所有任务
+        self.loop = loop
+        self.changed = asyncio.Event()
+        self.pending = set()
+        self.last_sent = {}
+
+    def watches(self, task_id):
+        return self.task_ids is None or task_id in self.task_ids
+
+    def take_pending(self):
+        pending, self.pending = self.pending, set()
+        return pending
+
+    def diff(self, task_id, snapshot):
+        """返回与上次推送相比发生变化的字段"""
+        last = self.last_sent.get(task_id, {})
+        delta = {key: value for key, value in snapshot.items() if last.get(key) != value}
+        if delta:
+            self.last_sent[task_id] = snapshot
+        return delta
+
+
+class ProgressBroadcaster:
+    """
+    进度推送中心
+    进度钩子、进程监控等在任务状态变化时调用notify（可在任意线程调用），
+    由各推送连接按自己的频率合并后发送增量
+    """
+    def __init__(self):
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self, task_ids=None):
+        subscription = ProgressSubscription(task_ids, asyncio.get_running_loop())
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def notify(self, task_id):
+        with self._lock:
+            subscribers = [sub for sub in self._subscribers if sub.watches(task_id)]
+        for sub in subscribers:
+            sub.loop.call_soon_threadsafe(self._mark_changed, sub, task_id)
+
+    @staticmethod
+    def _mark_changed(subscription, task_id):
+        subscription.pending.add(task_id)
+        subscription.changed.set()
+
+
+progress_broadcaster = ProgressBroadcaster()
+
+
+def notify_progress(task_id):
+    """通知进度推送流任务状态已变化"""
+    progress_broadcaster.notify(task_id)
+
+
+# 任务状态的每次变化都推送到进度流
+task_store.subscribe(lambda task_id, record: notify_progress(task_id))
+
+
+# 进度推送流：一个连接复用多个任务，只推送变化的字段
+@app.get("/progress/stream")
+async def progress_stream(request: Request, task_ids: str = None, interval: float = PROGRESS_STREAM_INTERVAL):
+    watched = [task_id for task_id in (task_ids or "").split(",") if task_id]
+    interval = max(PROGRESS_STREAM_MIN_INTERVAL, min(PROGRESS_STREAM_MAX_INTERVAL, interval))
+
+    async def event_stream():
+        subscription = progress_broadcaster.subscribe(watched)
+        try:
+            # 先推送一次完整状态
+            initial_ids = watched or task_store.active_ids()
+            snapshot = {task_id: subscription.diff(task_id, build_progress_snapshot(task_id)) for task_id in initial_ids}
+            yield f"event: progress\ndata: {json.dumps(snapshot, ensure_ascii=False)}\n\n"
+
+            while not await request.is_disconnected():
+                try:
+                    await asyncio.wait_for(subscription.changed.wait(), PROGRESS_STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+
+                subscription.changed.clear()
+                deltas = {}
+                for task_id in subscription.take_pending():
+                    delta = subscription.diff(task_id, build_progress_snapshot(task_id))
+                    if delta:
+                        deltas[task_id] = delta
+                if deltas:
+                    yield f"event: progress\ndata: {json.dumps(deltas, ensure_ascii=False)}\n\n"
+
+                # 合并间隔内的后续更新
+                await asyncio.sleep(interval)
+        finally:
+            progress_broadcaster.unsubscribe(subscription)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+# 获取下载进度
+@app.get("/progress/{task_id}")
+async def get_progress(task_id: str):
+    snapshot = build_progress_snapshot(task_id)
+    # 记录每次请求的进度值，用于调试
+    if snapshot["active"]:
+        api_log.debug("进度API请求 - 任务ID: %s, 进度值: %s%%, 速度: %s",
+                      task_id, snapshot["progress"], snapshot["speed_str"], extra={"task_id": task_id})
+    return snapshot
+
+
 # 删除视频
 @app.post("/delete_video")
 async def delete_video(request: DeleteVideoRequest):
@@ -1863,10 +4645,7 @@ async def delete_video(request: DeleteVideoRequest):
             info_path.unlink()
         
         # 从数据库中删除记录
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute('DELETE FROM downloads WHERE filepath LIKE ?', (f'%{request.filename}',))
-            conn.commit()
+        await db.aexecute('DELETE FROM downloads WHERE file_name = ?', (video_path.name,))
         
         return {"status": "success"}
     except Exception as e:
@@ -1876,28 +4655,80 @@ async def delete_video(request: DeleteVideoRequest):
 # 暂停下载
 @app.get("/pause_download/{task_id}")
 async def pause_download(task_id: str):
-    if task_id in download_tasks:
-        download_tasks[task_id]["paused"] = True
+    playlist_job = playlist_jobs.get(task_id)
+    if playlist_job is not None:
+        await playlist_job.pause()
         return {"status": "success"}
-    raise HTTPException(status_code=404, detail="任务不存在")
+    
+    control = task_controls.get(task_id)
+    if not task_store.is_active(task_id) or control is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    
+    if control.state == "running":
+        control.state = "paused"
+        task_store.update(task_id, {"paused": True})
+        if download_scheduler.remove(task_id):
+            # 还在排队，直接标记为暂停
+            mark_task_paused(task_id)
+        else:
+            # 正在下载，终止yt-dlp，任务结束后释放调度器名额
+            control.interrupt()
+            task_store.update(task_id, {"message": "正在暂停..."})
+    return {"status": "success"}
 
 
 # 继续下载
 @app.get("/resume_download/{task_id}")
 async def resume_download(task_id: str):
-    if task_id in download_tasks:
-        download_tasks[task_id]["paused"] = False
+    playlist_job = playlist_jobs.get(task_id)
+    if playlist_job is not None:
+        await playlist_job.resume()
         return {"status": "success"}
-    raise HTTPException(status_code=404, detail="任务不存在")
+    
+    control = task_controls.get(task_id)
+    if not task_store.is_active(task_id) or control is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    
+    if control.state == "paused":
+        if download_scheduler.is_running(task_id):
+            # 暂停尚未完成（yt-dlp还在退出），暂停完成后自动继续
+            control.resume_requested = True
+        else:
+            try:
+                resume_task(task_id)
+            except QueueFullError as e:
+                raise HTTPException(
+                    status_code=429,
+                    detail="下载队列已满，请稍后重试",
+                    headers={"Retry-After": str(e.retry_after)}
+                )
+    return {"status": "success"}
 
 
 # 取消下载
 @app.get("/cancel_download/{task_id}")
 async def cancel_download(task_id: str):
-    if task_id in download_tasks:
-        download_tasks[task_id]["cancelled"] = True
+    playlist_job = playlist_jobs.get(task_id)
+    if playlist_job is not None:
+        await playlist_job.cancel()
         return {"status": "success"}
-    raise HTTPException(status_code=404, detail="任务不存在")
+    
+    control = task_controls.get(task_id)
+    if not task_store.is_active(task_id) or control is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    
+    control.state = "cancelled"
+    control.resume_requested = False
+    task_store.update(task_id, {"cancelled": True})
+    if download_scheduler.is_running(task_id):
+        # 正在下载，终止yt-dlp，进程退出后再清理文件
+        control.interrupt()
+        task_store.update(task_id, {"message": "正在取消..."})
+    else:
+        # 排队中或已暂停，立即清理
+        download_scheduler.remove(task_id)
+        finish_cancelled_task(task_id)
+    return {"status": "success"}
 
 
 # 选择目录路由
@@ -1923,22 +4754,20 @@ async def select_directory():
                 path.mkdir(parents=True, exist_ok=True)
             # 统一使用正斜杠
             path_str = str(path).replace("\\", "/")
-            print(f"用户选择的下载目录: {path_str}")
+            api_log.info(f"用户选择的下载目录: {path_str}")
             return {"path": path_str}
         
-        print("用户取消了目录选择")
+        api_log.info("用户取消了目录选择")
         return {"path": None}
         
     except Exception as e:
-        print(f"选择目录出错: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        api_log.warning(f"选择目录出错: {str(e)}", exc_info=True)
         return {"path": None}
     finally:
         try:
             root.destroy()  # 清理tkinter窗口
         except Exception as destroy_error:
-            print(f"清理tkinter窗口时出错: {destroy_error}")
+            api_log.warning(f"清理tkinter窗口时出错: {destroy_error}")
             pass
 
 
@@ -1949,55 +4778,55 @@ async def open_file_location(request: FileLocationRequest):
         # 获取文件的绝对路径
         filepath = Path(request.filepath)
         filepath_str = str(filepath)
-        print(f"尝试打开文件位置: {filepath_str}")
+        api_log.info(f"尝试打开文件位置: {filepath_str}")
+        
+        # 记录访问时间，保留策略按最近访问时间清理
+        await touch_download_record(filepath_str)
         
         # 首先，检查数据库中是否有准确的记录
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT filepath, custom_path, actual_download_dir FROM downloads WHERE filepath = ?", (filepath_str,))
-            record = cursor.fetchone()
+        record = await db.afetchone("SELECT filepath, custom_path, actual_download_dir FROM downloads WHERE filepath = ?", (filepath_str,))
+        
+        if record:
+            # 优先使用记录中的实际下载目录
+            actual_dir = record[2]
+            if actual_dir and os.path.exists(actual_dir) and os.path.isdir(actual_dir):
+                api_log.info(f"从数据库找到实际下载目录: {actual_dir}")
+                os.startfile(str(actual_dir))
+                return {"status": "success", "message": f"已打开实际下载目录: {actual_dir}"}
             
-            if record:
-                # 优先使用记录中的实际下载目录
-                actual_dir = record[2]
-                if actual_dir and os.path.exists(actual_dir) and os.path.isdir(actual_dir):
-                    print(f"从数据库找到实际下载目录: {actual_dir}")
-                    os.startfile(str(actual_dir))
-                    return {"status": "success", "message": f"已打开实际下载目录: {actual_dir}"}
-                
-                # 其次使用自定义路径
-                custom_path = record[1]
-                if custom_path:
-                    print(f"从数据库找到自定义路径: {custom_path}")
-                    # 尝试从自定义路径中提取目录
-                    try:
-                        custom_dir = Path(custom_path)
-                        if custom_dir.exists() and custom_dir.is_dir():
-                            print(f"打开自定义目录: {custom_dir}")
-                            os.startfile(str(custom_dir))
-                            return {"status": "success", "message": f"已打开用户指定的下载目录: {custom_dir}"}
-                    except Exception as cp_error:
-                        print(f"打开自定义路径失败: {cp_error}")
+            # 其次使用自定义路径
+            custom_path = record[1]
+            if custom_path:
+                api_log.info(f"从数据库找到自定义路径: {custom_path}")
+                # 尝试从自定义路径中提取目录
+                try:
+                    custom_dir = Path(custom_path)
+                    if custom_dir.exists() and custom_dir.is_dir():
+                        api_log.info(f"打开自定义目录: {custom_dir}")
+                        os.startfile(str(custom_dir))
+                        return {"status": "success", "message": f"已打开用户指定的下载目录: {custom_dir}"}
+                except Exception as cp_error:
+                    api_log.warning(f"打开自定义路径失败: {cp_error}")
         
         # 检查文件是否存在
         if filepath.exists():
             directory = str(filepath.parent.resolve())
-            print(f"文件存在，打开其所在目录: {directory}")
+            api_log.info(f"文件存在，打开其所在目录: {directory}")
             os.startfile(directory)
             return {"status": "success", "message": f"已打开文件所在目录: {directory}"}
             
         # 如果文件不存在，尝试从最近的下载任务中查找
         filename = filepath.name
-        print(f"提取的文件名: {filename}")
+        api_log.info(f"提取的文件名: {filename}")
         
         # 检查最近的下载任务
-        for task_id, task in completed_tasks.items():
-            if "filepath" in task and "actual_download_dir" in task:
-                task_filepath = Path(task["filepath"])
+        for task in task_store.finished_records():
+            if task.filepath and task.actual_download_dir:
+                task_filepath = Path(task.filepath)
                 if task_filepath.name == filename or task_filepath.stem in filename or filename in task_filepath.name:
-                    actual_dir = task["actual_download_dir"]
+                    actual_dir = task.actual_download_dir
                     if os.path.exists(actual_dir) and os.path.isdir(actual_dir):
-                        print(f"在完成任务中找到匹配的下载目录: {actual_dir}")
+                        api_log.info(f"在完成任务中找到匹配的下载目录: {actual_dir}")
                         os.startfile(actual_dir)
                         return {"status": "success", "message": f"已打开最近任务的下载目录: {actual_dir}"}
             
@@ -2010,23 +4839,20 @@ async def open_file_location(request: FileLocationRequest):
             potential_file = potential_files[0]
             filepath = potential_file
             filepath_str = str(filepath)
-            print(f"在videos目录中找到匹配文件: {filepath_str}")
+            api_log.info(f"在videos目录中找到匹配文件: {filepath_str}")
             
             # 如果找到匹配文件，尝试打开它的位置
             if filepath.exists():
                 directory = os.path.dirname(filepath_str)
-                print(f"打开匹配文件所在目录: {directory}")
+                api_log.info(f"打开匹配文件所在目录: {directory}")
                 try:
                     os.startfile(directory)
                     return {"status": "success", "message": f"已打开匹配文件所在目录: {directory}"}
                 except Exception as dir_error:
-                    print(f"打开匹配文件目录失败: {dir_error}")
+                    api_log.warning(f"打开匹配文件目录失败: {dir_error}")
         else:
             # 在数据库中查找类似的文件路径
-            with sqlite3.connect(DB_PATH) as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT filepath FROM downloads")
-                all_filepaths = cursor.fetchall()
+            all_filepaths = await db.afetchall("SELECT filepath FROM downloads")
             
             # 检查任何匹配的文件名
             for (db_filepath,) in all_filepaths:
@@ -2034,36 +4860,36 @@ async def open_file_location(request: FileLocationRequest):
                 if db_path.exists():
                     filepath = db_path
                     filepath_str = str(filepath)
-                    print(f"在数据库中找到存在的文件: {filepath_str}")
+                    api_log.info(f"在数据库中找到存在的文件: {filepath_str}")
                     
                     # 打开文件所在目录
                     directory = os.path.dirname(filepath_str)
-                    print(f"打开数据库匹配文件所在目录: {directory}")
+                    api_log.info(f"打开数据库匹配文件所在目录: {directory}")
                     try:
                         os.startfile(directory)
                         return {"status": "success", "message": f"已打开数据库匹配文件所在目录: {directory}"}
                     except Exception as dir_error:
-                        print(f"打开数据库匹配文件目录失败: {dir_error}")
+                        api_log.warning(f"打开数据库匹配文件目录失败: {dir_error}")
                     break
             
             # 如果仍然找不到文件，尝试打开videos目录
             videos_dir_path = VIDEOS_DIR.resolve()
             videos_dir_str = str(videos_dir_path)
-            print(f"无法找到匹配文件，将打开默认videos目录: {videos_dir_str}")
+            api_log.warning(f"无法找到匹配文件，将打开默认videos目录: {videos_dir_str}")
             try:
                 if not os.path.exists(videos_dir_str):
                     os.makedirs(videos_dir_str, exist_ok=True)
                 os.startfile(videos_dir_str)
                 return {"status": "success", "message": "已打开默认视频目录"}
             except Exception as e:
-                print(f"打开默认目录失败: {e}")
+                api_log.warning(f"打开默认目录失败: {e}")
                 # 最后尝试打开当前工作目录
                 try:
                     current_dir = os.getcwd()
                     os.startfile(current_dir)
                     return {"status": "success", "message": "已打开当前工作目录"}
                 except Exception as e2:
-                    print(f"打开当前目录失败: {e2}")
+                    api_log.warning(f"打开当前目录失败: {e2}")
                     raise HTTPException(status_code=404, detail=f"无法找到文件或打开目录: {e2}")
         
         # 确保路径格式正确（Windows格式）
@@ -2074,52 +4900,52 @@ async def open_file_location(request: FileLocationRequest):
         if directory and os.path.exists(directory):
             try:
                 # 打开目录而不是文件
-                print(f"尝试打开目录: {directory}")
+                api_log.info(f"尝试打开目录: {directory}")
                 os.startfile(directory)
-                print("成功打开文件所在目录")
+                api_log.info("成功打开文件所在目录")
                 return {"status": "success", "message": "已打开文件所在目录"}
             except Exception as dir_error:
-                print(f"打开目录失败: {dir_error}")
+                api_log.warning(f"打开目录失败: {dir_error}")
         
         # 如果上面方法失败，尝试使用explorer /select方法
         try:
-            print(f"尝试使用explorer select方法")
+            api_log.info(f"尝试使用explorer select方法")
             # 使用explorer /select,命令(需要绝对路径)
             filepath_absolute = os.path.abspath(filepath_str)
             command = f'explorer /select,"{filepath_absolute}"'
-            print(f"执行命令: {command}")
+            api_log.info(f"执行命令: {command}")
             
             result = subprocess.run(command, shell=True)
             if result.returncode == 0:
-                print("explorer select方法成功")
+                api_log.info("explorer select方法成功")
                 return {"status": "success", "message": "已打开文件位置"}
             else:
-                print(f"explorer select方法失败，返回码: {result.returncode}")
+                api_log.warning(f"explorer select方法失败，返回码: {result.returncode}")
         except Exception as explorer_error:
-            print(f"使用explorer select方法过程中出错: {explorer_error}")
+            api_log.warning(f"使用explorer select方法过程中出错: {explorer_error}")
         
         # 最后的后备方案 - 直接打开视频目录
         videos_dir_path = VIDEOS_DIR.resolve()
-        print(f"所有方法失败，尝试打开视频目录: {videos_dir_path}")
+        api_log.warning(f"所有方法失败，尝试打开视频目录: {videos_dir_path}")
         try:
             os.startfile(str(videos_dir_path))
             return {"status": "success", "message": "已打开默认视频目录"}
         except Exception as last_error:
-            print(f"打开视频目录失败: {last_error}")
+            api_log.warning(f"打开视频目录失败: {last_error}")
             # 绝对最后的尝试：打开当前工作目录
             current_dir = os.getcwd()
-            print(f"尝试打开当前工作目录: {current_dir}")
+            api_log.info(f"尝试打开当前工作目录: {current_dir}")
             try:
                 os.startfile(current_dir)
                 return {"status": "success", "message": "已打开当前工作目录"}
             except Exception as very_last_error:
-                print(f"打开当前目录失败: {very_last_error}")
+                api_log.warning(f"打开当前目录失败: {very_last_error}")
                 return JSONResponse(
                     status_code=500,
                     content={"status": "error", "detail": "所有打开文件位置的方法都失败"}
                 )
     except Exception as e:
-        print(f"打开文件位置时出错: {e}")
+        api_log.warning(f"打开文件位置时出错: {e}")
         # 返回更友好的错误信息
         return JSONResponse(
             status_code=500,
@@ -2133,47 +4959,47 @@ async def open_file_directory(request: FileLocationRequest):
     try:
         filepath = Path(request.filepath)
         filepath_str = str(filepath)
-        print(f"尝试打开文件目录: {filepath_str}")
+        api_log.info(f"尝试打开文件目录: {filepath_str}")
+        
+        # 记录访问时间，保留策略按最近访问时间清理
+        await touch_download_record(filepath_str)
         
         # 首先，检查数据库中是否有准确的记录
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT filepath, custom_path, actual_download_dir FROM downloads WHERE filepath = ?", (filepath_str,))
-            record = cursor.fetchone()
+        record = await db.afetchone("SELECT filepath, custom_path, actual_download_dir FROM downloads WHERE filepath = ?", (filepath_str,))
+        
+        if record:
+            # 优先使用记录中的实际下载目录
+            actual_dir = record[2]
+            if actual_dir and os.path.exists(actual_dir) and os.path.isdir(actual_dir):
+                api_log.info(f"从数据库找到实际下载目录: {actual_dir}")
+                os.startfile(str(actual_dir))
+                return {"status": "success", "message": f"已打开实际下载目录: {actual_dir}"}
             
-            if record:
-                # 优先使用记录中的实际下载目录
-                actual_dir = record[2]
-                if actual_dir and os.path.exists(actual_dir) and os.path.isdir(actual_dir):
-                    print(f"从数据库找到实际下载目录: {actual_dir}")
-                    os.startfile(str(actual_dir))
-                    return {"status": "success", "message": f"已打开实际下载目录: {actual_dir}"}
-                
-                # 其次使用自定义路径
-                custom_path = record[1]
-                if custom_path:
-                    print(f"从数据库找到自定义路径: {custom_path}")
-                    # 尝试从自定义路径中提取目录
-                    try:
-                        if os.path.isdir(custom_path):
-                            print(f"打开自定义目录: {custom_path}")
-                            os.startfile(custom_path)
-                            return {"status": "success", "message": f"已打开自定义下载目录: {custom_path}"}
-                        elif os.path.exists(custom_path):
-                            # 可能是文件路径，获取其所在目录
-                            custom_dir = os.path.dirname(custom_path)
-                            if os.path.exists(custom_dir):
-                                print(f"打开自定义文件所在目录: {custom_dir}")
-                                os.startfile(custom_dir)
-                                return {"status": "success", "message": f"已打开自定义文件所在目录: {custom_dir}"}
-                    except Exception as cp_error:
-                        print(f"打开自定义路径失败: {cp_error}")
-        
-        # 检查是否是来自最近下载的请求，先检查completed_tasks中的记录
-        for task_id, task in completed_tasks.items():
-            if "filepath" in task and task["filepath"] == filepath_str and "actual_download_dir" in task:
-                actual_dir = task["actual_download_dir"]
-                print(f"从任务记录找到实际下载目录: {actual_dir}")
+            # 其次使用自定义路径
+            custom_path = record[1]
+            if custom_path:
+                api_log.info(f"从数据库找到自定义路径: {custom_path}")
+                # 尝试从自定义路径中提取目录
+                try:
+                    if os.path.isdir(custom_path):
+                        api_log.info(f"打开自定义目录: {custom_path}")
+                        os.startfile(custom_path)
+                        return {"status": "success", "message": f"已打开自定义下载目录: {custom_path}"}
+                    elif os.path.exists(custom_path):
+                        # 可能是文件路径，获取其所在目录
+                        custom_dir = os.path.dirname(custom_path)
+                        if os.path.exists(custom_dir):
+                            api_log.info(f"打开自定义文件所在目录: {custom_dir}")
+                            os.startfile(custom_dir)
+                            return {"status": "success", "message": f"已打开自定义文件所在目录: {custom_dir}"}
+                except Exception as cp_error:
+                    api_log.warning(f"打开自定义路径失败: {cp_error}")
+        
+        # 检查是否是来自最近下载的请求，先检查已结束任务中的记录
+        for task in task_store.finished_records():
+            if task.filepath == filepath_str and task.actual_download_dir:
+                actual_dir = task.actual_download_dir
+                api_log.info(f"从任务记录找到实际下载目录: {actual_dir}")
                 if os.path.exists(actual_dir) and os.path.isdir(actual_dir):
                     os.startfile(actual_dir)
                     return {"status": "success", "message": f"已打开实际下载目录: {actual_dir}"}
@@ -2182,17 +5008,17 @@ async def open_file_directory(request: FileLocationRequest):
         if filepath.exists():
             # 如果文件存在，获取其所在目录
             file_directory = filepath.parent
-            print(f"文件存在，其所在目录为: {file_directory}")
+            api_log.info(f"文件存在，其所在目录为: {file_directory}")
             
             # 尝试打开目录
             if file_directory.exists():
                 os.startfile(str(file_directory))
-                print(f"成功打开文件所在目录: {file_directory}")
+                api_log.info(f"成功打开文件所在目录: {file_directory}")
                 return {"status": "success", "message": f"已打开文件所在目录: {file_directory}"}
             
         # 如果文件不存在，尝试从路径中提取文件名
         filename = filepath.name
-        print(f"提取的文件名: {filename}")
+        api_log.info(f"提取的文件名: {filename}")
         
         # 在videos目录中查找相同名称的文件
         videos_dir = VIDEOS_DIR
@@ -2202,36 +5028,36 @@ async def open_file_directory(request: FileLocationRequest):
             # 使用找到的第一个匹配文件的目录
             potential_file = potential_files[0]
             potential_dir = potential_file.parent
-            print(f"在videos目录中找到匹配文件，其目录为: {potential_dir}")
+            api_log.info(f"在videos目录中找到匹配文件，其目录为: {potential_dir}")
             try:
                 os.startfile(str(potential_dir))
                 return {"status": "success", "message": f"已打开匹配文件所在目录: {potential_dir}"}
             except Exception as dir_error:
-                print(f"打开匹配文件目录失败: {dir_error}")
+                api_log.warning(f"打开匹配文件目录失败: {dir_error}")
         else:
             # 直接尝试打开videos目录
             videos_dir_str = str(videos_dir.absolute())
-            print(f"无法找到匹配文件，将直接打开默认videos目录: {videos_dir_str}")
+            api_log.warning(f"无法找到匹配文件，将直接打开默认videos目录: {videos_dir_str}")
             try:
                 if not os.path.exists(videos_dir_str):
                     os.makedirs(videos_dir_str, exist_ok=True)
                 os.startfile(videos_dir_str)
                 return {"status": "success", "message": "已打开默认视频目录"}
             except Exception as e:
-                print(f"打开默认目录失败: {e}")
+                api_log.warning(f"打开默认目录失败: {e}")
                 # 最后尝试打开当前工作目录
                 try:
                     current_dir = os.getcwd()
                     os.startfile(current_dir)
                     return {"status": "success", "message": "已打开当前工作目录"}
                 except Exception as e2:
-                    print(f"打开当前目录失败: {e2}")
+                    api_log.warning(f"打开当前目录失败: {e2}")
                     return JSONResponse(
                         status_code=500,
                         content={"status": "error", "detail": "无法打开任何目录"}
                     )
     except Exception as e:
-        print(f"打开文件目录时出错: {e}")
+        api_log.warning(f"打开文件目录时出错: {e}")
         # 返回更友好的错误信息
         return JSONResponse(
             status_code=500,
@@ -2243,11 +5069,11 @@ async def open_file_directory(request: FileLocationRequest):
 @app.get("/debug/database")
 async def debug_database():
     try:
-        with sqlite3.connect(DB_PATH) as conn:
+        def fetch_summary(conn):
             cursor = conn.cursor()
             
-            # 获取总记录数
-            cursor.execute('SELECT COUNT(*) FROM downloads')
+            # 获取总记录数（由触发器维护）
+            cursor.execute("SELECT value FROM history_meta WHERE key = 'row_count'")
             total_count = cursor.fetchone()[0]
             
             # 获取最近10条记录
@@ -2258,28 +5084,31 @@ async def debug_database():
                 LIMIT 10
             ''')
             recent_records = cursor.fetchall()
-            
-            # 检查文件是否存在
-            records_info = []
-            for record in recent_records:
-                file_path = Path(record[1])
-                records_info.append({
-                    "title": record[0],
-                    "filepath": str(file_path),
-                    "file_exists": file_path.exists(),
-                    "file_type": record[2],
-                    "download_time": record[3],
-                    "custom_path": record[4]
-                })
-            
-            return {
-                "total_records": total_count,
-                "recent_records": records_info,
-                "database_path": str(DB_PATH),
-                "database_exists": DB_PATH.exists(),
-                "database_size": os.path.getsize(DB_PATH) if DB_PATH.exists() else 0
-            }
-            
+            return total_count, recent_records
+        
+        total_count, recent_records = await db.aread(fetch_summary)
+        
+        # 检查文件是否存在
+        records_info = []
+        for record in recent_records:
+            file_path = Path(record[1])
+            records_info.append({
+                "title": record[0],
+                "filepath": str(file_path),
+                "file_exists": file_path.exists(),
+                "file_type": record[2],
+                "download_time": record[3],
+                "custom_path": record[4]
+            })
+        
+        return {
+            "total_records": total_count,
+            "recent_records": records_info,
+            "database_path": str(DB_PATH),
+            "database_exists": DB_PATH.exists(),
+            "database_size": os.path.getsize(DB_PATH) if DB_PATH.exists() else 0
+        }
+        
     except Exception as e:
         return {"error": str(e)}
 
@@ -2289,79 +5118,76 @@ async def debug_database():
 async def test_open_file():
     try:
         # 获取数据库中的第一个文件路径
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT filepath FROM downloads LIMIT 1')
-            row = cursor.fetchone()
-            
-            if not row:
-                return {"status": "error", "message": "数据库中没有文件记录"}
-            
-            filepath = row[0]
-            
-            # 测试不同的打开方法
-            results = []
-            
-            # 方法1: 使用explorer /select
-            try:
-                print(f"测试方法1: explorer /select,{filepath}")
-                result = subprocess.run(f'explorer /select,{filepath}', shell=True)
-                results.append({
-                    "method": "explorer /select",
-                    "success": result.returncode == 0,
-                    "returncode": result.returncode
-                })
-            except Exception as e:
-                results.append({
-                    "method": "explorer /select",
-                    "success": False,
-                    "error": str(e)
-                })
-            
-            # 方法2: 使用ShellExecute API
-            try:
-                print(f"测试方法2: ShellExecute API")
-                shell32 = ctypes.windll.shell32
-                result = shell32.ShellExecuteW(
-                    None, 'open', 'explorer.exe', f'/select,{filepath}', None, 1
-                )
-                results.append({
-                    "method": "ShellExecute API",
-                    "success": result > 32,
-                    "returncode": result
-                })
-            except Exception as e:
-                results.append({
-                    "method": "ShellExecute API",
-                    "success": False,
-                    "error": str(e)
-                })
-            
-            # 方法3: 只打开目录
-            try:
-                print(f"测试方法3: 打开目录")
-                directory = os.path.dirname(filepath)
-                os.startfile(directory)
-                results.append({
-                    "method": "打开目录",
-                    "success": True,
-                    "directory": directory
-                })
-            except Exception as e:
-                results.append({
-                    "method": "打开目录",
-                    "success": False,
-                    "error": str(e)
-                })
-            
-            return {
-                "filepath": filepath,
-                "exists": os.path.exists(filepath),
-                "absolute_path": os.path.abspath(filepath),
-                "normalized_path": os.path.normpath(filepath),
-                "directory": os.path.dirname(filepath),
-                "results": results
-            }
+        row = await db.afetchone('SELECT filepath FROM downloads LIMIT 1')
+        
+        if not row:
+            return {"status": "error", "message": "数据库中没有文件记录"}
+        
+        filepath = row[0]
+        
+        # 测试不同的打开方法
+        results = []
+        
+        # 方法1: 使用explorer /select
+        try:
+            api_log.info(f"测试方法1: explorer /select,{filepath}")
+            result = subprocess.run(f'explorer /select,{filepath}', shell=True)
+            results.append({
+                "method": "explorer /select",
+                "success": result.returncode == 0,
+                "returncode": result.returncode
+            })
+        except Exception as e:
+            results.append({
+                "method": "explorer /select",
+                "success": False,
+                "error": str(e)
+            })
+        
+        # 方法2: 使用ShellExecute API
+        try:
+            api_log.info(f"测试方法2: ShellExecute API")
+            shell32 = ctypes.windll.shell32
+            result = shell32.ShellExecuteW(
+                None, 'open', 'explorer.exe', f'/select,{filepath}', None, 1
+            )
+            results.append({
+                "method": "ShellExecute API",
+                "success": result > 32,
+                "returncode": result
+            })
+        except Exception as e:
+            results.append({
+                "method": "ShellExecute API",
+                "success": False,
+                "error": str(e)
+            })
+        
+        # 方法3: 只打开目录
+        try:
+            api_log.info(f"测试方法3: 打开目录")
+            directory = os.path.dirname(filepath)
+            os.startfile(directory)
+            results.append({
+                "method": "打开目录",
+                "success": True,
+                "directory": directory
+            })
+        except Exception as e:
+            results.append({
+                "method": "打开目录",
+                "success": False,
+                "error": str(e)
+            })
+        
+        return {
+            "filepath": filepath,
+            "exists": os.path.exists(filepath),
+            "absolute_path": os.path.abspath(filepath),
+            "normalized_path": os.path.normpath(filepath),
+            "directory": os.path.dirname(filepath),
+            "results": results
+        }
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
@@ -2385,29 +5211,25 @@ async def download_video(video_url, task_id, video_quality="best", format_type="
         
         # 安全更新任务状态 - 使用try-except包装所有状态更新
         try:
-            if task_id in download_tasks:
-                download_tasks[task_id].update({
+            if task_store.is_active(task_id):
+                task_store.update(task_id, {
                     "status": "initializing",
                     "message": "正在连接到YouTube...",
-                    "progress": 5,
+                    "progress": 0,
                     "start_time": download_start_time,
-                    "video_url": video_url,  # 记录视频URL，用于后续处理
-                    "speed": 1048576,  # 默认初始速度1MB/s，避免显示0
-                    "speed_str": "准备中..."  # 初始速度显示文本
+                    "video_url": video_url  # 记录视频URL，用于后续处理
                 })
         except Exception as e:
-            print(f"初始化任务状态时出错: {e}")
+            download_log.warning(f"初始化任务状态时出错: {e}")
             # 如果任务不存在，创建一个
-            if task_id not in download_tasks:
-                download_tasks[task_id] = {
+            if task_id not in task_store:
+                task_store.create(task_id, {
                     "status": "initializing",
                     "message": "正在连接到YouTube...",
-                    "progress": 5,
+                    "progress": 0,
                     "start_time": download_start_time,
-                    "video_url": video_url,
-                    "speed": 1048576,  # 默认初始速度1MB/s，避免显示0
-                    "speed_str": "准备中..."  # 初始速度显示文本
-                }
+                    "video_url": video_url
+                })
         
         # 使用自定义下载路径或默认路径
         output_dir = Path(download_path) if download_path else VIDEOS_DIR
@@ -2416,186 +5238,154 @@ async def download_video(video_url, task_id, video_quality="best", format_type="
         
         # 记录实际的下载目录绝对路径，用于后续打开文件位置
         actual_download_dir = str(output_dir)
-        print(f"实际下载目录: {actual_download_dir}")
+        download_log.info(f"实际下载目录: {actual_download_dir}")
         
-        # 如果需要压缩，创建临时下载目录
-        if compress_to_zip:
-            temp_dir = output_dir / f"temp_{task_id}"
-            temp_dir.mkdir(parents=True, exist_ok=True)
-            download_dir = temp_dir
-        else:
-            download_dir = output_dir
+        # 直接下载到目标目录，需要压缩时下载完成后再就地打包
+        download_dir = output_dir
         
         # 安全更新状态，表示已准备好下载位置
         try:
-            if task_id in download_tasks:
-                download_tasks[task_id].update({
+            if task_store.is_active(task_id):
+                task_store.update(task_id, {
                     "message": "已准备好下载位置，获取视频信息...",
-                    "progress": 10,
                     "actual_download_dir": actual_download_dir  # 保存实际下载目录
                 })
         except Exception as e:
-            print(f"更新下载位置状态时出错: {e}")
+            download_log.warning(f"更新下载位置状态时出错: {e}")
+        
+        # 之前通过/info获取过的视频信息直接用于显示和保存记录
+        try:
+            cached_info = await video_info_cache.get_cached(video_url)
+            if cached_info and task_store.is_active(task_id):
+                task_store.update(task_id, {
+                    key: cached_info[key] for key in ("title", "uploader", "duration") if cached_info.get(key)
+                })
+        except Exception as e:
+            download_log.warning(f"读取视频信息缓存时出错: {e}")
         
         # 直接使用直接下载方式
         use_direct_download = True
-        if compress_to_zip:
-            use_direct_download = False  # 压缩任务仍使用原下载方式
         
         # 安全更新状态
         try:
-            if task_id in download_tasks:
-                download_tasks[task_id].update({
-                    "message": "已选择直接下载模式，准备开始...",
-                    "progress": 25
+            if task_store.is_active(task_id):
+                task_store.update(task_id, {
+                    "message": "已选择直接下载模式，准备开始..."
                 })
         except Exception as e:
-            print(f"更新下载模式状态时出错: {e}")
+            download_log.warning(f"更新下载模式状态时出错: {e}")
         
         if use_direct_download:
             try:
-                # 使用命令行直接下载
-                output_dir_str, output_file = await direct_download_with_ytdlp(
+                # 使用进程池（或命令行）下载，与相同视频、相同格式的下载合并
+                output_dir_str, output_file = await deduplicated_download(
                     video_url, 
                     task_id, 
                     str(download_dir), 
                     video_quality, 
                     format_type,
-                    download_path  # 传递download_path参数
+                    download_path,  # 传递download_path参数
+                    compress_to_zip
                 )
                 
                 # 确保使用正确的下载目录路径
                 # 优先使用直接下载方法返回的目录
                 if output_dir_str and os.path.exists(output_dir_str):
                     actual_download_dir = str(Path(output_dir_str).resolve())
-                    print(f"更新实际下载目录为: {actual_download_dir}")
-                    if task_id in download_tasks:
-                        download_tasks[task_id]["actual_download_dir"] = actual_download_dir
+                    download_log.info(f"更新实际下载目录为: {actual_download_dir}")
+                    if task_store.is_active(task_id):
+                        task_store.update(task_id, {"actual_download_dir": actual_download_dir})
                 
                 # 如果需要压缩，进行额外处理
                 if compress_to_zip:
-                    # 这部分代码与原来的代码相同，处理压缩
-                    try:
-                        output_file_path = Path(output_file)
-                        # 更新状态
-                        if task_id in download_tasks:
-                            download_tasks[task_id].update({
-                                "message": "正在创建ZIP归档...",
-                                "progress": 98
-                            })
-                        
-                        # 找到所有相关文件
-                        video_base = output_file_path.stem
-                        all_files = list(download_dir.glob(f"{video_base}*"))
-                        
-                        # 创建ZIP文件
-                        zip_path = output_dir / f"{video_base}.zip"
-                        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                            for file in all_files:
-                                zipf.write(file, arcname=file.name)
-                        
-                        # 清理临时文件
-                        for file in all_files:
-                            file.unlink()
-                        temp_dir.rmdir()
-                        
-                        # 更新状态
-                        if task_id in download_tasks:
-                            download_tasks[task_id].update({
-                                "message": "ZIP归档已创建，下载完成！",
-                                "progress": 100,
-                                "filepath": str(zip_path)
-                            })
-                    except Exception as e:
-                        print(f"创建ZIP归档时出错: {e}")
-                        # 安全更新状态
-                        if task_id in download_tasks:
-                            download_tasks[task_id].update({
-                                "message": f"创建ZIP时出错: {str(e)}，但视频已下载成功",
-                                "progress": 100
-                            })
+                    output_file = await finish_zip_packaging(
+                        task_id, output_file, video_quality, format_type, download_path
+                    )
                 
                 # 下载成功，返回结果
                 return str(download_dir), output_file
                 
             except Exception as e:
+                # 用户暂停或取消导致的中断，不作为错误处理
+                if is_task_interrupted(task_id):
+                    raise DownloadInterrupted(str(e))
+                
                 # 直接下载失败，记录错误
                 error_message = str(e) if str(e) else "未知错误"
-                print(f"直接下载方式失败: {error_message}")
+                download_log.warning(f"直接下载方式失败: {error_message}")
                 
                 # 检查是否是ffmpeg相关错误
                 if "ffmpeg" in error_message.lower() or "ffprobe" in error_message.lower():
-                    print("检测到ffmpeg相关错误，尝试处理...")
+                    download_log.warning("检测到ffmpeg相关错误，尝试处理...")
                     
                     if not ffmpeg_retry_attempted:
-                        print("尝试下载ffmpeg并重试...")
+                        download_log.info("尝试下载ffmpeg并重试...")
                         # 更新状态
-                        if task_id in download_tasks:
-                            download_tasks[task_id].update({
+                        if task_store.is_active(task_id):
+                            task_store.update(task_id, {
                                 "status": "pending",
-                                "message": "正在下载ffmpeg工具，请稍候...",
-                                "progress": 10
+                                "message": "正在下载ffmpeg工具，请稍候..."
                             })
                         
                         # 尝试下载ffmpeg
                         ffmpeg_path = await download_ffmpeg()
                         
                         if ffmpeg_path:
-                            print(f"成功下载ffmpeg: {ffmpeg_path}，重试下载...")
+                            download_log.info(f"成功下载ffmpeg: {ffmpeg_path}，重试下载...")
                             
                             # 更新状态
-                            if task_id in download_tasks:
-                                download_tasks[task_id].update({
+                            if task_store.is_active(task_id):
+                                task_store.update(task_id, {
                                     "status": "retrying",
-                                    "message": "已安装ffmpeg，正在重试下载...",
-                                    "progress": 15
+                                    "message": "已安装ffmpeg，正在重试下载..."
                                 })
                             
                             # 设置重试标志
                             ffmpeg_retry_attempted = True
                             
                             # 重试下载
-                            output_dir_str, output_file = await direct_download_with_ytdlp(
+                            output_dir_str, output_file = await deduplicated_download(
                                 video_url, 
                                 task_id, 
                                 str(download_dir), 
                                 video_quality, 
                                 format_type,
-                                download_path
+                                download_path,
+                                compress_to_zip
                             )
                             
                             # 如果到达这里，说明重试成功
-                            print("重试下载成功！")
+                            download_log.info("重试下载成功！")
+                            if compress_to_zip:
+                                output_file = await finish_zip_packaging(
+                                    task_id, output_file, video_quality, format_type, download_path
+                                )
                             return str(download_dir), output_file
                         else:
-                            print("下载ffmpeg失败，无法自动修复")
+                            download_log.warning("下载ffmpeg失败，无法自动修复")
                             error_message = "下载MP3格式需要ffmpeg工具，但自动安装失败。请手动安装ffmpeg后重试。"
                 
                 # 安全更新任务状态
                 try:
-                    if task_id in download_tasks:
-                        download_tasks[task_id].update({
+                    if task_store.is_active(task_id):
+                        task_store.update(task_id, {
                             "status": "error",
                             "error": error_message,
                             "progress": 0,
                             "end_time": time.time(),
                             "message": "下载失败"
                         })
-                        
-                        # 将出错的任务移至已完成任务字典
-                        completed_tasks[task_id] = download_tasks[task_id].copy()
-                        del download_tasks[task_id]
-                    elif task_id not in completed_tasks:
-                        # 如果任务不在任何字典中，创建一个错误记录
-                        completed_tasks[task_id] = {
+                    elif task_id not in task_store:
+                        # 如果任务不存在，创建一个错误记录
+                        task_store.create(task_id, {
                             "status": "error",
                             "error": error_message,
                             "progress": 0,
                             "end_time": time.time(),
                             "message": "下载失败"
-                        }
+                        })
                 except Exception as update_error:
-                    print(f"更新任务错误状态时出错: {update_error}")
+                    download_log.warning(f"更新任务错误状态时出错: {update_error}")
                 
                 # 抛出异常，让外部处理程序处理
                 raise Exception(f"下载失败: {error_message}")
@@ -2606,41 +5396,38 @@ async def download_video(video_url, task_id, video_quality="best", format_type="
             raise Exception("仅支持直接下载模式，请重试")
             
     except Exception as e:
+        if isinstance(e, DownloadInterrupted) or is_task_interrupted(task_id):
+            raise DownloadInterrupted(str(e))
+        
         # 统一错误处理程序
         error_message = str(e) if str(e) else "未知错误"
-        print(f"下载错误 [{task_id}]: {error_message}")
+        download_log.warning(f"下载错误 [{task_id}]: {error_message}")
         
         # 记录更多错误信息
-        import traceback
-        traceback_str = traceback.format_exc()
-        print(f"详细错误信息: {traceback_str}")
+        download_log.debug("详细错误信息", exc_info=True)
         
         # 安全地更新任务状态
         try:
             # 如果任务存在，更新其状态
-            if task_id in download_tasks:
-                download_tasks[task_id].update({
+            if task_store.is_active(task_id):
+                task_store.update(task_id, {
                     "status": "error",
                     "error": error_message,
                     "progress": 0,
                     "end_time": time.time(),
                     "message": "下载失败"
                 })
-                
-                # 将出错的任务移至已完成任务字典
-                completed_tasks[task_id] = download_tasks[task_id].copy()
-                del download_tasks[task_id]
-            elif task_id not in completed_tasks:
-                # 如果任务不在任何字典中，创建一个错误记录
-                completed_tasks[task_id] = {
+            elif task_id not in task_store:
+                # 如果任务不存在，创建一个错误记录
+                task_store.create(task_id, {
                     "status": "error",
                     "error": error_message,
                     "progress": 0,
                     "end_time": time.time(),
                     "message": "下载失败"
-                }
+                })
         except Exception as update_error:
-            print(f"更新任务错误状态时出错: {update_error}")
+            download_log.warning(f"更新任务错误状态时出错: {update_error}")
         
         # 重新抛出异常，让API路由处理
         raise Exception(f"下载失败: {error_message}") 
@@ -2652,11 +5439,11 @@ def get_ffmpeg_path():
     返回ffmpeg可执行文件的路径
     """
     # 记录检测过程
-    print("开始检测ffmpeg路径...")
+    ffmpeg_log.info("开始检测ffmpeg路径...")
     
     # 首先检查应用程序目录下的ffmpeg
     ffmpeg_dir = Path(__file__).parent / "ffmpeg"
-    print(f"检查应用目录下ffmpeg: {ffmpeg_dir}")
+    ffmpeg_log.info(f"检查应用目录下ffmpeg: {ffmpeg_dir}")
     
     if platform.system() == "Windows":
         # 检查几种可能的路径
@@ -2669,29 +5456,29 @@ def get_ffmpeg_path():
         
         for path in possible_paths:
             if path.exists():
-                print(f"在 {path} 找到ffmpeg")
+                ffmpeg_log.info(f"在 {path} 找到ffmpeg")
                 return str(path.resolve())
             else:
-                print(f"未在 {path} 找到ffmpeg")
+                ffmpeg_log.info(f"未在 {path} 找到ffmpeg")
         
         # 检查环境变量PATH中是否有ffmpeg
         ffmpeg_path = shutil.which("ffmpeg")
         if ffmpeg_path:
-            print(f"在系统PATH中找到ffmpeg: {ffmpeg_path}")
+            ffmpeg_log.info(f"在系统PATH中找到ffmpeg: {ffmpeg_path}")
             return ffmpeg_path
         else:
-            print("在系统PATH中未找到ffmpeg")
+            ffmpeg_log.warning("在系统PATH中未找到ffmpeg")
     else:
         # Linux/Mac系统
         ffmpeg_path = shutil.which("ffmpeg")
         if ffmpeg_path:
-            print(f"在系统中找到ffmpeg: {ffmpeg_path}")
+            ffmpeg_log.info(f"在系统中找到ffmpeg: {ffmpeg_path}")
             return ffmpeg_path
         else:
-            print("在系统中未找到ffmpeg")
+            ffmpeg_log.warning("在系统中未找到ffmpeg")
     
     # 如果找不到ffmpeg，返回None
-    print("未找到ffmpeg，需要下载安装")
+    ffmpeg_log.warning("未找到ffmpeg，需要下载安装")
     return None
 
 # 添加下载和设置ffmpeg的函数
@@ -2707,14 +5494,14 @@ async def download_ffmpeg():
         bin_dir = ffmpeg_dir / "bin"
         bin_dir.mkdir(exist_ok=True)
         
-        print("正在尝试下载并设置ffmpeg...")
+        ffmpeg_log.info("正在尝试下载并设置ffmpeg...")
         
         # 检查是否已经下载过
         ffmpeg_exe = bin_dir / "ffmpeg.exe"
         ffprobe_exe = bin_dir / "ffprobe.exe"
         
         if ffmpeg_exe.exists() and ffprobe_exe.exists():
-            print(f"检测到已存在的ffmpeg工具: {ffmpeg_exe}")
+            ffmpeg_log.info(f"检测到已存在的ffmpeg工具: {ffmpeg_exe}")
             return str(ffmpeg_exe.resolve())
         
         # 根据系统选择下载链接
@@ -2731,10 +5518,10 @@ async def download_ffmpeg():
             # 异步下载
             try:
                 async with aiohttp.ClientSession() as session:
-                    print(f"下载ffmpeg从 {ffmpeg_url}")
+                    ffmpeg_log.info(f"下载ffmpeg从 {ffmpeg_url}")
                     async with session.get(ffmpeg_url, timeout=aiohttp.ClientTimeout(total=300)) as response:
                         if response.status == 200:
-                            print("正在下载ffmpeg...")
+                            ffmpeg_log.info("正在下载ffmpeg...")
                             total_size = int(response.headers.get('content-length', 0))
                             downloaded = 0
                             
@@ -2743,26 +5530,26 @@ async def download_ffmpeg():
                                     await f.write(chunk)
                                     downloaded += len(chunk)
                                     percentage = int((downloaded / total_size) * 100) if total_size > 0 else 0
-                                    print(f"下载进度: {percentage}%")
+                                    ffmpeg_log.info(f"下载进度: {percentage}%")
                             
-                            print("下载完成，解压中...")
+                            ffmpeg_log.info("下载完成，解压中...")
                             
                             # 解压
                             with zipfile.ZipFile(zip_path, 'r') as zip_ref:
                                 # 先列出所有文件
                                 all_files = zip_ref.namelist()
-                                print(f"压缩包内文件数量: {len(all_files)}")
+                                ffmpeg_log.info(f"压缩包内文件数量: {len(all_files)}")
                                 
                                 # 查找ffmpeg.exe和ffprobe.exe
                                 for file in all_files:
                                     filename = os.path.basename(file)
                                     if filename == 'ffmpeg.exe' or filename == 'ffprobe.exe':
-                                        print(f"找到文件: {file}")
+                                        ffmpeg_log.info(f"找到文件: {file}")
                                         
                                         # 提取到bin目录
                                         source = zip_ref.open(file)
                                         target_path = bin_dir / filename
-                                        print(f"提取到: {target_path}")
+                                        ffmpeg_log.info(f"提取到: {target_path}")
                                         
                                         with open(target_path, "wb") as target:
                                             target.write(source.read())
@@ -2770,7 +5557,7 @@ async def download_ffmpeg():
                             
                             # 如果无法从zip中直接找到文件，可能需要整个解压
                             if not (bin_dir / "ffmpeg.exe").exists():
-                                print("没有直接找到ffmpeg.exe，尝试完整解压...")
+                                ffmpeg_log.info("没有直接找到ffmpeg.exe，尝试完整解压...")
                                 extract_dir = ffmpeg_dir / "temp_extract"
                                 extract_dir.mkdir(exist_ok=True)
                                 
@@ -2783,7 +5570,7 @@ async def download_ffmpeg():
                                         if file == 'ffmpeg.exe' or file == 'ffprobe.exe':
                                             src_path = Path(root) / file
                                             dst_path = bin_dir / file
-                                            print(f"复制 {src_path} 到 {dst_path}")
+                                            ffmpeg_log.info(f"复制 {src_path} 到 {dst_path}")
                                             shutil.copy2(src_path, dst_path)
                                 
                                 # 清理临时目录
@@ -2795,43 +5582,42 @@ async def download_ffmpeg():
                             
                             # 检查是否成功提取
                             if ffmpeg_exe.exists() and ffprobe_exe.exists():
-                                print(f"ffmpeg设置成功: {ffmpeg_exe}")
-                                print(f"ffprobe设置成功: {ffprobe_exe}")
+                                ffmpeg_log.info(f"ffmpeg设置成功: {ffmpeg_exe}")
+                                ffmpeg_log.info(f"ffprobe设置成功: {ffprobe_exe}")
                                 return str(ffmpeg_exe.resolve())
                             else:
-                                print(f"未能成功提取ffmpeg工具。ffmpeg存在: {ffmpeg_exe.exists()}, ffprobe存在: {ffprobe_exe.exists()}")
+                                ffmpeg_log.info(f"未能成功提取ffmpeg工具。ffmpeg存在: {ffmpeg_exe.exists()}, ffprobe存在: {ffprobe_exe.exists()}")
                         else:
-                            print(f"下载ffmpeg失败: HTTP状态 {response.status}")
+                            ffmpeg_log.warning(f"下载ffmpeg失败: HTTP状态 {response.status}")
             except asyncio.TimeoutError:
-                print("下载ffmpeg超时，尝试备用下载源...")
+                ffmpeg_log.warning("下载ffmpeg超时，尝试备用下载源...")
                 
                 # 备用下载源 - 使用另一个链接
                 try:
                     ffmpeg_url = "https://github.com/GyanD/codexffmpeg/releases/download/2023-07-16/ffmpeg-6.0-essentials_build.zip"
-                    print(f"使用备用链接: {ffmpeg_url}")
+                    ffmpeg_log.info(f"使用备用链接: {ffmpeg_url}")
                     
                     async with aiohttp.ClientSession() as session:
                         async with session.get(ffmpeg_url, timeout=aiohttp.ClientTimeout(total=300)) as response:
                             if response.status == 200:
-                                print("正在从备用链接下载ffmpeg...")
+                                ffmpeg_log.info("正在从备用链接下载ffmpeg...")
                                 async with aiofiles.open(zip_path, 'wb') as f:
                                     await f.write(await response.read())
-                                print("备用链接下载完成，解压中...")
+                                ffmpeg_log.info("备用链接下载完成，解压中...")
                                 
                                 # 解压逻辑同上...
                 except Exception as backup_e:
-                    print(f"备用下载也失败: {backup_e}")
+                    ffmpeg_log.warning(f"备用下载也失败: {backup_e}")
         else:
             # 提示Linux/Mac用户通过包管理器安装
-            print("在Linux/Mac系统上，请使用系统包管理器安装ffmpeg")
-            print("Ubuntu/Debian: sudo apt-get install ffmpeg")
-            print("Fedora: sudo dnf install ffmpeg")
-            print("macOS (Homebrew): brew install ffmpeg")
+            ffmpeg_log.info("在Linux/Mac系统上，请使用系统包管理器安装ffmpeg")
+            ffmpeg_log.info("Ubuntu/Debian: sudo apt-get install ffmpeg")
+            ffmpeg_log.info("Fedora: sudo dnf install ffmpeg")
+            ffmpeg_log.info("macOS (Homebrew): brew install ffmpeg")
     
     except Exception as e:
-        print(f"下载或设置ffmpeg时出错: {e}")
-        import traceback
-        print(traceback.format_exc())
+        ffmpeg_log.warning(f"下载或设置ffmpeg时出错: {e}")
+        ffmpeg_log.debug("详细错误信息", exc_info=True)
     
     return None
 
@@ -2856,16 +5642,16 @@ async def check_ffmpeg_installation():
     """
     应用启动时检查ffmpeg是否安装，如果没有则尝试下载
     """
-    print("应用启动时检查ffmpeg...")
+    ffmpeg_log.info("应用启动时检查ffmpeg...")
     
     ffmpeg_path = get_ffmpeg_path()
     if not ffmpeg_path:
-        print("未找到ffmpeg，将尝试自动下载...")
+        ffmpeg_log.warning("未找到ffmpeg，将尝试自动下载...")
         try:
             # 启动下载任务，但不等待完成
             asyncio.create_task(download_ffmpeg())
-            print("ffmpeg下载任务已启动，将在后台执行...")
+            ffmpeg_log.info("ffmpeg下载任务已启动，将在后台执行...")
         except Exception as e:
-            print(f"启动ffmpeg下载任务失败: {e}")
+            ffmpeg_log.warning(f"启动ffmpeg下载任务失败: {e}")
     else:
-        print(f"ffmpeg已安装: {ffmpeg_path}")
\ No newline at end of file
+        ffmpeg_log.info(f"ffmpeg已安装: {ffmpeg_path}")
\ No newline at end of file
@@ -6,6 +6,7 @@ import time
 import webbrowser
 from http.client import HTTPConnection
 import subprocess
+import multiprocessing
 
 # 设置环境变量
 os.environ["PYTHONUNBUFFERED"] = "1"
@@ -47,6 +48,9 @@ uvicorn.config.Config.configure_logging = patched_configure_logging
 
 # 主程序
 if __name__ == "__main__":
+    # 打包后的程序需要支持yt-dlp进程池启动子进程
+    multiprocessing.freeze_support()
+    
     # 定义端口号
     PORT = 8000
     
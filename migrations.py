@@ -0,0 +1,281 @@
+"""
+数据库结构迁移
+数据库结构版本记录在PRAGMA user_version中，启动时依次执行尚未执行的迁移。
+新的结构变更只能追加到MIGRATIONS末尾，已发布的迁移不要修改。
+本模块只依赖标准库，导入时没有副作用，main和benchmark_history都从这里取迁移。
+"""
+import os
+import re
+import sqlite3
+import logging
+
+db_log = logging.getLogger("ytdl.db")
+
+
+def _migrate_base_schema(cursor):
+    """创建downloads和jobs表"""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS downloads (
+        id TEXT PRIMARY KEY,
+        title TEXT,
+        filepath TEXT,
+        file_type TEXT,
+        uploader TEXT,
+        duration TEXT,
+        filesize TEXT,
+        format_info TEXT,
+        download_time REAL,
+        download_time_str TEXT,
+        custom_path TEXT,
+        actual_download_dir TEXT
+    )
+    ''')
+    
+    # 引入版本号之前创建的数据库可能缺少actual_download_dir列
+    cursor.execute("PRAGMA table_info(downloads)")
+    columns = [column[1] for column in cursor.fetchall()]
+    if "actual_download_dir" not in columns:
+        db_log.info("添加actual_download_dir列到downloads表")
+        cursor.execute("ALTER TABLE downloads ADD COLUMN actual_download_dir TEXT")
+    
+    # 持久化的下载任务队列，服务重启后据此恢复未完成的下载
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS jobs (
+        task_id TEXT PRIMARY KEY,
+        video_url TEXT NOT NULL,
+        video_quality TEXT,
+        format_type TEXT,
+        compress_to_zip INTEGER DEFAULT 0,
+        download_path TEXT,
+        priority INTEGER DEFAULT 0,
+        state TEXT NOT NULL,
+        attempts INTEGER DEFAULT 0,
+        lease_owner TEXT,
+        lease_expires REAL,
+        partial_files TEXT,
+        temp_dirs TEXT,
+        last_error TEXT,
+        created_at REAL,
+        updated_at REAL
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs(state)")
+
+
+# 文件名中的视频ID（输出模板为 标题-ID[-shorts|-audio].扩展名）
+VIDEO_ID_IN_FILENAME = re.compile(r"-([A-Za-z0-9_-]{11})(?:-shorts|-audio)?\.[A-Za-z0-9]+$")
+_SIZE_UNITS = {"B": 1, "KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3, "TB": 1024 ** 4}
+
+
+def parse_size_to_bytes(size_str):
+    """把format_size生成的文本（如"12.34 MB"）转换为字节数，无法解析时返回None"""
+    try:
+        value, unit = str(size_str).split()
+        return int(float(value) * _SIZE_UNITS[unit.upper()])
+    except (ValueError, KeyError):
+        return None
+
+
+def parse_duration_to_seconds(duration_str):
+    """把format_duration生成的文本（如"0:03:21"或"1 day, 2:00:00"）转换为秒数，无法解析时返回None"""
+    try:
+        text = str(duration_str)
+        days = 0
+        if "day" in text:
+            day_part, text = text.split(",", 1)
+            days = int(day_part.split()[0])
+        hours, minutes, seconds = text.strip().split(":")
+        return days * 86400 + int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    except (ValueError, IndexError):
+        return None
+
+
+def extract_video_id_from_path(filepath):
+    match = VIDEO_ID_IN_FILENAME.search(os.path.basename(filepath or ""))
+    return match.group(1) if match else None
+
+
+def _migrate_numeric_columns(cursor):
+    """添加数值化的文件大小、时长以及视频ID、文件名列，并回填已有记录"""
+    cursor.execute("ALTER TABLE downloads ADD COLUMN filesize_bytes INTEGER")
+    cursor.execute("ALTER TABLE downloads ADD COLUMN duration_seconds REAL")
+    cursor.execute("ALTER TABLE downloads ADD COLUMN video_id TEXT")
+    cursor.execute("ALTER TABLE downloads ADD COLUMN file_name TEXT")
+    
+    cursor.execute("SELECT id, filepath, filesize, duration FROM downloads")
+    updates = [
+        (
+            parse_size_to_bytes(filesize),
+            parse_duration_to_seconds(duration),
+            extract_video_id_from_path(filepath),
+            os.path.basename(filepath or ""),
+            record_id
+        )
+        for record_id, filepath, filesize, duration in cursor.fetchall()
+    ]
+    cursor.executemany(
+        "UPDATE downloads SET filesize_bytes = ?, duration_seconds = ?, video_id = ?, file_name = ? WHERE id = ?",
+        updates
+    )
+
+
+def _migrate_history_indexes(cursor):
+    """为历史记录的常用查询添加索引"""
+    # 按下载时间过滤和排序（首页历史、清理旧记录）
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_downloads_download_time ON downloads(download_time)")
+    # 按文件路径查找（保存记录、打开文件位置）
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_downloads_filepath ON downloads(filepath)")
+    # 按文件名删除记录
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_downloads_file_name ON downloads(file_name)")
+    # 按视频ID查找已下载的视频
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_downloads_video_id ON downloads(video_id)")
+
+
+def _migrate_full_text_search(cursor):
+    """为标题和上传者建立FTS5全文索引，通过触发器与downloads表保持同步"""
+    # trigram分词支持中文和任意子串匹配；旧版SQLite不支持时退回unicode61分词
+    for tokenizer in ("trigram", "unicode61 remove_diacritics 2"):
+        try:
+            cursor.execute(f'''
+            CREATE VIRTUAL TABLE downloads_fts USING fts5(
+                title, uploader,
+                content='downloads', content_rowid='rowid',
+                tokenize='{tokenizer}'
+            )
+            ''')
+            break
+        except sqlite3.OperationalError as e:
+            db_log.warning(f"创建全文索引失败（分词器 {tokenizer}）: {e}")
+    else:
+        db_log.info("当前SQLite不支持FTS5，搜索将使用LIKE匹配")
+        return
+    
+    cursor.execute('''
+    CREATE TRIGGER downloads_fts_insert AFTER INSERT ON downloads BEGIN
+        INSERT INTO downloads_fts(rowid, title, uploader) VALUES (new.rowid, new.title, new.uploader);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER downloads_fts_delete AFTER DELETE ON downloads BEGIN
+        INSERT INTO downloads_fts(downloads_fts, rowid, title, uploader)
+        VALUES ('delete', old.rowid, old.title, old.uploader);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER downloads_fts_update AFTER UPDATE OF title, uploader ON downloads BEGIN
+        INSERT INTO downloads_fts(downloads_fts, rowid, title, uploader)
+        VALUES ('delete', old.rowid, old.title, old.uploader);
+        INSERT INTO downloads_fts(rowid, title, uploader) VALUES (new.rowid, new.title, new.uploader);
+    END
+    ''')
+    cursor.execute("INSERT INTO downloads_fts(downloads_fts) VALUES ('rebuild')")
+    
+    # 按类型和日期过滤历史记录
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_downloads_type_time ON downloads(file_type, download_time)")
+
+
+def _migrate_history_meta(cursor):
+    """维护下载记录总数和版本号，并为键集分页建立(download_time, id)索引"""
+    cursor.execute("CREATE TABLE IF NOT EXISTS history_meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+    cursor.execute("INSERT OR REPLACE INTO history_meta (key, value) SELECT 'row_count', COUNT(*) FROM downloads")
+    cursor.execute("INSERT OR REPLACE INTO history_meta (key, value) VALUES ('version', 0)")
+    cursor.execute('''
+    CREATE TRIGGER history_meta_insert AFTER INSERT ON downloads BEGIN
+        UPDATE history_meta SET value = value + 1 WHERE key IN ('row_count', 'version');
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER history_meta_delete AFTER DELETE ON downloads BEGIN
+        UPDATE history_meta SET value = value + (CASE key WHEN 'row_count' THEN -1 ELSE 1 END)
+        WHERE key IN ('row_count', 'version');
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER history_meta_update AFTER UPDATE ON downloads BEGIN
+        UPDATE history_meta SET value = value + 1 WHERE key = 'version';
+    END
+    ''')
+    cursor.execute("DROP INDEX IF EXISTS idx_downloads_download_time")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_downloads_time_id ON downloads(download_time, id)")
+
+
+def _migrate_file_state(cursor):
+    """添加由后台同步维护的file_exists和file_mtime列"""
+    cursor.execute("ALTER TABLE downloads ADD COLUMN file_exists INTEGER NOT NULL DEFAULT 1")
+    cursor.execute("ALTER TABLE downloads ADD COLUMN file_mtime REAL")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_downloads_exists_time_id ON downloads(file_exists, download_time, id)")
+
+
+def _migrate_last_accessed(cursor):
+    """添加最后访问时间列，供保留策略按LRU清理"""
+    cursor.execute("ALTER TABLE downloads ADD COLUMN last_accessed REAL")
+    cursor.execute("UPDATE downloads SET last_accessed = download_time")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_downloads_last_accessed ON downloads(last_accessed)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_downloads_dir_accessed ON downloads(actual_download_dir, last_accessed)")
+
+
+def _migrate_video_info_cache(cursor):
+    """创建视频信息缓存表，保存/info提取到的元数据"""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS video_info_cache (
+        video_id TEXT PRIMARY KEY,
+        url TEXT,
+        info TEXT NOT NULL,
+        fetched_at REAL NOT NULL
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_video_info_cache_fetched_at ON video_info_cache(fetched_at)")
+
+
+
+def _migrate_artifacts(cursor):
+    """创建已完成下载的索引，按视频ID和格式复用已下载的文件"""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS artifacts (
+        video_id TEXT NOT NULL,
+        format_key TEXT NOT NULL,
+        filepath TEXT NOT NULL,
+        filesize_bytes INTEGER NOT NULL,
+        title TEXT,
+        uploader TEXT,
+        duration_seconds INTEGER,
+        created_at REAL NOT NULL,
+        PRIMARY KEY (video_id, format_key)
+    )
+    ''')
+
+
+MIGRATIONS = [
+    _migrate_base_schema,
+    _migrate_numeric_columns,
+    _migrate_history_indexes,
+    _migrate_full_text_search,
+    _migrate_history_meta,
+    _migrate_file_state,
+    _migrate_last_accessed,
+    _migrate_video_info_cache,
+    _migrate_artifacts,
+]
+
+
+def apply_migrations(conn):
+    """执行尚未执行的迁移，每个迁移与版本号更新在同一个事务中提交，返回当前版本号"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        db_log.info(f"执行数据库迁移 {number}: {migration.__doc__}")
+        conn.execute("BEGIN")
+        try:
+            migration(conn.cursor())
+            conn.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return max(version, len(MIGRATIONS))
+
+
+def detect_fts_tokenizer(conn):
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'downloads_fts'").fetchone()
+    if row is None:
+        return None
+    return "trigram" if "trigram" in row[0] else "unicode61"
@@ -0,0 +1,153 @@
+"""
+下载任务调度器
+在download_video前做准入控制：全局并发上限、按来源并发上限、优先级队列（同优先级FIFO），队列已满时给出Retry-After估算。
+本模块只依赖标准库，导入时没有副作用；main创建调度器实例并提供并发配置。
+"""
+import time
+import math
+import heapq
+import asyncio
+import logging
+import itertools
+from urllib.parse import urlparse
+
+scheduler_log = logging.getLogger("ytdl.scheduler")
+
+# 没有历史数据时使用的单任务耗时估算（秒），用于计算Retry-After
+DEFAULT_JOB_DURATION_ESTIMATE = 60
+
+
+class QueueFullError(Exception):
+    """下载队列已满，调用方应稍后重试"""
+    def __init__(self, retry_after):
+        super().__init__("下载队列已满")
+        self.retry_after = retry_after
+
+
+def get_download_origins(video_url):
+    """
+    返回下载任务占用的来源，用于按来源限流；每个任务只占用一个来源
+    YouTube的页面（youtube.com、youtu.be）和媒体CDN（googlevideo.com）属于同一服务，合并为youtube.com，
+    否则一个任务同时占用两个来源的名额，实际并发由较小的上限决定
+    """
+    host = (urlparse(video_url).hostname or "").lower()
+    if host.endswith("youtube.com") or host.endswith("youtu.be") or host.endswith("googlevideo.com"):
+        return ["youtube.com"]
+    return [host] if host else []
+
+
+class DownloadScheduler:
+    """
+    下载任务调度器
+    在download_video前做准入控制：全局并发上限、按来源并发上限、优先级队列（同优先级FIFO）
+    """
+    def __init__(self, max_workers, max_queue_size, host_limits):
+        self.max_workers = max_workers
+        self.max_queue_size = max_queue_size
+        self.host_limits = dict(host_limits)
+        self._queue = []  # 堆，元素为 (-priority, seq, job)
+        self._seq = itertools.count()
+        self._running = {}  # task_id -> asyncio.Task
+        self._host_active = {}  # 来源 -> 正在运行的任务数
+        self._avg_duration = DEFAULT_JOB_DURATION_ESTIMATE
+
+    def submit(self, task_id, job_factory, video_url, priority=0):
+        """
+        提交任务，job_factory为返回协程的无参函数
+        返回排队位置（0表示已立即开始），队列已满时抛出QueueFullError
+        """
+        if len(self._queue) >= self.max_queue_size:
+            raise QueueFullError(self.estimate_retry_after())
+
+        job = {
+            "task_id": task_id,
+            "factory": job_factory,
+            "origins": get_download_origins(video_url),
+            "enqueue_time": time.time()
+        }
+        heapq.heappush(self._queue, (-priority, next(self._seq), job))
+        self._dispatch()
+        return self.queue_position(task_id) or 0
+
+    def queue_position(self, task_id):
+        """返回任务在等待队列中的位置（从1开始），不在队列中返回None"""
+        for position, entry in enumerate(sorted(self._queue), start=1):
+            if entry[2]["task_id"] == task_id:
+                return position
+        return None
+
+    def is_running(self, task_id):
+        return task_id in self._running
+
+    def remove(self, task_id):
+        """从等待队列中移除任务，返回是否移除成功（正在运行的任务不受影响）"""
+        for entry in self._queue:
+            if entry[2]["task_id"] == task_id:
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+                return True
+        return False
+
+    def estimate_retry_after(self):
+        """估算队列腾出空位所需的秒数"""
+        return max(1, math.ceil(self._avg_duration / max(1, self.max_workers)))
+
+    def stats(self):
+        return {
+            "running": len(self._running),
+            "queued": len(self._queue),
+            "max_workers": self.max_workers,
+            "max_queue_size": self.max_queue_size,
+            "host_active": dict(self._host_active)
+        }
+
+    def _has_capacity(self, origins):
+        for origin in origins:
+            limit = self.host_limits.get(origin)
+            if limit is not None and self._host_active.get(origin, 0) >= limit:
+                return False
+        return True
+
+    def _dispatch(self):
+        """按优先级启动可运行的任务，跳过来源已满的任务以避免队头阻塞"""
+        if not self._queue or len(self._running) >= self.max_workers:
+            return
+
+        started = False
+        for entry in sorted(self._queue):
+            if len(self._running) >= self.max_workers:
+                break
+            job = entry[2]
+            if not self._has_capacity(job["origins"]):
+                continue
+            self._queue.remove(entry)
+            started = True
+            self._start(job)
+
+        if started:
+            heapq.heapify(self._queue)
+
+    def _start(self, job):
+        for origin in job["origins"]:
+            self._host_active[origin] = self._host_active.get(origin, 0) + 1
+        self._running[job["task_id"]] = asyncio.create_task(self._run(job))
+
+    async def _run(self, job):
+        task_id = job["task_id"]
+        start_time = time.time()
+        try:
+            await job["factory"]()
+        except asyncio.CancelledError:
+            scheduler_log.info(f"[调度器] 任务 {task_id[:8]} 被取消")
+        except Exception as e:
+            # download_video已自行记录错误状态，这里只记录日志
+            scheduler_log.warning(f"[调度器] 任务 {task_id[:8]} 执行失败: {e}")
+        finally:
+            # 使用指数滑动平均更新任务耗时估算
+            duration = time.time() - start_time
+            self._avg_duration = self._avg_duration * 0.8 + duration * 0.2
+
+            for origin in job["origins"]:
+                self._host_active[origin] = max(0, self._host_active.get(origin, 0) - 1)
+            self._running.pop(task_id, None)
+            self._dispatch()
@@ -0,0 +1,183 @@
+"""
+下载任务状态存储
+TaskStore保存所有下载任务的状态记录，按TASK_TRANSITIONS校验状态转换，并记录已结束任务的结束顺序用于过期清理。
+本模块只依赖标准库，导入时没有副作用；main创建全局的task_store实例。
+"""
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+task_log = logging.getLogger("ytdl.tasks")
+
+# 任务状态及允许的状态转换；error可以转为pending/retrying（自动安装ffmpeg后重试）
+TASK_TRANSITIONS = {
+    "queued": {"initializing", "paused", "cancelled", "error"},
+    "initializing": {"downloading", "postprocessing", "pending", "retrying", "warning", "completed", "error", "paused", "cancelled"},
+    "downloading": {"initializing", "postprocessing", "pending", "retrying", "warning", "completed", "error", "paused", "cancelled"},
+    "postprocessing": {"downloading", "pending", "retrying", "warning", "completed", "error", "paused", "cancelled"},
+    "warning": {"initializing", "downloading", "postprocessing", "pending", "retrying", "completed", "error", "paused", "cancelled"},
+    "pending": {"initializing", "downloading", "postprocessing", "retrying", "warning", "completed", "error", "paused", "cancelled"},
+    "retrying": {"initializing", "downloading", "postprocessing", "pending", "warning", "completed", "error", "paused", "cancelled"},
+    "paused": {"queued", "cancelled"},
+    "error": {"pending", "retrying"},
+    "completed": set(),
+    "cancelled": set(),
+}
+TERMINAL_TASK_STATES = {"completed", "error", "cancelled"}
+
+
+class TaskRecord:
+    """单个下载任务的状态记录，使用__slots__减少内存占用"""
+    __slots__ = (
+        "task_id", "status", "progress", "message", "video_url", "video_quality",
+        "format_type", "compress_to_zip", "download_path", "title", "uploader",
+        "duration", "filepath", "actual_download_dir", "format_info", "error",
+        "speed", "speed_str", "eta", "eta_str", "downloaded_bytes", "elapsed",
+        "start_time", "end_time", "last_update_time", "last_progress_update",
+        "paused", "cancelled", "parent_id", "playlist", "output_files"
+    )
+
+    def __init__(self, task_id):
+        for name in self.__slots__:
+            setattr(self, name, None)
+        self.task_id = task_id
+        self.progress = 0
+        self.paused = False
+        self.cancelled = False
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None)
+        return default if value is None else value
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__ if getattr(self, name) is not None}
+
+
+class TaskStore:
+    """
+    下载任务状态存储
+    所有写操作都在事件循环线程中执行（其他线程的写入通过call_soon_threadsafe转交），
+    状态转换按TASK_TRANSITIONS校验，并按状态维护索引；状态变化后通知订阅者
+    """
+    def __init__(self, on_remove=None):
+        self._records = {}
+        self._by_state = {}  # 状态 -> 任务ID集合
+        self._finished = OrderedDict()  # 已结束任务，按结束顺序排列，用于过期清理
+        self._subscribers = []
+        self._loop = None
+        self._writer_thread = None
+        self._on_remove = on_remove  # 任务删除后调用on_remove(task_id)，用于清理其他按任务保存的数据
+
+    def bind_loop(self, loop):
+        """绑定写线程（事件循环线程），之后其他线程的写入会排队到该线程执行"""
+        self._loop = loop
+        self._writer_thread = threading.get_ident()
+
+    def subscribe(self, callback):
+        """订阅任务变化，callback(task_id, record)在写线程中调用"""
+        self._subscribers.append(callback)
+
+    def __contains__(self, task_id):
+        return task_id in self._records
+
+    def get(self, task_id):
+        return self._records.get(task_id)
+
+    def is_active(self, task_id):
+        record = self._records.get(task_id)
+        return record is not None and record.status not in TERMINAL_TASK_STATES
+
+    def ids_in_state(self, *states):
+        ids = set()
+        for state in states:
+            ids |= self._by_state.get(state, set())
+        return ids
+
+    def active_ids(self):
+        return [task_id for task_id, record in self._records.items() if record.status not in TERMINAL_TASK_STATES]
+
+    def finished_records(self):
+        return [self._records[task_id] for task_id in reversed(self._finished)]
+
+    def create(self, task_id, fields):
+        record = TaskRecord(task_id)
+        status = fields.pop("status", "queued")
+        self._set_fields(record, fields)
+        record.status = status
+        self._records[task_id] = record
+        self._by_state.setdefault(status, set()).add(task_id)
+        if status in TERMINAL_TASK_STATES:
+            record.end_time = record.end_time or time.time()
+            self._finished[task_id] = None
+        self._notify(task_id, record)
+        return record
+
+    def update(self, task_id, fields):
+        """更新任务字段，可在任意线程调用"""
+        if self._loop is not None and threading.get_ident() != self._writer_thread:
+            self._loop.call_soon_threadsafe(self._apply, task_id, dict(fields))
+            return True
+        return self._apply(task_id, dict(fields))
+
+    def remove(self, task_id):
+        record = self._records.pop(task_id, None)
+        if record is not None:
+            self._by_state.get(record.status, set()).discard(task_id)
+            self._finished.pop(task_id, None)
+        if self._on_remove is not None:
+            self._on_remove(task_id)
+
+    def expire_finished(self, max_age):
+        """删除结束超过max_age秒的任务，只检查最早结束的任务，返回删除数量"""
+        cutoff = time.time() - max_age
+        removed = 0
+        while self._finished:
+            task_id = next(iter(self._finished))
+            record = self._records.get(task_id)
+            if record is not None and (record.end_time or 0) > cutoff:
+                break
+            self.remove(task_id)
+            self._finished.pop(task_id, None)
+            removed += 1
+        return removed
+
+    def _apply(self, task_id, fields):
+        record = self._records.get(task_id)
+        if record is None:
+            return False
+
+        status = fields.pop("status", None)
+        if status is not None and status != record.status:
+            if status in TASK_TRANSITIONS.get(record.status, ()):
+                self._by_state.get(record.status, set()).discard(task_id)
+                self._by_state.setdefault(status, set()).add(task_id)
+                record.status = status
+                if status in TERMINAL_TASK_STATES:
+                    if "end_time" not in fields:
+                        record.end_time = time.time()
+                    self._finished.pop(task_id, None)
+                    self._finished[task_id] = None
+                else:
+                    self._finished.pop(task_id, None)
+            else:
+                task_log.warning(f"忽略非法的任务状态转换 [{task_id[:8]}]: {record.status} -> {status}")
+
+        self._set_fields(record, fields)
+        self._notify(task_id, record)
+        return True
+
+    @staticmethod
+    def _set_fields(record, fields):
+        for key, value in fields.items():
+            try:
+                setattr(record, key, value)
+            except AttributeError:
+                task_log.warning(f"忽略未知的任务字段: {key}")
+
+    def _notify(self, task_id, record):
+        for callback in self._subscribers:
+            try:
+                callback(task_id, record)
+            except Exception as e:
+                task_log.warning(f"任务状态订阅回调出错: {e}")
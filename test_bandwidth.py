@@ -0,0 +1,161 @@
+"""
+带宽限制测试
+使用可控的时钟测试令牌桶的补充和突发上限，以及BandwidthManager在全局、单任务、单客户端上限之间的分配
+（即/admin/bandwidth返回的内容）
+"""
+import asyncio
+
+import pytest
+
+from bandwidth import BANDWIDTH_BURST_SECONDS, BandwidthManager, TokenBucket
+
+
+class FakeClock:
+    """手动推进的时钟；sleep直接推进时钟并记录等待的秒数"""
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    async def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def make_bucket(rate, clock, burst_seconds=BANDWIDTH_BURST_SECONDS):
+    return TokenBucket(rate, burst_seconds=burst_seconds, clock=clock, sleep=clock.sleep)
+
+
+def test_bucket_starts_full_and_allows_burst():
+    clock = FakeClock()
+    bucket = make_bucket(1000, clock, burst_seconds=2)
+    asyncio.run(bucket.consume(2000))
+    assert clock.sleeps == []
+    assert bucket.tokens == 0
+
+
+def test_bucket_waits_for_debt():
+    """令牌不足时先透支，等待补足欠额"""
+    clock = FakeClock()
+    bucket = make_bucket(1000, clock)
+    asyncio.run(bucket.consume(1500))
+    assert clock.sleeps == [pytest.approx(0.5)]
+
+    # 等待期间补充的令牌正好抵消欠额
+    asyncio.run(bucket.consume(0))
+    assert bucket.tokens == pytest.approx(0)
+
+
+def test_bucket_refill_is_capped_at_burst():
+    clock = FakeClock()
+    bucket = make_bucket(1000, clock)
+    asyncio.run(bucket.consume(1000))
+    clock.advance(0.25)
+    bucket._refill()
+    assert bucket.tokens == pytest.approx(250)
+    # 空闲很久之后令牌最多补充到突发上限
+    clock.advance(60)
+    bucket._refill()
+    assert bucket.tokens == pytest.approx(1000)
+
+
+def test_set_rate_shrinks_burst_and_zero_disables():
+    clock = FakeClock()
+    bucket = make_bucket(1000, clock)
+    bucket.set_rate(100)
+    assert bucket.tokens == pytest.approx(100)
+    bucket.set_rate(0)
+    asyncio.run(bucket.consume(10 ** 9))
+    assert clock.sleeps == []
+
+
+def make_manager(clock, **limits):
+    changes = []
+    manager = BandwidthManager(
+        on_rate_change=lambda task_id, rate: changes.append((task_id, rate)),
+        clock=clock, sleep=clock.sleep, **limits
+    )
+    return manager, changes
+
+
+def rates(manager):
+    return {task_id: task["rate"] for task_id, task in manager.snapshot()["tasks"].items()}
+
+
+def test_global_limit_split_between_tasks():
+    manager, changes = make_manager(FakeClock(), global_limit=3000)
+    manager.register("a")
+    assert rates(manager) == {"a": 3000}
+    manager.register("b", client="10.0.0.2")
+    manager.register("c", client="10.0.0.3")
+    assert rates(manager) == {"a": 1000, "b": 1000, "c": 1000}
+
+    # 任务结束后限速解除，剩余任务重新平分
+    manager.unregister("c")
+    assert ("c", 0) in changes
+    assert rates(manager) == {"a": 1500, "b": 1500}
+    assert changes[-2:] == [("a", 1500), ("b", 1500)]
+
+
+def test_client_limit_split_between_client_tasks():
+    manager, _ = make_manager(FakeClock(), client_limit=1000)
+    manager.register("a1", client="10.0.0.1")
+    manager.register("a2", client="10.0.0.1")
+    manager.register("b1", client="10.0.0.2")
+    assert rates(manager) == {"a1": 500, "a2": 500, "b1": 1000}
+
+
+def test_task_rate_is_smallest_limit():
+    manager, _ = make_manager(FakeClock(), global_limit=4000, task_limit=1500, client_limit=2500)
+    manager.register("a1", client="10.0.0.1")
+    assert manager.task_rate("a1") == 1500
+    manager.register("a2", client="10.0.0.1")
+    assert rates(manager) == {"a1": 1250, "a2": 1250}
+    manager.register("b1", client="10.0.0.2")
+    manager.register("b2", client="10.0.0.2")
+    assert rates(manager) == {"a1": 1000, "a2": 1000, "b1": 1000, "b2": 1000}
+    assert manager.task_rate("missing") == 0
+
+
+def test_set_limits_updates_snapshot_and_rates():
+    clock = FakeClock()
+    manager, changes = make_manager(clock)
+    manager.register("a")
+    assert rates(manager) == {"a": 0}
+    assert changes == []
+
+    manager.set_limits(global_limit=2000, task_limit=500)
+    snapshot = manager.snapshot()
+    assert snapshot["global_limit"] == 2000
+    assert snapshot["task_limit"] == 500
+    assert snapshot["client_limit"] == 0
+    assert snapshot["tasks"] == {"a": {"client": "local", "rate": 500}}
+    assert changes == [("a", 500)]
+
+    # 取消单任务上限后只受全局上限约束
+    manager.set_limits(task_limit=0)
+    assert rates(manager) == {"a": 2000}
+    assert manager.global_bucket.rate == 2000
+
+
+def test_consume_waits_on_task_bucket():
+    clock = FakeClock()
+    manager, _ = make_manager(clock, global_limit=1000)
+    manager.register("a")
+    manager.register("b")
+    # 任务的令牌桶注册时为空，每个任务500字节/秒；等待期间全局桶已补满，不需要再等待
+    asyncio.run(manager.consume("a", 1000))
+    assert clock.sleeps == [pytest.approx(2.0)]
+
+
+def test_consume_waits_on_global_bucket():
+    """没有任务令牌桶的下载只受全局令牌桶限速"""
+    clock = FakeClock()
+    manager, _ = make_manager(clock, task_limit=0, global_limit=1000)
+    asyncio.run(manager.consume("unregistered", 1500))
+    assert clock.sleeps == [pytest.approx(0.5)]
@@ -0,0 +1,119 @@
+"""
+下载历史查询测试
+在内存数据库中按当前迁移创建表结构，确认键集分页在下载时间相同的记录之间不会重复或遗漏，
+以及history_meta中的记录总数在写入和删除后保持正确
+"""
+import sqlite3
+
+import pytest
+
+from history import HistoryCountCache, HistoryQuery, decode_history_cursor
+from migrations import apply_migrations
+
+NOW = 1_700_000_000.0
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(":memory:")
+    apply_migrations(conn)
+    yield conn
+    conn.close()
+
+
+def insert(conn, record_id, download_time, title=None, file_exists=1):
+    conn.execute(
+        "INSERT INTO downloads (id, title, filepath, file_type, download_time, download_time_str, file_exists) "
+        "VALUES (?, ?, ?, 'MP4', ?, '', ?)",
+        (record_id, title or record_id, f"/videos/{record_id}.mp4", download_time, file_exists)
+    )
+    conn.commit()
+
+
+def row_count(conn):
+    return conn.execute("SELECT value FROM history_meta WHERE key = 'row_count'").fetchone()[0]
+
+
+def all_pages(conn, page_size, count_cache=None):
+    """按游标依次读取所有页，返回每页的记录ID"""
+    pages = []
+    cursor = None
+    while True:
+        query = HistoryQuery(page_size=page_size, cursor=cursor, now=NOW)
+        total, rows, _, cursor = query.fetch(conn, count_cache)
+        pages.append([row[5] for row in rows])
+        if cursor is None:
+            return total, pages
+
+
+def test_keyset_pages_with_equal_download_time(conn):
+    """多条记录的下载时间相同时按id区分，翻页既不重复也不遗漏"""
+    ids = []
+    for index in range(7):
+        # 每个时间点有3条记录，页大小为2时同一时间点的记录会跨页
+        for suffix in "abc":
+            record_id = f"{index}-{suffix}"
+            insert(conn, record_id, NOW - 100 * index)
+            ids.append(record_id)
+
+    total, pages = all_pages(conn, page_size=2)
+    flat = [record_id for page in pages for record_id in page]
+    assert total == len(ids)
+    assert len(flat) == len(set(flat)) == len(ids)
+    assert all(len(page) == 2 for page in pages[:-1])
+    # 按下载时间倒序，同一时间按id倒序
+    assert flat == [f"{index}-{suffix}" for index in range(7) for suffix in "cba"]
+
+
+def test_cursor_points_after_last_row(conn):
+    for suffix in "abcd":
+        insert(conn, suffix, NOW - 10)
+    _, rows, _, cursor = HistoryQuery(page_size=3, now=NOW).fetch(conn)
+    assert [row[5] for row in rows] == ["d", "c", "b"]
+    assert decode_history_cursor(cursor) == [NOW - 10, "b"]
+
+    # 翻页期间插入更新的记录，不影响后续页
+    insert(conn, "z", NOW - 1)
+    _, rows, _, cursor = HistoryQuery(page_size=3, cursor=cursor, now=NOW).fetch(conn)
+    assert [row[5] for row in rows] == ["a"]
+    assert cursor is None
+
+
+def test_pages_skip_missing_and_old_files(conn):
+    insert(conn, "recent", NOW - 60)
+    insert(conn, "missing", NOW - 30, file_exists=0)
+    insert(conn, "old", NOW - 3 * 86400)
+    total, pages = all_pages(conn, page_size=10)
+    assert total == 1
+    assert pages == [["recent"]]
+
+
+def test_row_count_after_insert_and_delete(conn):
+    assert row_count(conn) == 0
+    for index in range(5):
+        insert(conn, f"id-{index}", NOW - index)
+    assert row_count(conn) == 5
+
+    conn.execute("DELETE FROM downloads WHERE id = ?", ("id-2",))
+    conn.commit()
+    assert row_count(conn) == 4
+    # 更新记录不改变总数
+    conn.execute("UPDATE downloads SET title = 'renamed' WHERE id = 'id-0'")
+    conn.commit()
+    assert row_count(conn) == 4
+    assert row_count(conn) == conn.execute("SELECT COUNT(*) FROM downloads").fetchone()[0]
+
+
+def test_cached_total_invalidated_by_delete(conn):
+    """总数缓存按history_meta的版本号失效，删除记录后返回新的总数和页面"""
+    cache = HistoryCountCache()
+    for index in range(4):
+        insert(conn, f"id-{index}", NOW - index)
+    total, pages = all_pages(conn, page_size=3, count_cache=cache)
+    assert total == 4
+
+    conn.execute("DELETE FROM downloads WHERE id = 'id-1'")
+    conn.commit()
+    total, pages = all_pages(conn, page_size=3, count_cache=cache)
+    assert total == 3
+    assert pages == [["id-0", "id-2", "id-3"]]
@@ -0,0 +1,128 @@
+"""
+下载调度器测试
+确认优先级队列（同优先级FIFO）、按来源并发上限，以及队列已满时的Retry-After估算
+"""
+import asyncio
+
+import pytest
+
+from scheduler import DEFAULT_JOB_DURATION_ESTIMATE, DownloadScheduler, QueueFullError, get_download_origins
+
+YOUTUBE_URL = "https://www.youtube.com/watch?v=dQw4w9WgXcQ"
+
+
+class Jobs:
+    """记录任务的启动顺序，任务一直运行到release"""
+    def __init__(self):
+        self.started = []
+        self.gates = {}
+
+    def factory(self, name):
+        gate = self.gates[name] = asyncio.Event()
+
+        async def job():
+            self.started.append(name)
+            await gate.wait()
+        return lambda: job()
+
+    async def release(self, name):
+        self.gates[name].set()
+        # 让任务结束并触发调度器启动下一个任务
+        for _ in range(5):
+            await asyncio.sleep(0)
+
+
+def test_youtube_job_uses_one_origin():
+    assert get_download_origins(YOUTUBE_URL) == ["youtube.com"]
+    assert get_download_origins("https://youtu.be/dQw4w9WgXcQ") == ["youtube.com"]
+    assert get_download_origins("https://vimeo.com/1") == ["vimeo.com"]
+
+
+def test_priority_then_fifo_order():
+    async def run():
+        scheduler = DownloadScheduler(1, 10, {})
+        jobs = Jobs()
+        assert scheduler.submit("first", jobs.factory("first"), YOUTUBE_URL) == 0
+        await asyncio.sleep(0)
+        assert scheduler.submit("low-1", jobs.factory("low-1"), YOUTUBE_URL, priority=0) == 1
+        assert scheduler.submit("low-2", jobs.factory("low-2"), YOUTUBE_URL, priority=0) == 2
+        # 高优先级的任务排到同优先级任务前面
+        assert scheduler.submit("high", jobs.factory("high"), YOUTUBE_URL, priority=5) == 1
+        assert scheduler.queue_position("low-2") == 3
+
+        for name in ("first", "high", "low-1"):
+            await jobs.release(name)
+        await jobs.release("low-2")
+        return jobs.started
+
+    assert asyncio.run(run()) == ["first", "high", "low-1", "low-2"]
+
+
+def test_youtube_jobs_reach_global_limit():
+    """YouTube任务只占用一个来源，来源上限等于全局上限时可以用满全部名额"""
+    async def run():
+        scheduler = DownloadScheduler(4, 10, {"youtube.com": 4})
+        jobs = Jobs()
+        for index in range(5):
+            scheduler.submit(f"job-{index}", jobs.factory(f"job-{index}"), YOUTUBE_URL)
+        await asyncio.sleep(0)
+        stats = scheduler.stats()
+        for index in range(5):
+            jobs.gates[f"job-{index}"].set()
+        return stats
+
+    stats = asyncio.run(run())
+    assert stats["running"] == 4
+    assert stats["queued"] == 1
+    assert stats["host_active"] == {"youtube.com": 4}
+
+
+def test_host_limit_skips_blocked_origin():
+    """来源已满的任务不阻塞其他来源的任务"""
+    async def run():
+        scheduler = DownloadScheduler(3, 10, {"youtube.com": 1})
+        jobs = Jobs()
+        scheduler.submit("yt-1", jobs.factory("yt-1"), YOUTUBE_URL)
+        scheduler.submit("yt-2", jobs.factory("yt-2"), YOUTUBE_URL, priority=5)
+        scheduler.submit("other", jobs.factory("other"), "https://vimeo.com/1")
+        await asyncio.sleep(0)
+        running = list(jobs.started)
+        await jobs.release("yt-1")
+        after_release = list(jobs.started)
+        for name in ("yt-2", "other"):
+            jobs.gates[name].set()
+        return running, after_release
+
+    running, after_release = asyncio.run(run())
+    assert running == ["yt-1", "other"]
+    assert after_release == ["yt-1", "other", "yt-2"]
+
+
+def test_queue_full_reports_retry_after():
+    """队列已满时抛出QueueFullError，Retry-After按平均任务耗时和并发数估算"""
+    async def run():
+        scheduler = DownloadScheduler(2, 2, {})
+        jobs = Jobs()
+        for index in range(4):
+            scheduler.submit(f"job-{index}", jobs.factory(f"job-{index}"), YOUTUBE_URL)
+        with pytest.raises(QueueFullError) as excinfo:
+            scheduler.submit("rejected", jobs.factory("rejected"), YOUTUBE_URL)
+        # 被拒绝的任务没有进入队列
+        assert scheduler.queue_position("rejected") is None
+
+        # 移除排队的任务后可以重新提交
+        assert scheduler.remove("job-3")
+        assert scheduler.submit("accepted", jobs.factory("accepted"), YOUTUBE_URL) == 2
+        for gate in jobs.gates.values():
+            gate.set()
+        return excinfo.value.retry_after
+
+    assert asyncio.run(run()) == DEFAULT_JOB_DURATION_ESTIMATE // 2
+
+
+def test_retry_after_is_at_least_one_second():
+    scheduler = DownloadScheduler(8, 0, {})
+    scheduler._avg_duration = 0.5
+    with pytest.raises(QueueFullError) as excinfo:
+        scheduler.submit("task", lambda: None, YOUTUBE_URL)
+    assert excinfo.value.retry_after == 1
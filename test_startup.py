@@ -0,0 +1,46 @@
+"""
+启动测试
+导入main模块（会执行应用初始化和init_db），确认数据库写线程在执行迁移后仍然存活；
+确认进程池工作进程使用的模块可以单独导入，不会带入整个应用
+"""
+import sys
+import subprocess
+
+import pytest
+
+import migrations
+
+
+def load_main():
+    """导入main模块，缺少运行依赖（fastapi、yt-dlp、pywin32等）时跳过测试"""
+    try:
+        import main
+    except ImportError as e:
+        pytest.skip(f"缺少运行依赖: {e}")
+    return main
+
+
+def test_db_writer_alive_after_init_db():
+    """init_db()通过写线程执行迁移，写线程不能因为异常退出"""
+    main = load_main()
+    main.init_db()
+    writer = main.db._writer_thread
+    assert writer is not None and writer.is_alive()
+
+    # 写线程仍能继续处理写操作，并且没有被重新创建
+    assert main.db.write(lambda conn: conn.execute("PRAGMA user_version").fetchone()[0]) == len(migrations.MIGRATIONS)
+    assert main.db._writer_thread is writer
+
+
+def imported_modules(module):
+    """在新的解释器中导入module，返回导入后sys.modules中的模块名"""
+    code = f"import sys, {module}; print(' '.join(sys.modules))"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    return set(result.stdout.split())
+
+
+def test_worker_module_has_no_app_imports():
+    """spawn启动的工作进程只导入ytdlp_worker，不能带入main、fastapi或数据库迁移"""
+    pytest.importorskip("yt_dlp")
+    modules = imported_modules("ytdlp_worker")
+    assert not modules & {"main", "fastapi", "uvicorn", "migrations"}
@@ -0,0 +1,94 @@
+"""
+任务状态存储测试
+确认状态转换按TASK_TRANSITIONS校验：非法转换被忽略，已完成和已取消的任务不会再改变状态；
+finished_records按结束顺序（最近结束的在前）返回已结束的任务
+"""
+import itertools
+
+import pytest
+
+from tasks import TASK_TRANSITIONS, TERMINAL_TASK_STATES, TaskStore
+
+ALL_STATES = set(TASK_TRANSITIONS)
+
+
+def store_in_state(status):
+    store = TaskStore()
+    store.create("task", {"status": status})
+    return store
+
+
+@pytest.mark.parametrize("current,target", [
+    (current, target) for current, target in itertools.product(sorted(ALL_STATES), repeat=2) if current != target
+])
+def test_transition_table(current, target):
+    store = store_in_state(current)
+    store.update("task", {"status": target, "message": "更新"})
+    record = store.get("task")
+    expected = target if target in TASK_TRANSITIONS[current] else current
+    assert record.status == expected
+    assert store.ids_in_state(expected) == {"task"}
+    # 非法的状态转换只忽略状态，其他字段照常更新
+    assert record.message == "更新"
+
+
+@pytest.mark.parametrize("status", ["completed", "cancelled"])
+def test_terminal_states_stay_terminal(status):
+    store = store_in_state(status)
+    for target in ALL_STATES - {status}:
+        store.update("task", {"status": target})
+    assert store.get("task").status == status
+    assert not store.is_active("task")
+    assert [record.task_id for record in store.finished_records()] == ["task"]
+
+
+def test_error_can_only_be_retried():
+    """error是结束状态，只能转为pending/retrying（自动安装ffmpeg后重试），重试后不再属于已结束任务"""
+    assert TASK_TRANSITIONS["error"] == {"pending", "retrying"}
+    store = store_in_state("error")
+    store.update("task", {"status": "completed"})
+    assert store.get("task").status == "error"
+    store.update("task", {"status": "pending"})
+    assert store.is_active("task")
+    assert store.finished_records() == []
+
+
+def test_finished_records_in_end_order():
+    store = TaskStore()
+    for task_id in ("a", "b", "c", "d"):
+        store.create(task_id, {"status": "downloading"})
+    store.update("b", {"status": "completed"})
+    store.update("a", {"status": "cancelled"})
+    store.update("d", {"status": "error"})
+    assert [record.task_id for record in store.finished_records()] == ["d", "a", "b"]
+    assert store.active_ids() == ["c"]
+    assert all(record.status in TERMINAL_TASK_STATES and record.end_time for record in store.finished_records())
+
+    # 重试的任务离开已结束列表，再次结束时排到最前面
+    store.update("d", {"status": "retrying"})
+    store.update("b", {"status": "error"})
+    assert [record.task_id for record in store.finished_records()] == ["a", "b"]
+    store.update("d", {"status": "completed"})
+    assert [record.task_id for record in store.finished_records()] == ["d", "a", "b"]
+
+
+def test_expire_finished_and_remove_hook():
+    removed = []
+    store = TaskStore(on_remove=removed.append)
+    store.create("old", {"status": "completed", "end_time": 100})
+    store.create("new", {"status": "downloading"})
+    store.update("new", {"status": "completed"})
+    store.create("running", {"status": "downloading"})
+
+    assert store.expire_finished(3600) == 1
+    assert removed == ["old"]
+    assert "old" not in store
+    assert [record.task_id for record in store.finished_records()] == ["new"]
+    assert store.ids_in_state("completed") == {"new"}
+
+
+def test_unknown_field_is_ignored():
+    store = store_in_state("downloading")
+    store.update("task", {"progress": 50, "no_such_field": 1})
+    assert store.get("task").progress == 50
+    assert "no_such_field" not in store.get("task").as_dict()
@@ -0,0 +1,61 @@
+"""
+命令行yt-dlp输出测试
+确认结构化输出能被解析；安静模式下写到stderr的后处理进度能通过readline读到，而不是进入错误信息缓冲区
+"""
+import sys
+import json
+import asyncio
+
+from ytdlp_process import YtdlpProcess, describe_postprocess, is_ytdlp_structured_line, parse_ytdlp_output_line
+
+
+def postprocess_line(status, postprocessor):
+    return "[ytdlp-postprocess] " + json.dumps({"status": status, "postprocessor": postprocessor, "info_dict": None})
+
+
+def test_postprocess_line_dispatch():
+    """合并开始的后处理进度解析为合并状态和merge阶段，结束事件不更新状态"""
+    kind, payload = parse_ytdlp_output_line(postprocess_line("started", "Merger"))
+    assert kind == "postprocess"
+    assert "info_dict" not in payload
+    assert describe_postprocess(payload) == ("正在合并音视频...", "merge")
+
+    kind, payload = parse_ytdlp_output_line(postprocess_line("finished", "Merger"))
+    assert describe_postprocess(payload) is None
+
+    _, payload = parse_ytdlp_output_line(postprocess_line("started", "EmbedThumbnail"))
+    assert describe_postprocess(payload) == ("正在处理文件: EmbedThumbnail", None)
+
+
+def test_parse_other_lines():
+    progress = "[ytdlp-progress] " + json.dumps({"status": "downloading", "downloaded_bytes": 10, "eta": None, "info_dict": {}})
+    assert parse_ytdlp_output_line(progress) == ("progress", {"status": "downloading", "downloaded_bytes": 10})
+    assert parse_ytdlp_output_line("[ytdlp-filepath] /tmp/a b.mp4 ") == ("filepath", "/tmp/a b.mp4")
+    assert parse_ytdlp_output_line("[ytdlp-progress] not json") == (None, "[ytdlp-progress] not json")
+    assert parse_ytdlp_output_line("ERROR: unavailable") == (None, "ERROR: unavailable")
+
+
+def test_structured_stderr_routed_to_readline():
+    """子进程写到stderr的带标记行通过readline返回，其他stderr行留在错误信息缓冲区"""
+    script = (
+        "import sys\n"
+        "print('[ytdlp-progress] {\"status\": \"downloading\"}', flush=True)\n"
+        f"print({postprocess_line('started', 'Merger')!r}, file=sys.stderr, flush=True)\n"
+        "print('WARNING: something', file=sys.stderr, flush=True)\n"
+    )
+
+    async def run():
+        process = YtdlpProcess([sys.executable, "-c", script], route_stderr=is_ytdlp_structured_line)
+        await process.start()
+        lines = []
+        while True:
+            line = await process.readline(timeout=30)
+            if line is None:
+                break
+            lines.append(line)
+        return lines, await process.wait(), process.stderr_text()
+
+    lines, returncode, stderr = asyncio.run(run())
+    assert returncode == 0
+    assert [parse_ytdlp_output_line(line)[0] for line in sorted(lines)] == ["postprocess", "progress"]
+    assert stderr == "WARNING: something"
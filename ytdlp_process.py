@@ -0,0 +1,227 @@
+"""
+命令行yt-dlp子进程
+YtdlpProcess异步读取子进程输出，parse_ytdlp_output_line解析yt-dlp的结构化输出（进度JSON、后处理进度、最终文件路径）。
+本模块只依赖标准库，导入时没有副作用；main和ytdlp_worker都从这里取进度字段。
+"""
+import json
+import time
+import asyncio
+import logging
+import threading
+import subprocess
+from collections import deque
+
+download_log = logging.getLogger("ytdl.download")
+
+# 从工作进程转发回主进程、以及从命令行进度中保留的进度字段（与DownloadProgressHook使用的字段一致）
+PROGRESS_FIELDS = (
+    "status", "downloaded_bytes", "total_bytes", "total_bytes_estimate",
+    "speed", "eta", "elapsed", "filename", "tmpfilename",
+    "fragment_index", "fragment_count", "error"
+)
+
+# 命令行yt-dlp的结构化输出：每行以标记开头，进度为JSON，文件路径为移动到最终位置后的路径。
+# 使用--print后yt-dlp进入安静模式（--progress保证进度仍然输出）：下载进度写到stdout，
+# 后处理进度通过to_screen写到stderr，因此stderr中带标记的行也要交给解析器，而不是放进错误信息缓冲区
+YTDLP_OUTPUT_TAGS = {
+    "[ytdlp-progress]": "progress",
+    "[ytdlp-postprocess]": "postprocess",
+    "[ytdlp-filepath]": "filepath",
+}
+YTDLP_STRUCTURED_OUTPUT_ARGS = [
+    "--progress-template", "download:[ytdlp-progress] %(progress)j",
+    "--progress-template", "postprocess:[ytdlp-postprocess] %(progress)j",
+    "--print", "after_move:[ytdlp-filepath] %(filepath)s",
+]
+# 后处理器开始时显示的状态
+YTDLP_POSTPROCESSOR_MESSAGES = {
+    "Merger": "正在合并音视频...",
+    "ExtractAudio": "正在转换为MP3...",
+    "FixupM3u8": "正在修复视频容器...",
+    "FixupM4a": "正在修复音频容器...",
+    "MoveFiles": "正在移动文件...",
+}
+# 对应任务吞吐量统计中阶段的后处理器
+YTDLP_POSTPROCESSOR_PHASES = {
+    "Merger": "merge",
+}
+
+# yt-dlp标准错误输出最多保留的行数，避免长时间任务累积全部输出
+STDERR_TAIL_LINES = 200
+# 单行输出的最大长度
+SUBPROCESS_LINE_LIMIT = 1024 * 1024
+# 线程读取模式下，进程退出后等待读取线程读完剩余输出的最长时间（秒）
+SUBPROCESS_READER_JOIN_TIMEOUT = 5
+
+
+def is_ytdlp_structured_line(line):
+    """是否为带结构化输出标记的行"""
+    return line.partition(" ")[0] in YTDLP_OUTPUT_TAGS
+
+
+def parse_ytdlp_output_line(line):
+    """
+    解析命令行yt-dlp的一行输出，返回(类型, 内容)
+    进度行返回去掉空值的字典（字段与进程池转发的进度一致），文件路径行返回路径，其他行返回(None, line)
+    """
+    tag, sep, payload = line.partition(" ")
+    kind = YTDLP_OUTPUT_TAGS.get(tag)
+    if kind is None or not sep:
+        return None, line
+    if kind == "filepath":
+        return kind, payload.strip()
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        return None, line
+    if kind == "progress":
+        return kind, {key: data[key] for key in PROGRESS_FIELDS if data.get(key) is not None}
+    return kind, {key: value for key, value in data.items() if value is not None}
+
+
+def describe_postprocess(payload):
+    """后处理器开始时返回(状态消息, 任务阶段)，阶段可能为None；其他后处理进度返回None"""
+    if payload.get("status") != "started":
+        return None
+    name = payload.get("postprocessor") or ""
+    return YTDLP_POSTPROCESSOR_MESSAGES.get(name, f"正在处理文件: {name}"), YTDLP_POSTPROCESSOR_PHASES.get(name)
+
+
+class YtdlpProcess:
+    """
+    基于asyncio的yt-dlp子进程封装
+    异步逐行读取stdout，stderr只保留最后若干行（环形缓冲区），不会阻塞事件循环。
+    route_stderr(line)返回True的stderr行（如安静模式下写到stderr的结构化进度）和stdout一起通过readline读取。
+    当前事件循环不支持子进程时（如Windows下的SelectorEventLoop）退回到后台线程读取
+    """
+    # 子进程启动耗时（秒）的回调，由main设置为运行指标的observe
+    spawn_observer = None
+
+    def __init__(self, cmd, env=None, stderr_lines=STDERR_TAIL_LINES, route_stderr=None):
+        self.cmd = cmd
+        self.env = env
+        self.route_stderr = route_stderr
+        self.stderr_tail = deque(maxlen=stderr_lines)
+        self.returncode = None
+        self.pid = None
+        self._lines = asyncio.Queue()  # 输出行，None表示stdout和stderr都已结束
+        self._process = None  # asyncio子进程
+        self._popen = None  # 线程模式下的Popen对象
+        self._readers = []  # 读取输出的任务（线程模式下为线程）
+        self._open_streams = 2
+
+    def _observe_spawn(self, spawn_start):
+        if self.spawn_observer is not None:
+            self.spawn_observer(time.perf_counter() - spawn_start)
+
+    def _on_stderr(self, line):
+        if self.route_stderr is not None and self.route_stderr(line):
+            self._lines.put_nowait(line)
+        else:
+            self.stderr_tail.append(line)
+
+    def _on_stream_closed(self):
+        self._open_streams -= 1
+        if self._open_streams == 0:
+            self._lines.put_nowait(None)
+
+    async def start(self):
+        creationflags = getattr(subprocess, "CREATE_NO_WINDOW", 0)  # 防止命令行窗口闪现
+        spawn_start = time.perf_counter()
+        try:
+            self._process = await asyncio.create_subprocess_exec(
+                *self.cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                env=self.env,
+                limit=SUBPROCESS_LINE_LIMIT,
+                creationflags=creationflags
+            )
+            self._observe_spawn(spawn_start)
+            self.pid = self._process.pid
+            self._readers = [
+                asyncio.create_task(self._read_stream(self._process.stdout, self._lines.put_nowait)),
+                asyncio.create_task(self._read_stream(self._process.stderr, self._on_stderr))
+            ]
+            for reader in self._readers:
+                reader.add_done_callback(lambda _: self._on_stream_closed())
+        except NotImplementedError:
+            download_log.info("当前事件循环不支持异步子进程，使用线程读取输出")
+            loop = asyncio.get_running_loop()
+            self._popen = subprocess.Popen(
+                self.cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                creationflags=creationflags,
+                env=self.env
+            )
+            self._observe_spawn(spawn_start)
+            self.pid = self._popen.pid
+
+            def forward(sink):
+                return lambda line: loop.call_soon_threadsafe(sink, line)
+
+            def at_eof():
+                loop.call_soon_threadsafe(self._on_stream_closed)
+
+            for pipe, sink in ((self._popen.stdout, self._lines.put_nowait), (self._popen.stderr, self._on_stderr)):
+                reader = threading.Thread(target=self._read_pipe, args=(pipe, forward(sink), at_eof), daemon=True)
+                reader.start()
+                self._readers.append(reader)
+
+    @staticmethod
+    async def _read_stream(stream, sink):
+        while True:
+            try:
+                line = await stream.readline()
+            except ValueError:
+                # 单行超过长度限制，丢弃该行继续读取
+                continue
+            if not line:
+                break
+            sink(line.decode("utf-8", errors="ignore").rstrip())
+
+    @staticmethod
+    def _read_pipe(pipe, sink, at_eof=None):
+        try:
+            for line in iter(pipe.readline, b""):
+                sink(line.decode("utf-8", errors="ignore").rstrip())
+        finally:
+            if at_eof:
+                at_eof()
+
+    async def readline(self, timeout=None):
+        """读取一行输出；stdout和stderr都结束后返回None，超时抛出asyncio.TimeoutError"""
+        if timeout is None:
+            return await self._lines.get()
+        return await asyncio.wait_for(self._lines.get(), timeout)
+
+    async def wait(self):
+        """等待进程退出并返回退出码"""
+        if self._process is not None:
+            self.returncode = await self._process.wait()
+            # 确保stderr已全部读入缓冲区
+            await asyncio.gather(*self._readers, return_exceptions=True)
+        elif self._popen is not None:
+            loop = asyncio.get_running_loop()
+            self.returncode = await loop.run_in_executor(None, self._popen.wait)
+            # 进程很快失败时读取线程可能还没读完stderr，等待它们结束，确保错误信息已进入缓冲区
+            await loop.run_in_executor(None, self._join_readers)
+        return self.returncode
+
+    def _join_readers(self):
+        deadline = time.monotonic() + SUBPROCESS_READER_JOIN_TIMEOUT
+        for reader in self._readers:
+            reader.join(max(0, deadline - time.monotonic()))
+
+    def terminate(self):
+        proc = self._process or self._popen
+        if proc is None or self.returncode is not None:
+            return
+        try:
+            proc.terminate()
+        except ProcessLookupError:
+            pass
+
+    def stderr_text(self):
+        return "\n".join(self.stderr_tail)
@@ -0,0 +1,159 @@
+"""
+yt-dlp进程池的工作进程入口
+进程池使用spawn方式启动工作进程，工作进程只导入本模块（标准库和yt_dlp），
+不会导入main，因此不会创建FastAPI应用、启动日志线程或打开数据库。
+本模块导入时没有副作用，工作进程的状态都保存在下面的全局变量中，由init_worker设置。
+"""
+import os
+import json
+import time
+import logging
+
+import yt_dlp
+
+from ytdlp_process import PROGRESS_FIELDS
+
+pool_log = logging.getLogger("ytdl.pool")
+
+# 每个工作进程缓存的YoutubeDL实例数量上限
+YTDLP_WORKER_CACHE_SIZE = 8
+
+# 工作进程检查暂停/取消指令的最小间隔（秒）
+WORKER_CONTROL_CHECK_INTERVAL = 0.5
+
+# 以下全局变量只在工作进程中使用
+_progress_queue = None
+_control_states = None
+_rate_limits = None
+_current_task = None
+_current_stream = None
+_current_ydl = None
+_last_control_check = 0
+_ydl_cache = {}
+
+
+class WorkerInterrupted(yt_dlp.utils.DownloadCancelled):
+    """工作进程中的下载被暂停或取消"""
+
+
+def init_worker(progress_queue, control_states, rate_limits):
+    """工作进程初始化：保存进度队列、控制状态和限速设置，预先加载YouTube提取器"""
+    global _progress_queue, _control_states, _rate_limits
+    _progress_queue = progress_queue
+    _control_states = control_states
+    _rate_limits = rate_limits
+    try:
+        with yt_dlp.YoutubeDL({"quiet": True}) as ydl:
+            ydl.get_info_extractor("Youtube")
+    except Exception as e:
+        pool_log.warning(f"预热yt-dlp工作进程时出错: {e}")
+
+
+def ping():
+    return os.getpid()
+
+
+def _check_control():
+    """主进程已暂停或取消当前任务时抛出WorkerInterrupted"""
+    if _control_states is None or _current_task is None:
+        return
+    state = _control_states.get(_current_task)
+    if state in ("paused", "cancelled"):
+        raise WorkerInterrupted(f"任务已{'暂停' if state == 'paused' else '取消'}")
+
+
+def _progress_hook(d):
+    """在工作进程中运行，把进度信息中可序列化的部分发回主进程"""
+    global _last_control_check
+    if _progress_queue is None or _current_task is None:
+        return
+
+    # 定期检查主进程下发的暂停/取消指令，抛出异常中止下载（.part文件会保留用于续传）
+    now = time.time()
+    if _control_states is not None and now - _last_control_check >= WORKER_CONTROL_CHECK_INTERVAL:
+        _last_control_check = now
+        _check_control()
+        # 应用主进程分配的速率上限，yt-dlp每读取一块数据都会重新读取ratelimit参数
+        if _rate_limits is not None and _current_ydl is not None:
+            rate = _rate_limits.get(_current_task) or None
+            if _current_ydl.params.get("ratelimit") != rate:
+                _current_ydl.params["ratelimit"] = rate
+
+    message = {key: d[key] for key in PROGRESS_FIELDS if key in d}
+    if _current_stream is not None:
+        message["stream"] = _current_stream
+    info = d.get("info_dict") or {}
+    for key in ("playlist_index", "playlist_count"):
+        if info.get(key) is not None:
+            message[key] = info[key]
+    _progress_queue.put((_current_task, message))
+
+
+def _get_ydl(ydl_opts):
+    """按参数复用工作进程中已创建的YoutubeDL实例"""
+    key = json.dumps(ydl_opts, sort_keys=True, default=str)
+    ydl = _ydl_cache.get(key)
+    if ydl is None:
+        if len(_ydl_cache) >= YTDLP_WORKER_CACHE_SIZE:
+            # 淘汰最早创建的实例
+            oldest = _ydl_cache.pop(next(iter(_ydl_cache)))
+            oldest.close()
+        opts = dict(ydl_opts)
+        opts.update({
+            "quiet": True,
+            "noprogress": True,
+            "progress_hooks": [_progress_hook]
+        })
+        ydl = yt_dlp.YoutubeDL(opts)
+        _ydl_cache[key] = ydl
+    return ydl
+
+
+def summarize_info(info):
+    """提取下载结果中主进程需要的字段，保证结果可以跨进程传递"""
+    entries = [info]
+    if info.get("_type") == "playlist":
+        entries = [entry for entry in info.get("entries") or [] if entry]
+
+    filepaths = []
+    for entry in entries:
+        for download in entry.get("requested_downloads") or []:
+            if download.get("filepath"):
+                filepaths.append(download["filepath"])
+
+    return {
+        "id": info.get("id"),
+        "title": info.get("title"),
+        "uploader": info.get("uploader"),
+        "duration": info.get("duration") or 0,
+        "filepaths": filepaths
+    }
+
+
+def download(task_id, video_url, ydl_opts, info=None, stream=None):
+    """
+    在工作进程中执行一次下载，返回精简后的视频信息
+    传入info时直接使用已解析的视频信息下载（不再重新解析），stream标记同一任务中并行下载的流
+    """
+    global _current_task, _current_stream, _current_ydl
+    _current_task = task_id
+    _current_stream = stream
+    try:
+        # 任务可能在进程池队列中等待时被暂停或取消
+        _check_control()
+        ydl = _current_ydl = _get_ydl(ydl_opts)
+        if info is None:
+            # 先只解析视频信息，解析期间没有进度回调，解析结束后检查一次暂停/取消再开始下载
+            info = ydl.extract_info(video_url, download=False, process=False)
+            _check_control()
+        info = ydl.process_ie_result(info, download=True)
+        return summarize_info(ydl.sanitize_info(info))
+    except Exception as e:
+        # yt-dlp的异常可能携带无法序列化的traceback，转换为普通异常再返回主进程
+        raise RuntimeError(str(e)) from None
+    finally:
+        if _current_ydl is not None:
+            _current_ydl.params.pop("ratelimit", None)
+        _current_task = None
+        _current_stream = None
+        _current_ydl = None